@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+'''
+Compare the dedup backends of ``huabot.dedup``: throughput of ``has`` on
+fresh and repeated members, and the redis memory each one ends up using.
+
+    REDIS_PORT=tcp://127.0.0.1:6379 python benchmarks/bench_dedup.py -n 100000
+
+Runs against the redis in REDIS_PORT under a throwaway DB_PREFIX, or a
+throwaway redis-server when none answers there, see ``redis_server``.
+'''
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+
+from redis_server import ensure_redis
+
+print(ensure_redis())
+os.environ.setdefault('DB_PREFIX', 'huabot-bench')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from huabot.db import DB
+from huabot.dedup import SetDedup, BloomDedup
+
+
+def members(count, seed):
+    rnd = random.Random(seed)
+    return [hashlib.sha1(bytes(str(rnd.random()), 'utf-8')).hexdigest()
+            for _ in range(count)]
+
+
+def memory_usage(db, pattern):
+    total = 0
+    for key in db._db.scan_iter(db.object_key(pattern)):
+        total += db._db.execute_command('MEMORY', 'USAGE', key) or 0
+    return total
+
+
+def run(name, dedup, db, fresh, again):
+    key = 'bench:{}:uniq'.format(name)
+    dedup.clear(key)
+
+    start = time.time()
+    for member in fresh:
+        dedup.has(key, member)
+    insert = time.time() - start
+
+    start = time.time()
+    hits = sum(1 for member in again if dedup.has(key, member))
+    lookup = time.time() - start
+
+    unseen = members(len(fresh) // 10 or 1, 'unseen')
+    false_positive = sum(1 for member in unseen if dedup.has(key, member))
+
+    memory = memory_usage(db, key + '*')
+    dedup.clear(key)
+
+    return {
+        'backend': name,
+        'insert/s': len(fresh) / insert,
+        'lookup/s': len(again) / lookup,
+        'hits': hits,
+        'fp rate': false_positive / len(unseen),
+        'bytes/member': memory / len(fresh),
+        'memory': memory,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=100000)
+    parser.add_argument('--error-rate', type=float, default=0.001)
+    args = parser.parse_args()
+
+    db = DB()
+    fresh = members(args.count, 'fresh')
+    backends = [
+        ('set', SetDedup(db)),
+        ('bloom', BloomDedup(db, capacity=max(args.count // 4, 1000),
+                             error_rate=args.error_rate)),
+    ]
+
+    print('{:<8} {:>10} {:>10} {:>8} {:>8} {:>13} {:>12}'.format(
+        'backend', 'insert/s', 'lookup/s', 'hits', 'fp rate',
+        'bytes/member', 'memory'))
+    for name, dedup in backends:
+        ret = run(name, dedup, db, fresh, fresh)
+        print('{backend:<8} {insert/s:>10.0f} {lookup/s:>10.0f} {hits:>8} '
+              '{fp rate:>8.4f} {bytes/member:>13.1f} {memory:>12}'.format(
+                  **ret))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+'''
+Compare the link codecs of ``huabot.codec``: payload size, the redis memory
+of the ``link:<fingerprint>`` keys, and encode/decode throughput including
+grapy's own pack and ``Request.build``.
+
+    REDIS_PORT=tcp://127.0.0.1:6379 python benchmarks/bench_link_codec.py -n 50000
+
+Runs against the redis in REDIS_PORT under a throwaway DB_PREFIX, or a
+throwaway redis-server when none answers there, see ``redis_server``.
+'''
+import os
+import sys
+import time
+import random
+import argparse
+
+from redis_server import ensure_redis
+
+print(ensure_redis())
+os.environ.setdefault('DB_PREFIX', 'huabot-bench')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from grapy.core import Request
+from huabot.db import DB
+from huabot.utils import fingerprint
+from huabot.codec import codecs, LinkCodec
+
+
+HOSTS = ['https://www.example.com', 'http://news.example.org',
+         'https://api.example.net/v1']
+
+
+def requests(count, seed):
+    rnd = random.Random(seed)
+    reqs = []
+    for i in range(count):
+        host = rnd.choice(HOSTS)
+        if host.endswith('/v1'):
+            req = Request('{}/statuses/{}.json?page={}'.format(
+                host, rnd.randrange(10 ** 9), rnd.randrange(100)),
+                callback='parse_item', headers={
+                    'User-Agent': 'Huabot',
+                    'Accept': 'application/json',
+                    'Authorization': 'Bearer ' + '%032x' % rnd.getrandbits(128),
+                })
+        else:
+            req = Request('{}/{}/{}.html'.format(
+                host, rnd.choice(['news', 'blog', 'item']),
+                rnd.randrange(10 ** 7)))
+        req.group = rnd.randrange(1, 50)
+        reqs.append(req)
+    return reqs
+
+
+def memory_usage(db, pattern):
+    total = 0
+    for key in db._db.scan_iter(db.object_key(pattern)):
+        total += db._db.execute_command('MEMORY', 'USAGE', key) or 0
+    return total
+
+
+def run(name, codec, db, reqs):
+    start = time.time()
+    datas = [codec.encode(bytes(req)) for req in reqs]
+    encode = time.time() - start
+
+    start = time.time()
+    for data in datas:
+        Request.build(codec.decode(data))
+    decode = time.time() - start
+
+    pattern = 'bench:link:{}:'.format(name)
+    db.drop_objects(pattern + '*')
+    pipe = db.pipeline(False)
+    for req, data in zip(reqs, datas):
+        pipe.set(db.object_key(pattern + fingerprint(req.url)), data)
+    pipe.execute()
+    memory = memory_usage(db, pattern + '*')
+    db.drop_objects(pattern + '*')
+
+    return {
+        'codec': name,
+        'encode/s': len(reqs) / encode,
+        'decode/s': len(reqs) / decode,
+        'payload': sum(len(data) for data in datas) / len(datas),
+        'bytes/link': memory / len(reqs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=50000)
+    args = parser.parse_args()
+
+    db = DB()
+    reqs = requests(args.count, 'links')
+
+    print('{:<10} {:>10} {:>10} {:>8} {:>11}'.format(
+        'codec', 'encode/s', 'decode/s', 'payload', 'bytes/link'))
+    for name, factory in sorted(codecs.items()):
+        try:
+            codec = LinkCodec(factory())
+        except ValueError as e:
+            print('{:<10} skipped: {}'.format(name, e))
+            continue
+        ret = run(name, codec, db, reqs)
+        print('{codec:<10} {encode/s:>10.0f} {decode/s:>10.0f} '
+              '{payload:>8.1f} {bytes/link:>11.1f}'.format(**ret))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+A redis for the benchmarks: the one in REDIS_PORT when it answers, else
+a throwaway ``redis-server`` (from PATH, or the one bundled with
+redislite) started on a free port and stopped at exit.
+
+Call ``ensure_redis`` before importing huabot, which reads REDIS_PORT and
+talks to redis at import time.
+'''
+import os
+import time
+import atexit
+import shutil
+import socket
+import tempfile
+import subprocess
+
+DEFAULT_PORT = 'tcp://127.0.0.1:6379'
+
+
+def _answers(host, port):
+    try:
+        sock = socket.create_connection((host, int(port)), timeout=0.5)
+    except OSError:
+        return False
+    try:
+        sock.sendall(b'PING\r\n')
+        return sock.recv(16).startswith(b'+PONG')
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def _executable():
+    path = shutil.which('redis-server')
+    if path:
+        return path
+    try:
+        import redislite
+    except ImportError:
+        return None
+    return redislite.__redis_executable__
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def ensure_redis(spawn=False):
+    '''
+    Point REDIS_PORT at a redis that answers and return a short
+    description of it. ``spawn`` always starts a fresh one, so results do
+    not depend on whatever else the shared one holds.
+    '''
+    host, port = os.environ.get('REDIS_PORT', DEFAULT_PORT)[6:].split(':')
+    if not spawn and _answers(host, port):
+        return 'redis at {}:{}'.format(host, port)
+
+    executable = _executable()
+    if not executable:
+        raise RuntimeError('no redis at {}:{} and no redis-server to '
+                           'start'.format(host, port))
+
+    port = _free_port()
+    workdir = tempfile.mkdtemp(prefix='huabot-bench-')
+    proc = subprocess.Popen(
+        [executable, '--port', str(port), '--bind', '127.0.0.1',
+         '--save', '', '--appendonly', 'no', '--dir', workdir],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop():
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    atexit.register(stop)
+
+    deadline = time.time() + 10
+    while not _answers('127.0.0.1', port):
+        if proc.poll() is not None or time.time() > deadline:
+            raise RuntimeError('{} did not start'.format(executable))
+        time.sleep(0.05)
+
+    os.environ['REDIS_PORT'] = 'tcp://127.0.0.1:{}'.format(port)
+    return 'spawned {} on port {}'.format(executable, port)
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+'''
+The hot paths of huabot against a real redis: ops/sec, redis round trips
+per op (counted by ``huabot.metrics``) and redis memory per entity, with
+an optional comparison to a saved baseline.
+
+    python benchmarks/suite.py -n 2000 --save benchmarks/baseline.json
+    python benchmarks/suite.py -n 2000 --baseline benchmarks/baseline.json
+
+Uses the redis in REDIS_PORT, or starts one, see ``redis_server``;
+``--spawn`` always starts a fresh one. The data lives under its own
+DB_PREFIX, ``huabot-bench-<pid>``, whatever the environment says, and the
+suite refuses to run when a shared redis already holds keys under it.
+Exits 1 when a case regressed: slower or bigger than the tolerance
+allows, or more round trips at all. The api cases are skipped when the
+api's dependencies are missing.
+
+``--backend memory`` runs the same cases on the in-memory storage
+backend, no redis needed; it makes no round trips and reports no memory,
+its ops/s are the baseline for what redis itself costs. ``--backend
+sqlite`` runs them on a throwaway file, removed at exit.
+'''
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+
+from redis_server import DEFAULT_PORT, ensure_redis
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=2000)
+    parser.add_argument('-k', '--cases', nargs='*', help='only these cases')
+    parser.add_argument('--backend', default='redis',
+                        help='the huabot.storage backend, default: redis')
+    parser.add_argument('--spawn', action='store_true',
+                        help='always start a throwaway redis-server')
+    parser.add_argument('--baseline', help='compare with this json')
+    parser.add_argument('--save', help='write the results to this json')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown or growth allowed, 0.2 is 20%%')
+    return parser.parse_args()
+
+
+def bench_env(args):
+    '''
+    Point huabot at data of its own: ``run`` drops everything under the
+    prefix, which must never be someone's crawl.
+    '''
+    os.environ['DB_BACKEND'] = args.backend
+    os.environ['DB_PREFIX'] = 'huabot-bench-{}'.format(os.getpid())
+    if args.backend == 'sqlite':
+        workdir = tempfile.mkdtemp(prefix='huabot-bench-')
+        atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+        os.environ['DB_SQLITE_PATH'] = os.path.join(workdir, 'bench.sqlite3')
+    if args.backend != 'redis':
+        return
+
+    print(ensure_redis(args.spawn))
+    if args.spawn:
+        return
+    from redis import StrictRedis
+    host, port = os.environ.get('REDIS_PORT', DEFAULT_PORT)[6:].split(':')
+    pattern = os.environ['DB_PREFIX'] + ':*'
+    for _ in StrictRedis(host, int(port)).scan_iter(pattern, 500):
+        sys.exit('{} is not empty, use --spawn'.format(pattern))
+
+# huabot reads its environment and talks to redis as it is imported
+if __name__ == '__main__':
+    ARGS = parse_args()
+    bench_env(ARGS)
+
+os.environ.setdefault('DB_PREFIX', 'huabot-bench')
+os.environ['METRICS'] = '1'
+os.environ['PACE_ROBOT_RATE'] = '0'
+os.environ['PACE_HOST_RATE'] = '0'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from grapy.core import Request, Item
+from huabot import db
+from huabot.utils import fingerprint, get_cls_name
+from huabot.metrics import registry
+from huabot.robot import BaseRobot
+from huabot.sched import CommonScheduler, RobotBased
+
+loop = asyncio.get_event_loop()
+CASES = []
+
+
+def case(func):
+    CASES.append(func)
+    return func
+
+
+def url_of(i):
+    return 'https://www.example.com/statuses/{}.json'.format(i)
+
+
+def new_task(user_id, i):
+    task = db.Task(None, {'user_id': user_id, 'url': url_of(i),
+                          'hash_url': fingerprint(url_of(i)),
+                          'name': 'task {}'.format(i)})
+    task.save()
+    return task
+
+
+def new_robot(user_id, i, subscribe=()):
+    robot = db.Robot(None, {'user_id': user_id, 'name': 'robot {}'.format(i),
+                            'subscribe': list(subscribe), 'alive': True})
+    robot.save()
+    return robot
+
+
+def new_user(name='bench'):
+    user = db.User(None, {'name': name, 'passwd': name})
+    user.save()
+    return user
+
+
+@case
+def table_save(count):
+    '''``Task.save`` of new rows, the entity is a task.'''
+    ids = iter(range(count))
+    return lambda: new_task(1, next(ids))
+
+
+@case
+def table_load(count):
+    '''``Task.payload`` of saved rows, one fresh object each.'''
+    tasks = [new_task(1, i).index for i in range(min(count, 1000))]
+    ids = iter(range(count))
+    return lambda: db.Task(tasks[next(ids) % len(tasks)]).payload['url']
+
+
+@case
+def push_req(count):
+    '''``CommonScheduler.push_req`` of new urls, the entity is a link.'''
+    task = new_task(1, 0)
+    sched = CommonScheduler(loop=loop)
+    ids = iter(range(count))
+
+    def op():
+        req = Request(url_of(next(ids)))
+        req.group = task.index
+        sched.push_req(req)
+    return op
+
+
+@case
+def task_has(count):
+    '''``Task.has`` of new fingerprints, the entity is a member.'''
+    task = new_task(1, 0)
+    ids = iter(range(count))
+    return lambda: task.has(fingerprint(url_of(next(ids))))
+
+
+@case
+def link_has(count):
+    '''``Link.has`` of new fingerprints, the entity is a member.'''
+    ids = iter(range(count))
+    return lambda: db.Link.has(fingerprint(url_of(next(ids))))
+
+
+@case
+def incr_succeed_count(count):
+    '''``Countable.incr_succeed_count`` of one task.'''
+    task = new_task(1, 0)
+    return task.incr_succeed_count
+
+
+class BenchItem(Item):
+    pass
+
+
+class StubRobot(BaseRobot):
+
+    @asyncio.coroutine
+    def process(self, item):
+        yield from asyncio.sleep(0)
+        return 1
+
+
+class BenchScheduler(CommonScheduler):
+    '''
+    Hands items straight to a stub robot, the way the example pipeline
+    does, instead of going through a grapy engine.
+    '''
+    # the robot scheduler's, without its periodic worker pool
+    push_item = RobotBased.push_item
+
+    def submit_item(self, item):
+        robot = StubRobot(item['robot_id'], loop=self.loop)
+        ret = yield from robot.process(item)
+        if ret:
+            robot.set_success(item)
+
+
+@case
+def item_flow(count):
+    '''
+    ``process_on_item`` claiming queued items for a stub robot, one item
+    per call; the entity is a queued item, measured while queueing.
+    '''
+    task = new_task(1, 0)
+    robot = new_robot(1, 0, [task.index])
+    for i in range(count):
+        db.Item(None, {'task_id': task.index, 'hash_url': fingerprint(
+            url_of(i)), 'cls_name': get_cls_name(BenchItem()),
+            'text': 'item {}'.format(i)}).save()
+    sched = BenchScheduler(loop=loop)
+
+    def op():
+        loop.run_until_complete(
+            sched.process_on_item(robot, [task.index]))
+    return op
+
+
+def api_case(func):
+    '''
+    An api handler called directly with a bound request, without http
+    and sessions; the fixture is one user with 100 tasks and robots.
+    '''
+    def setup(count):
+        try:
+            import bottle
+            from huabot.api import route
+        except ImportError as e:
+            raise SkipCase('api not importable: {}'.format(e))
+        user = new_user()
+        for i in range(100):
+            task = new_task(user.index, i)
+            robot = new_robot(user.index, i, [task.index])
+            db.Countable.incr_succeed_counts(robot, task, user)
+        query = 'start={}'.format(int(time.time()) - 3 * 86400)
+        bottle.request.bind({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+                             'QUERY_STRING': query})
+        return lambda: func(route, db.User(user.index))
+    setup.__name__ = func.__name__
+    setup.__doc__ = func.__doc__
+    return case(setup)
+
+
+@api_case
+def api_tasks(route, user):
+    '''GET /api/tasks/, 20 tasks with their succeed counts.'''
+    return route.get_tasks(user)
+
+
+@api_case
+def api_robots(route, user):
+    '''GET /api/robots/, 20 robots with their succeed counts.'''
+    return route.get_robots(user)
+
+
+@api_case
+def api_chart(route, user):
+    '''GET /api/hour/succeed_count, 80 hourly points.'''
+    return route.get_succeed_count('hour', user)
+
+
+@api_case
+def api_range_chart(route, user):
+    '''GET /api/succeed_count over the last three days.'''
+    return route.get_range_succeed_count(user)
+
+
+class SkipCase(Exception):
+    pass
+
+
+def used_memory():
+    return int(db.db._db.info('memory').get('used_memory', 0))
+
+
+def run(setup, count):
+    db.db.drop_objects('*')
+    op = setup(count)
+
+    memory = used_memory()
+    trips = registry.count('huabot_redis_seconds')
+    start = time.time()
+    for _ in range(count):
+        op()
+    spent = time.time() - start
+    trips = registry.count('huabot_redis_seconds') - trips
+    memory = used_memory() - memory
+    if setup is item_flow:
+        # the items were queued during setup, they are gone by now
+        memory = -memory
+
+    db.db.drop_objects('*')
+    return {
+        'ops/s': count / spent,
+        'trips/op': trips / count,
+        'bytes/op': max(memory, 0) / count,
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''
+    The regressions of ``results`` against ``baseline``, as lines.
+    Round trips are deterministic and may not grow at all; memory
+    below 16 bytes per op is noise.
+    '''
+    regressions = []
+    for name, ret in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        if ret['ops/s'] < base['ops/s'] * (1 - tolerance):
+            regressions.append('{}: {:.0f} ops/s, baseline {:.0f}'.format(
+                name, ret['ops/s'], base['ops/s']))
+        if ret['trips/op'] > base['trips/op'] + 0.01:
+            regressions.append('{}: {:.2f} trips/op, baseline {:.2f}'.format(
+                name, ret['trips/op'], base['trips/op']))
+        if base['bytes/op'] >= 16 and \
+                ret['bytes/op'] > base['bytes/op'] * (1 + tolerance):
+            regressions.append('{}: {:.0f} bytes/op, baseline {:.0f}'.format(
+                name, ret['bytes/op'], base['bytes/op']))
+    return regressions
+
+
+def main(args):
+    results = {}
+    print('{:<20} {:>10} {:>9} {:>9}'.format(
+        'case', 'ops/s', 'trips/op', 'bytes/op'))
+    for setup in CASES:
+        if args.cases and setup.__name__ not in args.cases:
+            continue
+        try:
+            ret = run(setup, args.count)
+        except SkipCase as e:
+            print('{:<20} skipped, {}'.format(setup.__name__, e))
+            continue
+        results[setup.__name__] = ret
+        print('{:<20} {ops/s:>10.0f} {trips/op:>9.2f} {bytes/op:>9.0f}'.format(
+            setup.__name__, **ret))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'count': args.count, 'python': platform.python_version(),
+                       'backend': args.backend,
+                       'redis': db.db._db.info()['redis_version'],
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('backend', 'redis') != args.backend:
+            sys.exit('{} holds {} results'.format(
+                args.baseline, baseline.get('backend', 'redis')))
+        baseline = baseline['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        if regressions:
+            sys.exit(1)
+        print('no regression against', args.baseline)
+
+
+if __name__ == '__main__':
+    try:
+        main(ARGS)
+    finally:
+        db.db.drop_objects('*')
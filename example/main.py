@@ -2,6 +2,8 @@
 import argparse
 from grapy import engine
 from huabot import sched
+from huabot.supervisor import Supervisor
+from huabot.storage import check_shared
 from grapy.utils import (
     import_middlewares,
     import_pipelines,
@@ -13,7 +15,7 @@ from config import spiders, pipelines, middlewares
 import os
 import logging
 import logging.handlers
-from huabot.utils import logger
+from huabot.utils import logger, ENGINE_SHARDS
 
 
 def start_engine(flag=True):
@@ -27,6 +29,12 @@ def start_engine(flag=True):
     engine.start(flag)
 
 
+def run_engine(tasks, shard=0):
+    engine.set_sched(sched.RobotBasedScheduler(
+        tasks=tasks, loop=engine.loop, shard=shard))
+    start_engine(True)
+
+
 def start_web():
     from bottle import run
     import www
@@ -81,12 +89,24 @@ def main():
 
     grapy_logger.addHandler(ch)
 
-    engine.set_sched(sched.RobotBasedScheduler(tasks=args.tasks))
+    if args.cmd in ('engine', 'web'):
+        check_shared('the engine and the web apart, use: all')
 
     if args.cmd == 'engine':
-        start_engine(True)
+        if ENGINE_SHARDS > 1:
+            Supervisor(lambda shard: run_engine(args.tasks, shard)).run()
+        else:
+            run_engine(args.tasks)
+        return
+
+    if ENGINE_SHARDS > 1 and args.cmd != 'web':
+        raise SystemExit('ENGINE_SHARDS={}: run the engine and the web '
+                         'separately'.format(ENGINE_SHARDS))
+
+    engine.set_sched(sched.RobotBasedScheduler(
+        tasks=args.tasks, loop=engine.loop))
 
-    elif args.cmd == 'web':
+    if args.cmd == 'web':
         start_web()
 
     else:
@@ -3,7 +3,7 @@ import aiohttp
 from time import time
 
 import os
-from huabot.utils import logger, json_decode, hash_url
+from huabot.utils import logger, json_decode, fingerprint
 from huabot.robot import BaseRobot, RobotError
 
 YB_HOST = os.environ.get('YB_HOST', 'huabot.com')
@@ -103,24 +103,19 @@ class YabbyRobot(BaseRobot):
             self.update_robot()
 
     def update_robot(self):
-        change = False
-        keys = ['expires_in', 'access_token', 'refresh_token', 'expires_at']
-        for key in keys:
-            if self._robot.payload[key] != self.token[key]:
-                self._robot.payload[key] = self.token[key]
-                change = True
-
-        keys = ['username']
-        for key in keys:
-            if self._robot.payload[key] != self.user[key]:
-                self._robot.payload[key] = self.user[key]
-                change = True
-
-        if change:
-            self._robot.save()
+        # writes only the fields that changed, the token ones on a refresh
+        fields = {}
+        for key in ['expires_in', 'access_token', 'refresh_token',
+                    'expires_at']:
+            fields[key] = self.token[key]
+
+        for key in ['username']:
+            fields[key] = self.user[key]
+
+        self._robot.update(**fields)
 
     def process(self, tweet):
-        if self._robot.has_item(hash_url(tweet['text'])):
+        if self._robot.has_item(fingerprint(tweet['text'])):
             return 0
 
         tweet['text'] = tweet['text'][:150]
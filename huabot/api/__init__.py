@@ -26,7 +26,9 @@ session_opts = {
     'session.type': 'ext:redis',
     'session.cookie_expires': 7 * 24 * 60 * 60,
     'session.url': REDIS_PORT[6:],
-    'session.auto': True
+    'session.expire': 7 * 24 * 60 * 60,
+    'session.auto': True,
+    'session.storage': os.environ.get('SESSION_STORAGE', 'hash'),
 }
 
 server = SessionMiddleware(app, session_opts)
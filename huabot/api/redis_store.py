@@ -1,5 +1,9 @@
 import json
 import logging
+import binascii
+from base64 import b64decode
+from time import time
+from collections import OrderedDict
 from beaker.exceptions import InvalidCacheBackendError
 
 from .nosql import Container
@@ -8,6 +12,7 @@ from .nosql import pickle
 
 try:
     from redis import StrictRedis, ConnectionPool
+    from redis.exceptions import ResponseError
 except ImportError:
     raise InvalidCacheBackendError(
         "Redis cache backend requires the 'redis' library")
@@ -18,6 +23,14 @@ log = logging.getLogger(__name__)
 class RedisManager(NoSqlManager):
 
     connection_pools = {}
+    # (redis key, hash field) -> [payload, payload without the access
+    # time, read at, expire refreshed at], shared by the managers of a
+    # process
+    local_cache = OrderedDict()
+    local_cache_size = 10000
+    # the items beaker stores in a namespace, which the hash layout still
+    # reads from, and removes, under their legacy string keys
+    legacy_keys = ('session',)
 
     def __init__(self,
                  namespace,
@@ -27,6 +40,15 @@ class RedisManager(NoSqlManager):
                  **params):
         self.db = params.pop('db', None)
         self.dbpass = params.pop('password', None)
+        # hash: one hash per namespace, so the namespace is listed and
+        # removed without scanning the keyspace; string: the legacy layout,
+        # one key per item
+        self.storage = params.pop('storage', 'hash')
+        self.scan_count = int(params.pop('scan_count', 500))
+        # seconds a decoded item is served from the process cache, and
+        # the least seconds between two EXPIREs of an unchanged item
+        self.cache_ttl = float(params.pop('cache_ttl', 5))
+        self.refresh_interval = float(params.pop('refresh_interval', 300))
         NoSqlManager.__init__(self,
                               namespace,
                               url=url,
@@ -43,12 +65,114 @@ class RedisManager(NoSqlManager):
         self.db_conn = StrictRedis(
             connection_pool=self.connection_pools[pool_key], **params)
 
+    def _serialize(self, value):
+        if self.serializer == 'json':
+            return json.dumps(value, ensure_ascii=True)
+        return pickle.dumps(value, 2)
+
+    def _deserialize(self, payload):
+        if self.serializer == 'json':
+            if isinstance(payload, bytes):
+                payload = payload.decode('utf-8')
+            return json.loads(payload)
+        return pickle.loads(payload)
+
+    def _location(self, key):
+        if self.storage == 'hash':
+            return self._namespace_key(), key
+        return self._format_key(key), None
+
+    def _session_data(self, value):
+        # beaker >= 1.8 hands sessions over serialized and base64 encoded;
+        # encrypted ones can not be read and always count as changed
+        if not isinstance(value, (bytes, str)):
+            return value
+        try:
+            data = b64decode(value, validate=True)
+        except (binascii.Error, ValueError):
+            return None
+        for loads in [pickle.loads, json.loads]:
+            try:
+                return loads(data)
+            except Exception:
+                pass
+        return None
+
+    def _clean(self, value):
+        # beaker rewrites _accessed_time on every request, it does not
+        # make the session dirty
+        data = self._session_data(value)
+        if isinstance(data, dict) and '_accessed_time' in data:
+            data = dict(data)
+            data.pop('_accessed_time')
+            return self._serialize(data)
+        return self._serialize(value)
+
+    def _cache_get(self, location):
+        entry = self.local_cache.get(location)
+        if entry and time() - entry[2] < self.cache_ttl:
+            return entry
+        return None
+
+    def _cache_set(self, location, payload, clean, refreshed_at):
+        self.local_cache[location] = [payload, clean, time(), refreshed_at]
+        self.local_cache.move_to_end(location)
+        while len(self.local_cache) > self.local_cache_size:
+            self.local_cache.popitem(last=False)
+
+    def __getitem__(self, key):
+        location = self._location(key)
+        entry = self._cache_get(location)
+        if entry:
+            return self._deserialize(entry[0])
+
+        name, field = location
+        if field is None:
+            payload = self.db_conn.get(name)
+        else:
+            payload = self.db_conn.hget(name, field)
+        if payload is None and field is not None:
+            payload = self._migrate_legacy(key)
+        if payload is None:
+            raise KeyError(key)
+
+        value = self._deserialize(payload)
+        old = self.local_cache.get(location)
+        refreshed_at = old[3] if old and old[0] == payload else 0
+        self._cache_set(location, payload, self._clean(value), refreshed_at)
+        return value
+
     def __contains__(self, key):
-        return self.db_conn.exists(self._format_key(key))
+        location = self._location(key)
+        if self._cache_get(location):
+            return True
+        name, field = location
+        if field is None:
+            return self.db_conn.exists(name)
+        return self.db_conn.hexists(name, field) or \
+            self.db_conn.exists(self._format_key(key))
 
-    def set_value(self, key, value, expiretime=None):
-        key = self._format_key(key)
+    def _migrate_legacy(self, key):
+        # a session written before the switch to the hash layout: move it
+        # into the namespace hash, keeping what is left of its expiry
+        legacy = self._format_key(key)
+        pipe = self.db_conn.pipeline()
+        pipe.get(legacy)
+        pipe.pttl(legacy)
+        pipe.delete(legacy)
+        payload, ttl, _ = pipe.execute()
+        if payload is None:
+            return None
 
+        name = self._namespace_key()
+        pipe = self.db_conn.pipeline()
+        pipe.hset(name, key, payload)
+        if ttl > 0:
+            pipe.pexpire(name, ttl)
+        pipe.execute()
+        return payload
+
+    def set_value(self, key, value, expiretime=None):
         #
         # beaker.container.Value.set_value calls NamespaceManager.set_value
         # however it (until version 1.6.4) never sets expiretime param.
@@ -60,18 +184,47 @@ class RedisManager(NoSqlManager):
         if (expiretime is None) and (type(value) is tuple):
             expiretime = value[1]
 
-        if self.serializer == 'json':
-            serialized_value = json.dumps(value, ensure_ascii=True)
-        else:
-            serialized_value = pickle.dumps(value, 2)
+        location = self._location(key)
+        name, field = location
+        clean = self._clean(value)
+        now = time()
 
-        if expiretime:
-            self.db_conn.setex(key, expiretime, serialized_value)
+        # unchanged since read or written here: skip the write, only
+        # push the expiry back now and then
+        entry = self.local_cache.get(location)
+        if entry and entry[1] == clean:
+            if expiretime and now - entry[3] >= self.refresh_interval:
+                self.db_conn.expire(name, expiretime)
+                entry[3] = now
+            return
+
+        serialized_value = self._serialize(value)
+
+        if field is not None:
+            pipe = self.db_conn.pipeline()
+            pipe.hset(name, field, serialized_value)
+            if expiretime:
+                pipe.expire(name, expiretime)
+            pipe.execute()
+        elif expiretime:
+            self.db_conn.setex(name, expiretime, serialized_value)
         else:
-            self.db_conn.set(key, serialized_value)
+            self.db_conn.set(name, serialized_value)
+
+        self._cache_set(location, serialized_value, clean, now)
 
     def __delitem__(self, key):
-        self.db_conn.delete(self._format_key(key))
+        location = self._location(key)
+        self.local_cache.pop(location, None)
+        name, field = location
+        if field is None:
+            self.db_conn.delete(name)
+        else:
+            self.db_conn.pipeline() \
+                .hdel(name, field).delete(self._format_key(key)).execute()
+
+    def _namespace_key(self):
+        return 'beaker:%s' % self.namespace
 
     def _format_key(self, key):
         return 'beaker:%s:%s' % (self.namespace, key.replace(' ', '\302\267'))
@@ -79,11 +232,45 @@ class RedisManager(NoSqlManager):
     def _format_pool_key(self, host, port, db):
         return '{0}:{1}:{2}'.format(host, port, self.db)
 
+    def _unlink(self, keys):
+        # UNLINK frees the values in a background thread, DEL on servers
+        # older than 4.0
+        try:
+            self.db_conn.execute_command('UNLINK', *keys)
+        except ResponseError:
+            self.db_conn.delete(*keys)
+
+    def _scan_keys(self):
+        return self.db_conn.scan_iter(
+            'beaker:%s:*' % self.namespace, self.scan_count)
+
     def do_remove(self):
-        self.db_conn.flush()
+        for location in list(self.local_cache):
+            if location[0] == self._namespace_key() or \
+                    location[0].startswith(self._namespace_key() + ':'):
+                self.local_cache.pop(location, None)
+
+        if self.storage == 'hash':
+            self._unlink([self._namespace_key()] +
+                         [self._format_key(key) for key in self.legacy_keys])
+            return
+
+        batch = []
+        for key in self._scan_keys():
+            batch.append(key)
+            if len(batch) >= self.scan_count:
+                self._unlink(batch)
+                batch = []
+        if batch:
+            self._unlink(batch)
 
     def keys(self):
-        return self.db_conn.keys('beaker:%s:*' % self.namespace)
+        if self.storage == 'hash':
+            return [key.decode('utf-8')
+                    for key in self.db_conn.hkeys(self._namespace_key())]
+
+        skip = len('beaker:%s:' % self.namespace)
+        return [key.decode('utf-8')[skip:] for key in self._scan_keys()]
 
 
 class RedisContainer(Container):
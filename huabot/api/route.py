@@ -2,8 +2,9 @@ from huabot.api import app, request, response
 from huabot.utils import hash_url, submit_task
 from huabot.periodic import sched_task, sched_robot
 from huabot import db
+from huabot import metrics
 import json
-from datetime import datetime, timedelta
+from datetime import datetime
 
 
 def json_response(key=None, data=None, err=None, status=200):
@@ -235,17 +236,16 @@ def get_robots(user):
     robot_start = robot_count - stop
     robot_stop = robot_count - start
 
-    robot_ids = db.Task.range_by_user_id(user.user_id, robot_start, robot_stop)
-    robot_ids = sorted(robot_ids, key=lambda x: int(x.member), reverse=True)
+    robot_ids = db.Robot.range_by_user_id(user.user_id, robot_start,
+                                          robot_stop)
+    robot_ids = sorted([int(x.member) for x in robot_ids], reverse=True)
 
-    robots = []
-    for index in robot_ids:
-        robot = db.Task(index.member)
-        if not robot.payload:
-            continue
-        data = robot.payload.copy()
-        data['succeed_count'] = robot.succeed_count
-        robots.append(data)
+    robots = [robot for robot in db.Robot.get_many(robot_ids) if robot]
+    counts = db.Robot.succeed_counts([robot.index for robot in robots],
+                                     user.user_id)
+
+    robots = [dict(robot.payload, succeed_count=count)
+              for robot, count in zip(robots, counts)]
 
     return json_response(data={
         'total': robot_count,
@@ -411,16 +411,14 @@ def get_tasks(user):
     task_stop = task_count - start
 
     task_ids = db.Task.range_by_user_id(user.user_id, task_start, task_stop)
-    task_ids = sorted(task_ids, key=lambda x: int(x.member), reverse=True)
+    task_ids = sorted([int(x.member) for x in task_ids], reverse=True)
+
+    tasks = [task for task in db.Task.get_many(task_ids) if task]
+    counts = db.Task.succeed_counts([task.index for task in tasks],
+                                    user.user_id)
 
-    tasks = []
-    for index in task_ids:
-        task = db.Task(index.member)
-        if not task.payload:
-            continue
-        data = task.payload.copy()
-        data['succeed_count'] = task.succeed_count
-        tasks.append(data)
+    tasks = [dict(task.payload, succeed_count=count)
+             for task, count in zip(tasks, counts)]
 
     return json_response(data={
         'total': task_count,
@@ -430,142 +428,81 @@ def get_tasks(user):
     })
 
 
-@app.get("/api/<type:re:year|month|day|hour|minute>/succeed_count")
-def get_succeed_count(type, user):
-    now = datetime.now()
-    members = []
-
-    count = 80
-
-    year = now.year
-    month = now.month
-    for i in range(count):
-        if type == "year":
-            members.append("%s" % (year - i))
-            subfix = "-01-01 00:00:00"
-        elif type == "month":
-            n_month = month - i
-            n_year = year
-            if n_month <= 0:
-                n_year = n_year - 1
-                n_month = 12 + n_month
-            members.append("%s-%s" % (n_year, n_month))
-            subfix = "-01 00:00:00"
-        elif type == "day":
-            date = now - timedelta(days=i)
-            members.append("%s-%s-%s" % (date.year, date.month, date.day))
-            subfix = " 00:00:00"
-        elif type == "hour":
-            date = now - timedelta(hours=i)
-            members.append("%s-%s-%s %s" % (
-                date.year, date.month, date.day, date.hour))
-            subfix = ":00:00"
-        else:
-            date = now - timedelta(minutes=i)
-            members.append("%s-%s-%s %s:%s" % (
-                date.year, date.month, date.day, date.hour, date.minute))
-            subfix = ":00"
-
-    retval = []
-
-    for member in members:
-        retval.append([member + subfix, user.get_time_succeed_count(member)])
+def time_series_response(countable, type, count=80):
+    subfix = countable.time_subfix[type]
+    retval = [[member + subfix, succeed_count]
+              for member, succeed_count in countable.get_time_series(
+                  type, count=count)]
 
     return json_response('result', retval)
 
 
+def time_range_response(countable):
+    '''
+    ``start`` and ``end`` are unix timestamps, ``end`` defaults to now;
+    the bucket size is picked to fit ``size`` points (default 80).
+    '''
+    start = request.query.start
+    end = request.query.end
+    size = request.query.size
+    if not start:
+        return json_response(err='start is required', status=400)
+
+    try:
+        start = datetime.fromtimestamp(int(start))
+        end = datetime.fromtimestamp(int(end)) if end else None
+        size = min(int(size), 1000) if size else 80
+    except (ValueError, OverflowError, OSError):
+        return json_response(err='start, end and size must be integers',
+                             status=400)
+    if size < 1:
+        return json_response(err='size must be positive', status=400)
+
+    type, series = countable.pick_time_series(start, end, size)
+    subfix = countable.time_subfix[type]
+    retval = [[member + subfix, succeed_count]
+              for member, succeed_count in series]
+
+    return json_response(data={'type': type, 'result': retval})
+
+
+@app.get('/api/succeed_count')
+def get_range_succeed_count(user):
+    return time_range_response(user)
+
+
+@app.get('/api/robots/<robot_id:re:\d+>/succeed_count')
+def get_robot_range_succeed_count(robot_id, user):
+    return time_range_response(db.Robot(int(robot_id)))
+
+
+@app.get('/api/tasks/<task_id:re:\d+>/succeed_count')
+def get_task_range_succeed_count(task_id, user):
+    return time_range_response(db.Task(int(task_id)))
+
+
+@app.get("/api/<type:re:year|month|day|hour|minute>/succeed_count")
+def get_succeed_count(type, user):
+    return time_series_response(user, type)
+
+
 @app.get(
     '/api/robots/<robot_id:re:\d+>/'
     '<type:re:year|month|day|hour|minute>/succeed_count')
 def get_robot_succeed_count(robot_id, type, user):
-    now = datetime.now()
-    members = []
-    subfix = ""
-    robot_id = int(robot_id)
-    robot = db.Robot(robot_id)
-
-    count = 80
-
-    year = now.year
-    month = now.month
-    for i in range(count):
-        if type == "year":
-            members.append("%s" % (year - i))
-            subfix = "-01-01 00:00:00"
-        elif type == "month":
-            n_month = month - i
-            n_year = year
-            if n_month <= 0:
-                n_year = n_year - 1
-                n_month = 12 + n_month
-            members.append("%s-%s" % (n_year, n_month))
-            subfix = "-01 00:00:00"
-        elif type == "day":
-            date = now - timedelta(days=i)
-            members.append("%s-%s-%s" % (date.year, date.month, date.day))
-            subfix = " 00:00:00"
-        elif type == "hour":
-            date = now - timedelta(hours=i)
-            members.append("%s-%s-%s %s" % (
-                date.year, date.month, date.day, date.hour))
-            subfix = ":00:00"
-        else:
-            date = now - timedelta(minutes=i)
-            members.append("%s-%s-%s %s:%s" % (
-                date.year, date.month, date.day, date.hour, date.minute))
-            subfix = ":00"
-
-    retval = []
-
-    for member in members:
-        retval.append([member + subfix, robot.get_time_succeed_count(member)])
-
-    return json_response('result', retval)
+    robot = db.Robot(int(robot_id))
+    return time_series_response(robot, type)
 
 
 @app.get(
     '/api/tasks/<task_id:re:\d+>/'
     '<type:re:year|month|day|hour|minute>/succeed_count')
 def get_task_succeed_count(task_id, type, user):
-    now = datetime.now()
-    members = []
-    subfix = ""
-    task_id = int(task_id)
-    task = db.Task(task_id)
+    task = db.Task(int(task_id))
+    return time_series_response(task, type)
 
-    count = 80
-    year = now.year
-    month = now.month
-    for i in range(count):
-        if type == "year":
-            members.append("%s" % (year - i))
-            subfix = "-01-01 00:00:00"
-        elif type == "month":
-            n_month = month - i
-            n_year = year
-            if n_month <= 0:
-                n_year = n_year - 1
-                n_month = 12 + n_month
-            members.append("%s-%s" % (n_year, n_month))
-            subfix = "-01 00:00:00"
-        elif type == "day":
-            date = now - timedelta(days=i)
-            members.append("%s-%s-%s" % (date.year, date.month, date.day))
-            subfix = " 00:00:00"
-        elif type == "hour":
-            date = now - timedelta(hours=i)
-            members.append("%s-%s-%s %s" % (
-                date.year, date.month, date.day, date.hour))
-            subfix = ":00:00"
-        else:
-            date = now - timedelta(minutes=i)
-            members.append("%s-%s-%s %s:%s" % (
-                date.year, date.month, date.day, date.hour, date.minute))
-            subfix = ":00"
-
-    retval = []
-
-    for member in members:
-        retval.append([member + subfix, task.get_time_succeed_count(member)])
 
-    return json_response('result', retval)
+@app.get('/api/metrics')
+def get_metrics(user):
+    response.set_header('content-type', 'text/plain; version=0.0.4')
+    return metrics.registry.render(metrics.collect(db.db))
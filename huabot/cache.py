@@ -0,0 +1,94 @@
+'''
+In-process cache of object payloads for the tables marked ``cacheable``.
+
+Every write of a cacheable row publishes its key on the invalidation
+channel, on whichever node it happens; each process caching rows listens
+there from a background thread and drops the keys it hears about. While
+the subscription is down nothing is cached, and everything is dropped
+when it comes back, since messages may have been missed meanwhile. The
+ttl bounds how stale a row can get should anything else go wrong.
+'''
+import os
+import threading
+from time import time, sleep
+from collections import OrderedDict
+from .utils import logger, to_str
+
+
+class ObjectCache(object):
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.ready = False
+        self.version = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if not item:
+                return None
+            data, expires_at = item
+            if expires_at < time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return data
+
+    def set(self, key, data, version):
+        '''
+        Cache ``data`` read while the cache was at ``version``: when
+        anything got invalidated since, it may be stale already.
+        '''
+        with self._lock:
+            if not self.ready or version != self.version:
+                return
+            self._data[key] = (data, time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.version += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._data.clear()
+
+    def listen(self, redis, channel):
+        '''
+        Start the invalidation thread, once per process: a forked child
+        does not inherit the parent's thread.
+        '''
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.ready = False
+        self.clear()
+        thread = threading.Thread(target=self._listen, args=(redis, channel))
+        thread.daemon = True
+        thread.start()
+
+    def _listen(self, redis, channel):
+        while True:
+            try:
+                pubsub = redis.pubsub()
+                pubsub.subscribe(channel)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        self.clear()
+                        self.ready = True
+                    elif message['type'] == 'message':
+                        self.invalidate(to_str(message['data']))
+            except Exception as e:
+                logger.warning('object cache subscription lost: %s', e)
+
+            self.ready = False
+            self.clear()
+            sleep(1)
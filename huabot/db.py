@@ -1,21 +1,50 @@
-from .utils import to_int, to_str, REDIS_PORT, REDIS_HOST, DB_PREFIX, hash_url
-import redis
+from .utils import to_int, to_str, DB_PREFIX, DB_BACKEND
+from .utils import fingerprint, SET_SENTINEL
+from .utils import logger, SUCCEED_COUNT_RETENTION
+from .utils import OBJECT_CACHE_SIZE, OBJECT_CACHE_TTL, HASH_ROWS
+from .cache import ObjectCache
+from .metrics import registry, timed
+from .storage import Script, get_storage
+from .dedup import get_dedup
+from .codec import get_codec
 from time import time
 from collections import defaultdict
 import json
 from grapy.core import Request
-from datetime import datetime
+from datetime import datetime, timedelta
+from redis.exceptions import ResponseError
 
 
 class DB(object):
+    # tables whose rows may be cached, filled by init_table
+    cache_tables = set()
+    # tables whose rows are hashes, filled by init_table from HASH_ROWS
+    hash_tables = set()
 
-    def __init__(self, prefix=DB_PREFIX):
-        self._db = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT)
+    def __init__(self, prefix=DB_PREFIX, backend=DB_BACKEND,
+                 cache_size=OBJECT_CACHE_SIZE, cache_ttl=OBJECT_CACHE_TTL):
         self._prefix = prefix
+        self._backend = backend
+        self._client = None
+        self.cache = None
+        # the other backends live in the process, there is no round trip
+        # to save and no channel to hear about the other writers
+        if cache_size > 0 and backend == 'redis':
+            self.cache = ObjectCache(cache_size, cache_ttl)
 
-    def get_object(self, key):
-        key = self._prefix + ":" + key
-        data = self._db.get(key)
+    @property
+    def _db(self):
+        if self._client is None:
+            self._client = get_storage(self._backend)
+        return self._client
+
+    def object_key(self, key):
+        return self._prefix + ":" + key
+
+    def index_key(self, name):
+        return ":".join([self._prefix, 'index', name])
+
+    def load_object(self, data):
         ret = defaultdict(str)
         if data:
             data = json.loads(to_str(data))
@@ -23,13 +52,276 @@ class DB(object):
 
         return ret
 
+    def dump_object(self, obj):
+        return json.dumps(obj.copy())
+
+    def load_fields(self, data):
+        ret = defaultdict(str)
+        for field, value in data.items():
+            ret[to_str(field)] = json.loads(to_str(value))
+
+        return ret
+
+    def dump_fields(self, obj):
+        return dict((field, json.dumps(value)) for field, value in obj.items())
+
+    def is_hash(self, key):
+        parts = key.split(':')
+        return len(parts) == 2 and parts[0] in self.hash_tables
+
+    def read_row(self, pipe, key):
+        '''
+        Read row ``key`` with GET, or HGETALL when it is a hash, on
+        ``pipe``; with the client itself the reply is returned, load it
+        with ``load_row``.
+        '''
+        if self.is_hash(key):
+            return pipe.hgetall(self.object_key(key))
+        return pipe.get(self.object_key(key))
+
+    def load_row(self, key, data):
+        # by the reply, a row may still be in the layout HASH_ROWS left
+        if isinstance(data, dict):
+            return self.load_fields(data)
+        return self.load_object(data)
+
+    @staticmethod
+    def _wrongtype(reply):
+        return isinstance(reply, ResponseError) and \
+            str(reply).startswith('WRONGTYPE')
+
+    def _read_again(self, keys, data, again):
+        '''
+        Read the rows ``again``, indexes into ``keys`` and their replies
+        ``data``, in the other layout: until ``python -m huabot.migrate
+        rows`` is done after HASH_ROWS changed, both are around.
+        '''
+        if again:
+            pipe = self.pipeline(False)
+            for i in again:
+                if self.is_hash(keys[i]):
+                    pipe.get(self.object_key(keys[i]))
+                else:
+                    pipe.hgetall(self.object_key(keys[i]))
+            for i, reply in zip(again, pipe.execute()):
+                data[i] = reply
+        for reply in data:
+            if isinstance(reply, Exception):
+                raise reply
+        return data
+
+    def check_row(self, key, reply):
+        '''
+        ``reply`` to a ``read_row`` of ``key``, read again in the other
+        layout when it is a WRONGTYPE error.
+        '''
+        again = [0] if self._wrongtype(reply) else []
+        return self._read_again([key], [reply], again)[0]
+
+    def write_row(self, pipe, key, obj):
+        '''
+        Queue the write of the whole row ``key`` on ``pipe``; a hash is
+        replaced, so no column dropped from ``obj`` is left behind.
+        '''
+        if self.is_hash(key):
+            pipe.delete(self.object_key(key))
+            pipe.hmset(self.object_key(key), self.dump_fields(obj))
+        else:
+            pipe.set(self.object_key(key), self.dump_object(obj))
+
+    def pipeline(self, transaction=True):
+        return self._db.pipeline(transaction)
+
+    def register_script(self, script, fallback=None):
+        '''
+        Register a lua script. The returned callable runs it with EVALSHA
+        and loads it on the first NOSCRIPT reply. Keys must already be
+        prefixed with ``object_key``. ``fallback(client, keys, args)`` is
+        the same in python, for the storage backends without lua.
+        '''
+        return Script(self, script, fallback)
+
+    def cache_channel(self):
+        return self.object_key('cache:invalidate')
+
+    def is_cacheable(self, key):
+        parts = key.split(':')
+        return len(parts) == 2 and parts[0] in self.cache_tables
+
+    def publish_change(self, pipe, key):
+        '''
+        Queue the invalidation of the cacheable row ``key`` on ``pipe``,
+        next to the write itself.
+        '''
+        pipe.publish(self.cache_channel(), key)
+        if self.cache:
+            self.cache.invalidate(key)
+
+    def _use_cache(self, key):
+        if not self.cache or not self.is_cacheable(key):
+            return False
+        self.cache.listen(self._db, self.cache_channel())
+        return True
+
+    def _read_row(self, key):
+        try:
+            return self.read_row(self._db, key)
+        except ResponseError as e:
+            return self.check_row(key, e)
+
+    def get_object(self, key):
+        if not self._use_cache(key):
+            return self.load_row(key, self._read_row(key))
+
+        data = self.cache.get(key)
+        if data is None:
+            version = self.cache.version
+            data = self._read_row(key)
+            if data:
+                self.cache.set(key, data, version)
+        return self.load_row(key, data)
+
+    def get_fields(self, key, names):
+        '''
+        Fields ``names`` of the hash row ``key`` with one HMGET, or from
+        the cached row; missing ones are ``''`` like in a payload.
+        '''
+        if self._use_cache(key):
+            payload = self.get_object(key)
+            return [payload[name] for name in names]
+
+        try:
+            data = self._db.hmget(self.object_key(key), names)
+        except ResponseError as e:
+            if not self._wrongtype(e):
+                raise
+            # not migrated yet, a json row
+            payload = self.get_object(key)
+            return [payload[name] for name in names]
+        return ['' if value is None else json.loads(to_str(value))
+                for value in data]
+
+    def get_objects(self, keys):
+        if not keys:
+            return []
+        data = [None] * len(keys)
+        cached = [self._use_cache(key) for key in keys]
+        for i, key in enumerate(keys):
+            if cached[i]:
+                data[i] = self.cache.get(key)
+
+        missing = [i for i, d in enumerate(data) if d is None]
+        if missing:
+            version = self.cache.version if self.cache else 0
+            rets = self._read_rows([keys[i] for i in missing])
+            for i, d in zip(missing, rets):
+                data[i] = d
+                if cached[i] and d:
+                    self.cache.set(keys[i], d, version)
+        return [self.load_row(key, d) for key, d in zip(keys, data)]
+
+    def _read_rows(self, keys):
+        # one round trip either way: a MGET, or the HGETALLs pipelined
+        if not any(self.is_hash(key) for key in keys):
+            data = self._db.mget([self.object_key(key) for key in keys])
+            # MGET has no WRONGTYPE, a row still in a hash reads as None
+            again = [i for i, reply in enumerate(data) if reply is None]
+        else:
+            pipe = self.pipeline(False)
+            for key in keys:
+                self.read_row(pipe, key)
+            data = pipe.execute(False)
+            again = [i for i, reply in enumerate(data)
+                     if self._wrongtype(reply)]
+        return self._read_again(keys, data, again)
+
     def set_object(self, key, obj):
-        key = self._prefix + ":" + key
-        self._db.set(key, json.dumps(obj.copy()))
+        if not self.is_cacheable(key) and not self.is_hash(key):
+            self._db.set(self.object_key(key), self.dump_object(obj))
+            return
+        pipe = self.pipeline()
+        self.write_row(pipe, key, obj)
+        if self.is_cacheable(key):
+            self.publish_change(pipe, key)
+        pipe.execute()
+
+    def update_object(self, key, fields):
+        '''
+        HSET only ``fields`` of the hash row ``key``, unless it was
+        deleted: 1 when written, 0 without a row and -1 when it is still
+        a json string, see ``_update_row``.
+        '''
+        channel = ''
+        if self.is_cacheable(key):
+            channel = self.cache_channel()
+        args = [channel, key]
+        for field, value in self.dump_fields(fields).items():
+            args += [field, value]
+        ret = to_int(_update_row(keys=[self.object_key(key)], args=args))
+        if channel and self.cache:
+            self.cache.invalidate(key)
+        return ret
+
+    def save_row(self, key, obj, zsets, exists=False):
+        '''
+        Write the whole row ``key`` and apply ``zsets``, ``(name, score,
+        member)`` of its indexes with ``score`` None for a ZREM, in one
+        go; when ``exists`` only if the row is still there, see
+        ``_write_row``. False when nothing was written.
+        '''
+        channel = ''
+        if self.is_cacheable(key):
+            channel = self.cache_channel()
+        if self.is_hash(key):
+            layout = 'hash'
+            values = []
+            for field, value in self.dump_fields(obj).items():
+                values += [field, value]
+        else:
+            layout = 'string'
+            values = [self.dump_object(obj)]
+        args = ['1' if exists else '', channel, key, layout, len(values)]
+        args += values
+        keys = [self.object_key(key)]
+        for name, score, member in zsets:
+            keys.append(self.index_key(name))
+            args += ['' if score is None else score, member]
+        ret = to_int(_write_row(keys=keys, args=args))
+        if channel and self.cache:
+            self.cache.invalidate(key)
+        return ret > 0
 
     def del_object(self, key):
-        key = self._prefix + ":" + key
-        self._db.delete(key)
+        if not self.is_cacheable(key):
+            self._db.delete(self.object_key(key))
+            return
+        pipe = self.pipeline()
+        pipe.delete(self.object_key(key))
+        self.publish_change(pipe, key)
+        pipe.execute()
+
+    def scan_objects(self, pattern, count=500):
+        '''
+        Iterate the keys matching ``pattern`` with an incremental SCAN,
+        without the prefix.
+        '''
+        skip = len(self._prefix) + 1
+        for key in self._db.scan_iter(self.object_key(pattern), count):
+            yield to_str(key)[skip:]
+
+    def drop_objects(self, pattern, count=500):
+        '''
+        Delete every key matching ``pattern`` with an incremental SCAN,
+        ``count`` keys per round trip.
+        '''
+        keys = []
+        for key in self.scan_objects(pattern, count):
+            keys.append(self.object_key(key))
+            if len(keys) >= count:
+                self._db.delete(*keys)
+                keys = []
+        if keys:
+            self._db.delete(*keys)
 
     def next_sequence(self, name):
         key = self._prefix + ":sequence:" + name
@@ -37,13 +329,11 @@ class DB(object):
         return to_int(ret)
 
     def add_index(self, name, member, score=1):
-        key = ":".join([self._prefix, 'index', name])
-        self._db.zadd(key, score, member)
+        self._db.zadd(self.index_key(name), score, member)
 
     def get_index(self, name, member):
-        key = ":".join([self._prefix, 'index', name])
         try:
-            ret = self._db.zscore(key, member)
+            ret = self._db.zscore(self.index_key(name), member)
             ret = to_int(ret)
         except:
             ret = 0
@@ -51,52 +341,160 @@ class DB(object):
         return ret
 
     def range_index(self, name, start=0, stop=-1, reverse=False):
-        key = ":".join([self._prefix, 'index', name])
+        key = self.index_key(name)
         try:
             if reverse:
-                data = self._db.zrevrange(key, start, stop)
+                data = self._db.zrevrange(key, start, stop, withscores=True)
             else:
-                data = self._db.zrange(key, start, stop)
+                data = self._db.zrange(key, start, stop, withscores=True)
         except:
             return []
 
-        return [(to_str(index), self._db.zscore(key, to_str(index)))
-                for index in data]
+        return [(to_str(index), score) for index, score in data]
+
+    def range_index_by_score(self, name, min='-inf', max='+inf', start=None,
+                             num=None, reverse=False):
+        key = self.index_key(name)
+        if num is not None and start is None:
+            start = 0
+        elif start is not None and num is None:
+            # LIMIT with a negative count: everything from start on
+            num = -1
+        try:
+            if reverse:
+                data = self._db.zrevrangebyscore(key, max, min, start, num,
+                                                 withscores=True)
+            else:
+                data = self._db.zrangebyscore(key, min, max, start, num,
+                                              withscores=True)
+        except:
+            return []
+
+        return [(to_str(index), score) for index, score in data]
 
     def count_index(self, name):
-        key = ":".join([self._prefix, 'index', name])
-        count = self._db.zcard(key)
+        count = self._db.zcard(self.index_key(name))
         return int(count)
 
     def drop_index(self, name):
-        key = ":".join([self._prefix, 'index', name])
-        self._db.delete(key)
+        self._db.delete(self.index_key(name))
 
     def delete_index(self, name, member):
-        key = ":".join([self._prefix, 'index', name])
-        self._db.zrem(key, member)
+        self._db.zrem(self.index_key(name), member)
 
-    def execute(self, cmd, key, *args):
-        key = self._prefix + ":" + key
+    def execute(self, cmd, key, *args, **kwargs):
+        key = self.object_key(key)
         func = getattr(self._db, cmd.lower())
         if func:
             try:
-                return func(key, *args)
-            except:
-                pass
+                return func(key, *args, **kwargs)
+            except Exception as e:
+                registry.incr('huabot_db_execute_errors_total',
+                              {'command': cmd.lower()})
+                logger.debug('db.execute %s %s: %s', cmd, key, e)
         if cmd.lower().find("range") > -1:
             return []
         return None
 
 db = DB()
+dedup = get_dedup(db)
+link_codec = get_codec()
+
+
+
+def _update_row_py(client, keys, args):
+    kind = to_str(client.type(keys[0]))
+    if kind != 'hash':
+        return -1 if kind == 'string' else 0
+    client.hmset(keys[0], dict(zip(args[2::2], args[3::2])))
+    if args[0]:
+        client.publish(args[0], args[1])
+    return 1
+
+
+# KEYS[1] is a hash row; ARGV[1] the cache channel or '', ARGV[2] the row
+# key published on it and ARGV[3..] field/value pairs. Sets the fields of
+# a row that still exists; a json row is left to Table.save.
+_update_row = db.register_script('''
+local kind = redis.call('TYPE', KEYS[1]).ok
+if kind ~= 'hash' then
+    if kind == 'string' then
+        return -1
+    end
+    return 0
+end
+redis.call('HMSET', KEYS[1], unpack(ARGV, 3))
+if ARGV[1] ~= '' then
+    redis.call('PUBLISH', ARGV[1], ARGV[2])
+end
+return 1
+''', _update_row_py)
+
+
+
+def _write_row_py(client, keys, args):
+    if args[0] and not client.exists(keys[0]):
+        return 0
+    count = int(args[4])
+    values = args[5:5 + count]
+    if args[3] == 'hash':
+        client.delete(keys[0])
+        client.hmset(keys[0], dict(zip(values[::2], values[1::2])))
+    else:
+        client.set(keys[0], values[0])
+    if args[1]:
+        client.publish(args[1], args[2])
+    zsets = args[5 + count:]
+    for key, score, member in zip(keys[1:], zsets[::2], zsets[1::2]):
+        if score == '':
+            client.zrem(key, member)
+        else:
+            client.zadd(key, score, member)
+    return 1
+
+
+# KEYS[1] is a row and KEYS[2..] the index zsets of Table.save. ARGV[1] is
+# '1' when the row must still exist, ARGV[2] the cache channel or '',
+# ARGV[3] the row key published on it, ARGV[4] the layout, 'hash' or
+# 'string', and ARGV[5] the count of values that follow: field/value
+# pairs or the json. Then a score and member for each index zset, an
+# empty score for a ZREM. Returns 0, writing nothing, when the row is gone.
+_write_row = db.register_script('''
+if ARGV[1] ~= '' and redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local count = tonumber(ARGV[5])
+if ARGV[4] == 'hash' then
+    redis.call('DEL', KEYS[1])
+    redis.call('HMSET', KEYS[1], unpack(ARGV, 6, 5 + count))
+else
+    redis.call('SET', KEYS[1], ARGV[6])
+end
+if ARGV[2] ~= '' then
+    redis.call('PUBLISH', ARGV[2], ARGV[3])
+end
+local i = 6 + count
+for k = 2, #KEYS do
+    if ARGV[i] == '' then
+        redis.call('ZREM', KEYS[k], ARGV[i + 1])
+    else
+        redis.call('ZADD', KEYS[k], ARGV[i], ARGV[i + 1])
+    end
+    i = i + 2
+end
+return 1
+''', _write_row_py)
 
 get_object = db.get_object
+get_fields = db.get_fields
 set_object = db.set_object
+update_object = db.update_object
 del_object = db.del_object
 next_sequence = db.next_sequence
 add_index = db.add_index
 get_index = db.get_index
 range_index = db.range_index
+range_index_by_score = db.range_index_by_score
 count_index = db.count_index
 drop_index = db.drop_index
 delete_index = db.delete_index
@@ -150,6 +548,12 @@ class Index(object):
         ret = db.range_index(name, start, stop, reverse)
         return [Index(name, idx[0], idx[1]) for idx in ret]
 
+    @classmethod
+    def range_by_score(self, name, min='-inf', max='+inf', start=None,
+                       num=None, reverse=False):
+        ret = db.range_index_by_score(name, min, max, start, num, reverse)
+        return [Index(name, idx[0], idx[1]) for idx in ret]
+
     @classmethod
     def drop(self, name):
         db.drop_index(name)
@@ -163,6 +567,10 @@ class Table(object):
     table_name = "table"
     unique_columns = []
     index_columns = []
+    # keep rows in the process object cache, see huabot.cache
+    cacheable = False
+    # the rows may be stored as hashes, see HASH_ROWS
+    hash_rows = True
 
     def __init__(self, index=None, payload=None):
         self._index = index
@@ -195,92 +603,155 @@ class Table(object):
     def payload(self, payload):
         self._payload = payload
 
+    def _unique_index(self, columns, payload):
+        columns = columns.split(" ")
+        members = [to_str(payload[column]) for column in columns]
+        return ":".join([self.table_name] + columns), ':'.join(members)
+
+    def _column_index(self, columns, payload):
+        keys = [self.table_name]
+        for column in columns.split(" "):
+            keys.append(column)
+            keys.append(to_str(payload[column]))
+        return ":".join(keys)
+
+    def _is_changed(self, columns, old):
+        for column in columns.split(" "):
+            if old[column] != self._payload[column]:
+                return True
+        return False
+
+    @timed('table_save', lambda self: {'table': self.table_name})
     def save(self):
+        '''
+        Write the row and its indexes. A saved row is only written while
+        it still exists: False, writing nothing, when it was deleted.
+        '''
         if not self._payload:
             raise ValueError("Table: {} value is None".format(self.table_name))
 
-        if not self.index:
-            for columns in self.unique_columns:
+        uniques = [self._unique_index(columns, self._payload)
+                   for columns in self.unique_columns]
+
+        # read phase: every unique check and the old row in one round trip
+        pipe = db.pipeline(False)
+        for name, member in uniques:
+            pipe.zscore(db.index_key(name), member)
+        if self.index:
+            db.read_row(pipe, self.key())
+        rets = pipe.execute(False)
+
+        for columns, score in zip(self.unique_columns, rets):
+            score = to_int(score) if score else 0
+            if score > 0 and (not self.index or score != self.index):
                 columns = columns.split(" ")
-                members = [to_str(self._payload[column]) for column in columns]
-                index = Index.get(":".join([self.table_name] + columns),
-                                  ':'.join(members))
-                if index.score > 0:
-                    raise ValueError(
-                        "Table: {} duplicate columns: {} value: {}".format(
-                            self.table_name, columns, members))
-            self.index = db.next_sequence(self.table_name)
+                members = [to_str(self._payload[column])
+                           for column in columns]
+                raise ValueError(
+                    "Table: {} duplicate columns: {} value: {}".format(
+                        self.table_name, columns, members))
+
+        old = None
+        if self.index:
+            old = db.load_row(self.key(), db.check_row(self.key(), rets[-1]))
+            if not old:
+                return False
         else:
-            for columns in self.unique_columns:
-                columns = columns.split(" ")
-                members = [to_str(self._payload[column]) for column in columns]
-                index = Index.get(":".join([self.table_name] + columns),
-                                  ':'.join(members))
-                if index.score > 0 and index.score != self.index:
-                    raise ValueError(
-                        "Table: {} duplicate columns: {} value: {}".format(
-                            self.table_name, columns, members))
-
-            old = db.get_object(self.key())
-            for columns in self.unique_columns:
-                columns = columns.split(" ")
-                is_df = False
-                for column in columns:
-                    if old[column] != self._payload[column]:
-                        is_df = True
+            self.index = db.next_sequence(self.table_name)
 
-                if is_df:
-                    members = [to_str(old[column]) for column in columns]
-                    Index.get(":".join([self.table_name] + columns),
-                              ':'.join(members)).delete()
+        member = to_str(self.index)
+
+        # write phase: index maintenance and the row itself in one script
+        zsets = []
+        if old is not None:
+            for columns in self.unique_columns:
+                if self._is_changed(columns, old):
+                    name, old_member = self._unique_index(columns, old)
+                    zsets.append((name, None, old_member))
 
             for columns in self.index_columns:
-                columns = columns.split(" ")
-                is_df = False
-                for column in columns:
-                    if old[column] != self._payload[column]:
-                        is_df = True
-                if is_df:
-                    members = [to_str(old[column]) for column in columns]
-                    keys = [self.table_name]
-                    for c, m in zip(columns, members):
-                        keys.append(c)
-                        keys.append(m)
-
-                    idx = Index(":".join(keys))
-                    idx.member = to_str(self.index)
-                    idx.delete()
-
-        db.set_object(self.key(), self._payload)
-        idx = Index(self.table_name)
-        idx.member = to_str(self.index)
-        idx.score = self.index
-        idx.save()
+                if self._is_changed(columns, old):
+                    name = self._column_index(columns, old)
+                    zsets.append((name, None, member))
+
+        zsets.append((self.table_name, self.index, member))
 
-        for columns in self.unique_columns:
-            columns = columns.split(" ")
-            members = [to_str(self._payload[column]) for column in columns]
-            idx = Index(":".join([self.table_name] + columns))
-            idx.member = ':'.join(members)
-            idx.score = self.index
-            idx.save()
+        for name, unique_member in uniques:
+            zsets.append((name, self.index, unique_member))
 
         for columns in self.index_columns:
-            columns = columns.split(" ")
-            members = [to_str(self._payload[column]) for column in columns]
-            keys = [self.table_name]
-            for c, m in zip(columns, members):
-                keys.append(c)
-                keys.append(m)
-            idx = Index(":".join(keys))
-            idx.member = to_str(self.index)
-            idx.score = self.index
-            idx.save()
+            name = self._column_index(columns, self._payload)
+            zsets.append((name, self.index, member))
+
+        return db.save_row(self.key(), self._payload, zsets,
+                           exists=old is not None)
+
+    def _indexed_columns(self):
+        return set(" ".join(self.unique_columns + self.index_columns).split())
+
+    def _changed(self, fields):
+        # without a loaded payload there is nothing to compare with
+        if not self._payload:
+            return fields
+        return dict((key, value) for key, value in fields.items()
+                    if self._payload.get(key, '') != value)
+
+    def update(self, **fields):
+        '''
+        Set ``fields`` of a saved row and write only those that changed:
+        one HSET of a hash row, see HASH_ROWS. A json row, or a change to
+        a unique or index column, goes through ``save``. Returns False,
+        writing nothing, when the row is gone.
+        '''
+        if not self.index:
+            raise ValueError("Table: {} update of an unsaved row".format(
+                self.table_name))
+
+        if db.is_hash(self.key()) and \
+                not self._indexed_columns() & set(fields):
+            fields = self._changed(fields)
+            if not fields:
+                return True
+            ret = db.update_object(self.key(), fields)
+            if ret >= 0:
+                if ret and self._payload:
+                    self._payload.update(fields)
+                return ret > 0
+
+        payload = self.payload
+        if not payload:
+            return False
+        fields = self._changed(fields)
+        if not fields:
+            return True
+        payload.update(fields)
+        return self.save()
+
+    def get_fields(self, *names):
+        '''
+        Columns ``names`` of the row, in order. Reads only those fields
+        of a hash row not loaded yet, a json row is loaded whole.
+        '''
+        if self._payload or not db.is_hash(self.key()):
+            return [self.payload[name] for name in names]
+        return db.get_fields(self.key(), names)
 
     @classmethod
     def get(self, index):
         return self(index)
 
+    @classmethod
+    def get_many(self, indexes):
+        '''
+        Load many rows with a single MGET. Missing rows come back as None
+        so the result lines up with ``indexes``.
+        '''
+        indexes = list(indexes)
+        payloads = db.get_objects([":".join([self.table_name, to_str(index)])
+                                   for index in indexes])
+        return [self(index, payload) if payload else None
+                for index, payload in zip(indexes, payloads)]
+
     @classmethod
     def get_by_uniq(self, column, member=None):
         key = ":".join([self.table_name, column])
@@ -302,6 +773,12 @@ class Table(object):
                            start, stop, reverse)
         return idxs
 
+    @classmethod
+    def range_by_score(self, column, min='-inf', max='+inf', start=None,
+                       num=None, reverse=False):
+        return Index.range_by_score(":".join([self.table_name, column]),
+                                    min, max, start, num, reverse)
+
     @classmethod
     def range_by_index(self, column, value=None, start=0, stop=-1,
                        reverse=False):
@@ -328,6 +805,19 @@ class Table(object):
         else:
             return _range_by_index
 
+    @classmethod
+    def counts_by_index(self, column, values):
+        '''
+        ``count_by_index`` for many values in one round trip.
+        '''
+        if not values:
+            return []
+        pipe = db.pipeline(False)
+        for value in values:
+            pipe.zcard(db.index_key(":".join([self.table_name, column,
+                                              to_str(value)])))
+        return [int(count) for count in pipe.execute()]
+
     def __getattr__(self, key):
         if not self._payload:
             self._payload = db.get_object(self.key())
@@ -361,6 +851,16 @@ class Table(object):
 
 
 def init_table(table):
+    if table.cacheable:
+        DB.cache_tables.add(table.table_name)
+
+    if table.table_name in HASH_ROWS:
+        if table.hash_rows:
+            DB.hash_tables.add(table.table_name)
+        else:
+            logger.warning('HASH_ROWS: %s rows stay json strings',
+                           table.table_name)
+
     for column in table.unique_columns:
         setattr(table, "get_by_" + column, table.get_by_uniq(column, False))
 
@@ -373,9 +873,50 @@ def init_table(table):
             table, "count_by_" + column, table.count_by_index(column, False))
 
 
+def _incr_succeed_count_py(client, keys, args):
+    zsets, ttl = int(args[0]), int(args[1])
+    for i, key in enumerate(keys):
+        if i < zsets:
+            client.zincrby(key, args[i + 2], 1)
+        else:
+            client.hincrby(key, args[i + 2], 1)
+            if ttl > 0:
+                client.expire(key, ttl)
+    return len(keys)
+
+
+# KEYS holds ARGV[1] sorted sets followed by minute hashes; ARGV[2] is
+# the ttl of the minute hashes and ARGV[3..] one member/field per key.
+_incr_succeed_count = db.register_script('''
+local zsets = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[2])
+for i, key in ipairs(KEYS) do
+    if i <= zsets then
+        redis.call('ZINCRBY', key, 1, ARGV[i + 2])
+    else
+        redis.call('HINCRBY', key, ARGV[i + 2], 1)
+        if ttl > 0 then
+            redis.call('EXPIRE', key, ttl)
+        end
+    end
+end
+return #KEYS
+''', _incr_succeed_count_py)
+
+
 class Countable(object):
 
     dtypes = ['year', 'month', 'day', 'hour', 'minute']
+    # what completes a bucket member into a full timestamp
+    time_subfix = {
+        'year': '-01-01 00:00:00',
+        'month': '-01 00:00:00',
+        'day': ' 00:00:00',
+        'hour': ':00:00',
+        'minute': ':00',
+    }
+    # seconds to keep each fine grained bucket, see compact_succeed_count
+    retention = SUCCEED_COUNT_RETENTION
 
     @classmethod
     def p_key(self):
@@ -386,13 +927,11 @@ class Countable(object):
         return ":".join([self.table_name, "user_id", to_str(user_id),
                          "succeed_count"])
 
-    def incr_succeed_count(self):
-        self._incr(self.p_key(), to_str(self.index))
-        if self.table_name != 'user':
-            self._incr(self.pu_key(self.payload['user_id']),
-                       to_str(self.index))
-        now = datetime.now()
-        members = [
+    @staticmethod
+    def time_members(now=None):
+        if now is None:
+            now = datetime.now()
+        return [
             "%s" % now.year,
             "%s:%s" % (now.year, now.month),
             "%s:%s:%s" % (now.year, now.month, now.day),
@@ -401,10 +940,100 @@ class Countable(object):
                 now.year, now.month, now.day, now.hour, now.minute)
         ]
 
+    def time_key(self, dtype):
+        return ':'.join([self.table_name, to_str(self.index), dtype,
+                         'succeed_count'])
+
+    def minute_key(self, day):
+        '''
+        The per day hash holding minute buckets, ``day`` is ``Y:M:D``.
+        Fields are minute offsets into the day.
+        '''
+        return ':'.join([self.time_key('minute'), day])
+
+    @staticmethod
+    def minute_field(member):
+        '''
+        Split a ``Y:M:D:h:m`` member into its day and minute offset.
+        '''
+        parts = member.split(':')
+        offset = int(parts[3]) * 60 + int(parts[4])
+        return ':'.join(parts[:3]), to_str(offset)
+
+    def succeed_count_members(self, members):
+        '''
+        The buckets a success increments, given the members from
+        ``time_members``: (key, member) pairs for the sorted sets and
+        (key, field) pairs for the minute hash.
+        '''
+        pairs = [(self.p_key(), to_str(self.index))]
+        if self.table_name != 'user':
+            pairs.append((self.pu_key(self.payload['user_id']),
+                          to_str(self.index)))
+
         for dtype, member in zip(self.dtypes, members):
-            key = ':'.join([self.table_name, to_str(self.index), dtype,
-                            'succeed_count'])
-            self._incr(key, member)
+            if dtype != 'minute':
+                pairs.append((self.time_key(dtype), member))
+
+        day, field = self.minute_field(members[-1])
+        return pairs, [(self.minute_key(day), field)]
+
+    @classmethod
+    def minute_ttl(self):
+        '''
+        Minute hashes expire a day after the retention of their last
+        minute, so they need no compaction.
+        '''
+        seconds = self.retention.get('minute')
+        if not seconds:
+            return 0
+        return seconds + 86400
+
+    def minute_days(self, now=None):
+        '''
+        The ``Y:M:D`` of every day whose minute hash may not have expired
+        yet, or None when they are kept forever and any day may be left.
+        '''
+        ttl = self.minute_ttl()
+        if not ttl:
+            return None
+        if now is None:
+            now = datetime.now()
+        # a hash lives ttl seconds past the last minute of its day
+        first = now - timedelta(seconds=ttl + 86400)
+        days = (now.date() - first.date()).days
+        return [self.time_members(now - timedelta(days=i))[2]
+                for i in range(days + 1)]
+
+    @staticmethod
+    def incr_succeed_count_args(objs):
+        members = Countable.time_members()
+        zsets = []
+        hashes = []
+        for obj in objs:
+            pairs, fields = obj.succeed_count_members(members)
+            zsets.extend(pairs)
+            hashes.extend(fields)
+
+        keys = [db.object_key(key) for key, _ in zsets + hashes]
+        args = [len(zsets), objs[0].minute_ttl() if objs else 0]
+        args.extend(member for _, member in zsets + hashes)
+        return keys, args
+
+    @staticmethod
+    def incr_succeed_counts(*objs):
+        '''
+        Increment every succeed_count bucket of ``objs`` with a single
+        EVALSHA. Bucket members are computed once for all of them.
+        '''
+        keys, args = Countable.incr_succeed_count_args(objs)
+        try:
+            _incr_succeed_count(keys=keys, args=args)
+        except Exception as e:
+            logger.exception(e)
+
+    def incr_succeed_count(self):
+        self.incr_succeed_counts(self)
 
     def init_succeed_count(self):
         db.execute("zadd", self.p_key(), 0, to_str(self.index))
@@ -412,14 +1041,6 @@ class Countable(object):
             db.execute("zadd", self.pu_key(self.payload['user_id']), 0,
                        to_str(self.index))
 
-    def _incr(self, key, member):
-        try:
-            ret = db.execute("zincrby", key, member, 1)
-        except:
-            ret = db.execute("zadd", key, 1, member)
-
-        return to_int(ret)
-
     @property
     def succeed_count(self):
         try:
@@ -437,50 +1058,437 @@ class Countable(object):
 
         return ret
 
+    @classmethod
+    def succeed_counts(self, indexes, user_id=None):
+        '''
+        Batched ``succeed_count`` for many rows: one pipelined round trip,
+        plus one more when rows still only have a per-user counter and
+        ``user_id`` is given to backfill them.
+        '''
+        members = [to_str(index) for index in indexes]
+        if not members:
+            return []
+
+        key = db.object_key(self.p_key())
+        pipe = db.pipeline(False)
+        for member in members:
+            pipe.zscore(key, member)
+        rets = pipe.execute()
+
+        missing = [i for i, ret in enumerate(rets) if not ret]
+        if missing and user_id and self.table_name != 'user':
+            pu_key = db.object_key(self.pu_key(user_id))
+            pipe = db.pipeline(False)
+            for i in missing:
+                pipe.zscore(pu_key, members[i])
+            for i, ret in zip(missing, pipe.execute()):
+                rets[i] = ret
+
+            backfill = [i for i in missing if rets[i]]
+            if backfill:
+                pipe = db.pipeline(False)
+                for i in backfill:
+                    pipe.zadd(key, to_int(rets[i]), members[i])
+                pipe.execute()
+
+        return [to_int(ret) if ret else 0 for ret in rets]
+
     def get_time_succeed_count(self, member):
         member = member.replace('-', ':').replace(' ', ':')
         dtype = self.dtypes[member.count(':')]
-        key = ':'.join([self.table_name, to_str(self.index), dtype,
-                        'succeed_count'])
+        if dtype == 'minute':
+            return self._get_minute_succeed_count(member)
+
         try:
-            ret = db.execute('zscore', key, member)
+            ret = db.execute('zscore', self.time_key(dtype), member)
             ret = to_int(ret)
         except:
             ret = 0
 
         return ret
 
+    def _get_minute_succeed_count(self, member):
+        # minutes live in the day hash; rows written before the hash
+        # layout may still sit in the legacy sorted set until migrated
+        try:
+            day, field = self.minute_field(member)
+            pipe = db.pipeline(False)
+            pipe.hget(db.object_key(self.minute_key(day)), field)
+            pipe.zscore(db.object_key(self.time_key('minute')), member)
+            current, legacy = pipe.execute()
+        except Exception:
+            return 0
+
+        return to_int(current or 0) + to_int(legacy or 0)
+
+    @staticmethod
+    def time_series_members(dtype, end, count):
+        '''
+        The ``count`` bucket members of ``dtype`` ending at ``end``, newest
+        first, formatted like ``2026-10-18 7:5``.
+        '''
+        members = []
+        for i in range(count):
+            if dtype == 'year':
+                members.append("%s" % (end.year - i))
+            elif dtype == 'month':
+                months = end.year * 12 + end.month - 1 - i
+                members.append("%s-%s" % (months // 12, months % 12 + 1))
+            elif dtype == 'day':
+                date = end - timedelta(days=i)
+                members.append("%s-%s-%s" % (date.year, date.month, date.day))
+            elif dtype == 'hour':
+                date = end - timedelta(hours=i)
+                members.append("%s-%s-%s %s" % (
+                    date.year, date.month, date.day, date.hour))
+            else:
+                date = end - timedelta(minutes=i)
+                members.append("%s-%s-%s %s:%s" % (
+                    date.year, date.month, date.day, date.hour, date.minute))
+
+        return members
+
+    @staticmethod
+    def time_bucket_count(dtype, start, end):
+        '''
+        How many ``dtype`` buckets the range ``start``..``end`` touches.
+        '''
+        if dtype == 'year':
+            return end.year - start.year + 1
+        if dtype == 'month':
+            return (end.year - start.year) * 12 + end.month - start.month + 1
+        if dtype == 'day':
+            return (end.date() - start.date()).days + 1
+
+        size = 3600 if dtype == 'hour' else 60
+        start = int(start.timestamp()) // size
+        end = int(end.timestamp()) // size
+        return end - start + 1
+
+    def _time_series_plan(self, dtype, members):
+        '''
+        The reads fetching ``members`` as (command, key, args) tuples, and a
+        function folding their replies into one count per member.
+        '''
+        members = [member.replace('-', ':').replace(' ', ':')
+                   for member in members]
+
+        if dtype != 'minute':
+            key = db.object_key(self.time_key(dtype))
+            plan = [('zscore', key, (member, )) for member in members]
+            return plan, lambda rets: [to_int(ret or 0) for ret in rets]
+
+        days = []
+        fields = {}
+        for member in members:
+            day, field = self.minute_field(member)
+            if day not in fields:
+                days.append(day)
+                fields[day] = []
+            fields[day].append(field)
+
+        plan = [('hmget', db.object_key(self.minute_key(day)), fields[day])
+                for day in days]
+        legacy = db.object_key(self.time_key('minute'))
+        plan.extend(('zscore', legacy, (member, )) for member in members)
+
+        def fold(rets):
+            current = []
+            for ret in rets[:len(days)]:
+                current.extend(ret)
+            legacy = rets[len(days):]
+            return [to_int(c or 0) + to_int(l or 0)
+                    for c, l in zip(current, legacy)]
+
+        return plan, fold
+
+    def get_time_series(self, dtype, end=None, count=80):
+        '''
+        ``count`` buckets of ``dtype`` up to ``end`` (default now), newest
+        first, as (member, count) pairs read in one round trip.
+        '''
+        if end is None:
+            end = datetime.now()
+
+        members = self.time_series_members(dtype, end, count)
+        plan, fold = self._time_series_plan(dtype, members)
+
+        pipe = db.pipeline(False)
+        for cmd, key, args in plan:
+            getattr(pipe, cmd)(key, *args)
+        try:
+            counts = fold(pipe.execute())
+        except Exception as e:
+            logger.exception(e)
+            counts = [0] * len(members)
+
+        return list(zip(members, counts))
+
+    def pick_time_series(self, start, end=None, max_points=80):
+        '''
+        Pick the finest dtype that covers ``start``..``end`` in at most
+        ``max_points`` buckets and is still inside its retention. Returns
+        the dtype and its ``get_time_series``.
+        '''
+        now = datetime.now()
+        if end is None:
+            end = now
+
+        for dtype in reversed(self.dtypes):
+            # the coarsest dtype is the fallback, whatever its retention
+            coarsest = dtype == self.dtypes[0]
+            seconds = self.retention.get(dtype)
+            if seconds and start < now - timedelta(seconds=seconds) and \
+                    not coarsest:
+                continue
+            count = self.time_bucket_count(dtype, start, end)
+            if count <= max_points or coarsest:
+                count = max(1, min(count, max_points))
+                return dtype, self.get_time_series(dtype, end, count)
+
+    def get_day_minute_succeed_count(self, day):
+        '''
+        Every minute bucket of ``day`` (``Y-M-D``) with one HGETALL, as a
+        dict of minute offset to count.
+        '''
+        day = day.replace('-', ':')
+        data = db.execute('hgetall', self.minute_key(day)) or {}
+        return dict((to_int(field), to_int(count))
+                    for field, count in data.items())
+
+    def migrate_time_succeed_count(self, count=500):
+        '''
+        Move the legacy minute sorted set into per day hashes. Buckets
+        already past retention are dropped instead of moved. Safe to run
+        while counters are being written.
+        '''
+        key = self.time_key('minute')
+        ttl = self.minute_ttl()
+        deadline = None
+        if ttl:
+            deadline = datetime.now() - timedelta(
+                seconds=self.retention['minute'])
+
+        moved = 0
+        cursor = 0
+        while True:
+            ret = db.execute('zscan', key, cursor, count=count)
+            if not ret:
+                break
+            cursor, data = ret
+
+            if data:
+                pipe = db.pipeline()
+                for member, score in data:
+                    member = to_str(member)
+                    try:
+                        day, field = self.minute_field(member)
+                        end = self._bucket_end('minute', member)
+                    except (ValueError, IndexError):
+                        continue
+                    pipe.zrem(db.object_key(key), member)
+                    if deadline and end <= deadline:
+                        continue
+                    hash_key = db.object_key(self.minute_key(day))
+                    pipe.hincrby(hash_key, field, to_int(score))
+                    if ttl:
+                        pipe.expire(hash_key, ttl)
+                    moved += 1
+                pipe.execute()
+
+            if not cursor:
+                break
+
+        return moved
+
     @classmethod
-    def range_succeed_count(self, start=0, stop=-1, reverse=False):
+    def _range_count(self, key, start=0, stop=-1, reverse=False):
+        cmd = 'zrevrange' if reverse else 'zrange'
+        data = db.execute(cmd, key, start, stop, withscores=True)
+        return [(to_str(index), score) for index, score in data]
+
+    @classmethod
+    def _range_count_by_score(self, key, min='-inf', max='+inf', start=None,
+                              num=None, reverse=False):
+        if num is not None and start is None:
+            start = 0
+        elif start is not None and num is None:
+            # LIMIT with a negative count: everything from start on
+            num = -1
         if reverse:
-            data = db.execute('zrevrange', self.p_key(), start, stop)
+            data = db.execute('zrevrangebyscore', key, max, min, start, num,
+                              withscores=True)
         else:
-            data = db.execute('zrange', self.p_key(), start, stop)
-        return [(to_str(index),
-                 db.execute('zscore', self.p_key(), to_str(index)))
-                for index in data]
+            data = db.execute('zrangebyscore', key, min, max, start, num,
+                              withscores=True)
+        return [(to_str(index), score) for index, score in data]
+
+    @classmethod
+    def range_succeed_count(self, start=0, stop=-1, reverse=False):
+        return self._range_count(self.p_key(), start, stop, reverse)
 
     @classmethod
     def range_user_succeed_count(self, user_id, start=0, stop=-1,
                                  reverse=False):
-        if reverse:
-            data = db.execute('zrevrange', self.pu_key(user_id), start, stop)
-        else:
-            data = db.execute('zrange', self.pu_key(user_id), start, stop)
-        return [(to_str(index),
-                 db.execute('zscore', self.pu_key(user_id), to_str(index)))
-                for index in data]
+        return self._range_count(self.pu_key(user_id), start, stop, reverse)
+
+    @classmethod
+    def range_succeed_count_by_score(self, min='-inf', max='+inf',
+                                     start=None, num=None, reverse=False):
+        return self._range_count_by_score(self.p_key(), min, max, start, num,
+                                          reverse)
+
+    @classmethod
+    def range_user_succeed_count_by_score(self, user_id, min='-inf',
+                                          max='+inf', start=None, num=None,
+                                          reverse=False):
+        return self._range_count_by_score(self.pu_key(user_id), min, max,
+                                          start, num, reverse)
+
+    @staticmethod
+    def _bucket_end(dtype, member):
+        parts = [int(part) for part in to_str(member).split(':')]
+        if dtype == 'minute':
+            return datetime(*parts) + timedelta(minutes=1)
+        if dtype == 'hour':
+            return datetime(*parts) + timedelta(hours=1)
+        if dtype == 'day':
+            return datetime(*parts) + timedelta(days=1)
+        return None
+
+    def compact_succeed_count(self, now=None, count=500):
+        '''
+        Drop the minute/hour/day buckets older than ``retention``,
+        ZSCANning ``count`` members per round trip. Before a bucket goes
+        its count is rolled up into the parent bucket when the parent
+        holds less than its children, so coarser series never lose
+        data. Returns the number of buckets removed.
+        '''
+        if now is None:
+            now = datetime.now()
+
+        removed = 0
+        # finest first, so minutes roll up before their hours are trimmed
+        for pos in range(len(self.dtypes) - 1, 0, -1):
+            dtype = self.dtypes[pos]
+            seconds = self.retention.get(dtype)
+            if not seconds:
+                continue
+
+            deadline = now - timedelta(seconds=seconds)
+            cursor = 0
+            while True:
+                ret = db.execute('zscan', self.time_key(dtype), cursor,
+                                 count=count)
+                if not ret:
+                    break
+                cursor, data = ret
+
+                expired = []
+                for member, score in data:
+                    try:
+                        end = self._bucket_end(dtype, member)
+                    except (ValueError, TypeError):
+                        continue
+                    if end and end <= deadline:
+                        expired.append((to_str(member), score))
+
+                if expired:
+                    self._trim_buckets(pos, expired)
+                    removed += len(expired)
+
+                if not cursor:
+                    break
+
+        return removed
+
+    def _trim_buckets(self, pos, expired):
+        key = db.object_key(self.time_key(self.dtypes[pos]))
+        parent_key = db.object_key(self.time_key(self.dtypes[pos - 1]))
+
+        parents = {}
+        for member, score in expired:
+            parent = member.rsplit(':', 1)[0]
+            parents[parent] = parents.get(parent, 0) + score
+
+        parent_members = list(parents)
+        pipe = db.pipeline(False)
+        for parent in parent_members:
+            pipe.zscore(parent_key, parent)
+        scores = pipe.execute()
+
+        pipe = db.pipeline()
+        for parent, score in zip(parent_members, scores):
+            if (score or 0) < parents[parent]:
+                pipe.zadd(parent_key, parents[parent], parent)
+        pipe.zrem(key, *[member for member, _ in expired])
+        pipe.execute()
 
     def del_succeed_count(self):
-        for dtype in self.dtypes:
-            key = ':'.join([self.table_name, to_str(self.index), dtype,
-                            'succeed_count'])
-            db.del_object(key)
+        keys = [self.time_key(dtype) for dtype in self.dtypes]
+        days = self.minute_days()
+        if days is None:
+            db.drop_objects(self.minute_key('*'))
+        else:
+            keys.extend(self.minute_key(day) for day in days)
+
+        pipe = db.pipeline()
+        pipe.delete(*[db.object_key(key) for key in keys])
+        pipe.zrem(db.object_key(self.p_key()), to_str(self.index))
+        pipe.zrem(db.object_key(self.pu_key(self.payload['user_id'])),
+                  to_str(self.index))
+        pipe.execute()
+
+
+def compact_succeed_counts(tables=None, now=None, size=100):
+    '''
+    Apply ``Countable.compact_succeed_count`` to every row of ``tables``
+    (Robot, Task and User by default), paging through the table index
+    ``size`` rows at a time. This is a generator yielding after each row
+    so a caller can spread the work out.
+    '''
+    if tables is None:
+        tables = [Robot, Task, User]
+    if now is None:
+        now = datetime.now()
+
+    for table in tables:
+        start = 0
+        while True:
+            idxs = Index.range(table.table_name, start, start + size - 1)
+            if not idxs:
+                break
+            for idx in idxs:
+                yield table(idx.member).compact_succeed_count(now)
+            start += size
 
-        db.execute("zrem", self.p_key(), to_str(self.index))
 
-        db.execute("zrem", self.pu_key(self.payload['user_id']),
-                   to_str(self.index))
+def migrate_succeed_counts(tables=None, size=100):
+    '''
+    Run ``Countable.migrate_time_succeed_count`` over every row of
+    ``tables``, yielding after each row like ``compact_succeed_counts``.
+    '''
+    if tables is None:
+        tables = [Robot, Task, User]
+
+    for table in tables:
+        start = 0
+        while True:
+            idxs = Index.range(table.table_name, start, start + size - 1)
+            if not idxs:
+                break
+            for idx in idxs:
+                yield table(idx.member).migrate_time_succeed_count()
+            start += size
+
+
+def lock_compact_succeed_counts(timeout):
+    '''
+    Take the cluster wide compaction slot for ``timeout`` seconds, so only
+    one engine compacts per period.
+    '''
+    return bool(db.execute('set', 'succeed_count:compact', int(time()),
+                           ex=timeout, nx=True))
 
 
 class Schedable(object):
@@ -507,38 +1515,161 @@ class Schedable(object):
 
     @property
     def sched_at(self):
-        if hasattr(self, '_sched_at'):
-            if self._sched_at:
-                return self._sched_at
+        # not hasattr: Table.__getattr__ would load the row for it
+        if self.__dict__.get('_sched_at'):
+            return self._sched_at
 
         self._sched_at = db.execute('zscore', self.table_name + ':sched',
                                     self.index)
         return self._sched_at
 
+    @staticmethod
+    def load_sched_at(rows):
+        '''
+        Read ``sched_at`` of many rows in one round trip, so the property
+        makes none.
+        '''
+        rows = [row for row in rows if not row.__dict__.get('_sched_at')]
+        if not rows:
+            return
+        pipe = db.pipeline(False)
+        for row in rows:
+            pipe.zscore(db.object_key(row.table_name + ':sched'), row.index)
+        for row, score in zip(rows, pipe.execute()):
+            row._sched_at = score
+
+
+def _pick_link_py(client, keys, args):
+    ready = keys[0]
+    picks = []
+    for key, task_id in zip(keys[1:], args[1:]):
+        depth = client.zscore(ready, task_id) or 0
+        if depth > 0:
+            picks.append([task_id, key, depth])
+
+    total = sum(depth for _, _, depth in picks)
+    while picks:
+        target = float(args[0]) * total
+        k = len(picks) - 1
+        for i, (_, _, depth) in enumerate(picks):
+            target -= depth
+            if target < 0:
+                k = i
+                break
+
+        task_id, key, depth = picks.pop(k)
+        link = client.rpop(key)
+        left = client.llen(key)
+        if left > 0:
+            client.zadd(ready, left, task_id)
+        else:
+            client.zrem(ready, task_id)
+        if link:
+            return [to_str(task_id).encode('utf-8'), link]
+        total -= depth
+    return None
+
+
+# KEYS[1] is the task:ready zset of link queue depths, KEYS[2..] the link
+# lists of the task ids in ARGV[2..]; ARGV[1] is a random number in [0, 1).
+# Pops a link from one of the tasks, picked with its depth as weight, and
+# resets that depth to what is left in the list, dropping stale entries.
+_pick_link = db.register_script('''
+local ready = KEYS[1]
+local ids, keys, weights = {}, {}, {}
+local total = 0
+for i = 2, #KEYS do
+    local depth = tonumber(redis.call('ZSCORE', ready, ARGV[i]) or '0')
+    if depth > 0 then
+        ids[#ids + 1] = ARGV[i]
+        keys[#keys + 1] = KEYS[i]
+        weights[#weights + 1] = depth
+        total = total + depth
+    end
+end
+
+local r = tonumber(ARGV[1])
+while #ids > 0 do
+    local target = r * total
+    local k = #ids
+    for i = 1, #ids do
+        target = target - weights[i]
+        if target < 0 then
+            k = i
+            break
+        end
+    end
+
+    local link = redis.call('RPOP', keys[k])
+    local left = redis.call('LLEN', keys[k])
+    if left > 0 then
+        redis.call('ZADD', ready, left, ids[k])
+    else
+        redis.call('ZREM', ready, ids[k])
+    end
+    if link then
+        return {ids[k], link}
+    end
+
+    total = total - weights[k]
+    table.remove(ids, k)
+    table.remove(keys, k)
+    table.remove(weights, k)
+end
+return false
+''', _pick_link_py)
+
+
+def _pop_link_py(client, keys, args):
+    link = client.rpop(keys[1])
+    left = client.llen(keys[1])
+    if left > 0:
+        client.zadd(keys[0], left, args[0])
+    else:
+        client.zrem(keys[0], args[0])
+    return link
+
+
+# KEYS[1] is the task:ready zset, KEYS[2] the link list of task ARGV[1].
+# Pops a link whatever task:ready says and resets the depth of the task to
+# what is left, so a missing or stale entry is repaired on the way.
+_pop_link = db.register_script('''
+local link = redis.call('RPOP', KEYS[2])
+local left = redis.call('LLEN', KEYS[2])
+if left > 0 then
+    redis.call('ZADD', KEYS[1], left, ARGV[1])
+else
+    redis.call('ZREM', KEYS[1], ARGV[1])
+end
+return link
+''', _pop_link_py)
+
 
 class Task(Table, Countable, Schedable):
     table_name = "task"
     unique_columns = ["hash_url"]
     index_columns = ["user_id"]
+    cacheable = True
 
     def delete(self):
         Table.delete(self)
         self.del_succeed_count()
         self.remove_sched()
-        key = "{}:{}:link:uniq".format(self.table_name, self.index)
-        db.del_object(key)
+        dedup.clear("{}:{}:link:uniq".format(self.table_name, self.index))
+        db.execute("zrem", self.ready_key(), self.index)
 
     def save(self):
         is_new = False
         if not self.index:
             is_new = True
 
-        Table.save(self)
+        if not Table.save(self):
+            return False
 
         if is_new:
             self.init_succeed_count()
-            key = "{}:{}:link:uniq".format(self.table_name, self.index)
-            db.execute('sadd', key, 'haha')
+            dedup.init("{}:{}:link:uniq".format(self.table_name, self.index))
+        return True
 
     @property
     def subscribed(self):
@@ -561,24 +1692,99 @@ class Task(Table, Countable, Schedable):
         return db.execute("scard", "{}:{}:subscribed".format(
             self.table_name, self.index))
 
+    @classmethod
+    def ready_key(self):
+        return "{}:ready".format(self.table_name)
+
+    def link_key(self):
+        return "{}:{}:link".format(self.table_name, self.index)
+
     def link_push(self, hash_url):
-        key = "{}:{}:link".format(self.table_name, self.index)
-        db.execute("lpush", key, hash_url)
+        pipe = db.pipeline()
+        pipe.lpush(db.object_key(self.link_key()), hash_url)
+        pipe.zincrby(db.object_key(self.ready_key()), self.index, 1)
+        pipe.execute()
 
     def link_pop(self):
-        key = "{}:{}:link".format(self.table_name, self.index)
-        ret = db.execute("rpop", key)
-        if ret:
-            return str(ret, 'utf-8')
-        return None
+        '''
+        Pop a link of this task straight off its queue, see ``_pop_link``.
+        '''
+        hash_url = _pop_link(keys=[db.object_key(self.ready_key()),
+                                   db.object_key(self.link_key())],
+                             args=[self.index])
+        if not hash_url:
+            return None
+        return str(hash_url, 'utf-8')
 
     def link_count(self):
-        return db.execute(
-            "llen", "{}:{}:link".format(self.table_name, self.index))
+        return db.execute("llen", self.link_key())
 
     def link_drop(self):
-        return db.execute(
-            "delete", "{}:{}:link".format(self.table_name, self.index))
+        pipe = db.pipeline()
+        pipe.delete(db.object_key(self.link_key()))
+        pipe.zrem(db.object_key(self.ready_key()), self.index)
+        pipe.execute()
+
+    @classmethod
+    def pick_link(self, task_ids, rand=0):
+        '''
+        Pop a link of one of ``task_ids``, picked at random weighted by the
+        depth of their link queues, see ``_pick_link``. Returns
+        ``(task_id, hash_url)``, or ``(None, None)`` when every queue is
+        empty.
+        '''
+        if not task_ids:
+            return None, None
+        keys = [db.object_key(self.ready_key())]
+        keys.extend([db.object_key(self(task_id).link_key())
+                     for task_id in task_ids])
+        try:
+            ret = _pick_link(keys=keys, args=[rand] + list(task_ids))
+        except Exception as e:
+            logger.exception(e)
+            return None, None
+        if not ret:
+            return None, None
+        return int(ret[0]), str(ret[1], 'utf-8')
+
+    @classmethod
+    def ready(self, task_ids):
+        '''
+        The ``task_ids`` with queued links, in one round trip.
+        '''
+        if not task_ids:
+            return []
+        pipe = db.pipeline(False)
+        for task_id in task_ids:
+            pipe.zscore(db.object_key(self.ready_key()), task_id)
+        return [task_id for task_id, depth in zip(task_ids, pipe.execute())
+                if depth and depth > 0]
+
+    @classmethod
+    def rebuild_ready(self, size=500):
+        '''
+        Reset task:ready from the link queues, for queues filled before
+        it existed.
+        '''
+        start = 0
+        while True:
+            idxs = Index.range(self.table_name, start, start + size - 1)
+            if not idxs:
+                break
+            task_ids = [int(idx.member) for idx in idxs]
+            pipe = db.pipeline(False)
+            for task_id in task_ids:
+                pipe.llen(db.object_key(self(task_id).link_key()))
+            depths = pipe.execute()
+
+            pipe = db.pipeline(False)
+            for task_id, depth in zip(task_ids, depths):
+                if depth:
+                    pipe.zadd(db.object_key(self.ready_key()), depth, task_id)
+                else:
+                    pipe.zrem(db.object_key(self.ready_key()), task_id)
+            pipe.execute()
+            start += size
 
     def incr_visit(self):
         ret = db.execute(
@@ -600,16 +1806,12 @@ class Task(Table, Countable, Schedable):
 
     def has(self, hash_url):
         key = "{}:{}:link:uniq".format(self.table_name, self.index)
-        if db.execute("sismember", key, hash_url):
-            return True
-
-        db.execute("sadd", key, hash_url)
-        return False
+        return dedup.has(key, hash_url)
 
     def clear_uniq(self):
         key = "{}:{}:link:uniq".format(self.table_name, self.index)
-        db.del_object(key)
-        db.execute("sadd", key, "haha")
+        dedup.clear(key)
+        dedup.init(key)
 
         while True:
             hash_url = self.link_pop()
@@ -630,6 +1832,7 @@ class Robot(Table, Countable, Schedable):
     table_name = "robot"
     unique_columns = ["name"]
     index_columns = ["user_id", "alive user_id"]
+    cacheable = True
 
     def delete(self):
         Table.delete(self)
@@ -642,11 +1845,13 @@ class Robot(Table, Countable, Schedable):
         if not self.index:
             is_new = True
 
-        Table.save(self)
+        if not Table.save(self):
+            return False
 
         if is_new:
             self.init_succeed_count()
-            self.set_item('haha')
+            self.set_item(SET_SENTINEL)
+        return True
 
     def set_item(self, hash_url):
         db.execute('sadd', "{}:{}:item".format(self.table_name, self.index),
@@ -683,6 +1888,7 @@ init_table(Robot)
 class User(Table, Countable):
     table_name = "user"
     unique_columns = ["name"]
+    cacheable = True
 
     def delete(self):
         Table.delete(self)
@@ -705,14 +1911,101 @@ class User(Table, Countable):
 init_table(User)
 
 
+def _claim_item_py(client, keys, args):
+    id = client.spop(keys[0])
+    if not id:
+        for member in client.zrange(keys[2], 0, -1):
+            if client.exists(to_str(args[0]) + to_str(member)):
+                client.sadd(keys[0], member)
+            else:
+                client.zrem(keys[1], member)
+                client.zrem(keys[2], member)
+        id = client.spop(keys[0])
+        if not id:
+            return None
+
+    key = to_str(args[0]) + to_str(id)
+    data = client.get(key)
+    client.delete(key)
+    client.zrem(keys[1], id)
+    client.zrem(keys[2], id)
+
+    if data:
+        payload = json.loads(to_str(data))
+        for columns in args[2:]:
+            columns = columns.split()
+            members = [to_str(payload.get(column, '')) for column in columns]
+            name = to_str(args[1]) + ':'.join(columns)
+            client.zrem(name, ':'.join(members))
+    return [id, data]
+
+
+# KEYS[1] is the item queue of a task, KEYS[2] the item table index and
+# KEYS[3] the task_id column index. ARGV[1] and ARGV[2] are the item object
+# and index key prefixes, ARGV[3..] the unique columns. Pops an item id,
+# fetches and deletes its row and removes it from every index.
+#
+# An empty queue is checked against the task_id index: Item.save indexes a
+# row before it queues it, so an indexed row is queued again, and only the
+# entries of rows that are gone are removed.
+#
+# The row keys are only known once popped, so they are built from ARGV[1]
+# instead of passed in KEYS: the script needs every key on one redis, it
+# can not run on a cluster.
+_claim_item = db.register_script('''
+local id = redis.call('SPOP', KEYS[1])
+if not id then
+    for _, member in ipairs(redis.call('ZRANGE', KEYS[3], 0, -1)) do
+        if redis.call('EXISTS', ARGV[1] .. member) == 1 then
+            redis.call('SADD', KEYS[1], member)
+        else
+            redis.call('ZREM', KEYS[2], member)
+            redis.call('ZREM', KEYS[3], member)
+        end
+    end
+    id = redis.call('SPOP', KEYS[1])
+    if not id then
+        return false
+    end
+end
+
+local key = ARGV[1] .. id
+local data = redis.call('GET', key)
+redis.call('DEL', key)
+redis.call('ZREM', KEYS[2], id)
+redis.call('ZREM', KEYS[3], id)
+
+if data then
+    local payload = cjson.decode(data)
+    for i = 3, #ARGV do
+        local members = {}
+        for column in string.gmatch(ARGV[i], '%S+') do
+            local value = payload[column]
+            if value == nil then
+                value = ''
+            end
+            members[#members + 1] = tostring(value)
+        end
+        local name = ARGV[2] .. (string.gsub(ARGV[i], ' ', ':'))
+        redis.call('ZREM', name, table.concat(members, ':'))
+    end
+end
+return {id, data}
+''', _claim_item_py)
+
+
 class Item(Table):
     table_name = 'item'
     unique_columns = ["hash_url"]
     index_columns = ['task_id']
+    # _claim_item decodes the row in lua
+    hash_rows = False
 
     def save(self):
-        Table.save(self)
+        if not Table.save(self):
+            return False
         self.add_queue()
+        return True
 
     def delete(self):
         Table.delete(self)
@@ -720,12 +2013,7 @@ class Item(Table):
 
     @classmethod
     def has(self, hash_url):
-        key = "{}:uniq".format(self.table_name)
-        if db.execute("sismember", key, hash_url):
-            return True
-
-        db.execute("sadd", key, hash_url)
-        return False
+        return dedup.has("{}:uniq".format(self.table_name), hash_url)
 
     def add_queue(self):
         key = "{}:{}:queue".format(self.table_name, self.payload['task_id'])
@@ -740,6 +2028,31 @@ class Item(Table):
         key = "{}:{}:visit".format(self.table_name, task_id)
         return db.execute('get', key)
 
+    @classmethod
+    def claim(self, task_id):
+        '''
+        Pop an item of the task queue and delete it with its indexes in one
+        atomic step, see ``_claim_item``, so concurrent robots never get
+        the same item. Returns the item, ``False`` when the popped row was
+        already gone, or None when the queue is empty.
+        '''
+        keys = [db.object_key("{}:{}:queue".format(self.table_name, task_id)),
+                db.index_key(self.table_name),
+                db.index_key(":".join([self.table_name, 'task_id',
+                                       to_str(task_id)]))]
+        args = [db.object_key(self.table_name + ":"),
+                db.index_key(self.table_name + ":")] + self.unique_columns
+        try:
+            ret = _claim_item(keys=keys, args=args)
+        except Exception as e:
+            logger.exception(e)
+            return None
+        if not ret:
+            return None
+        if not ret[1]:
+            return False
+        return self(int(ret[0]), db.load_object(ret[1]))
+
     @classmethod
     def pop_queue(self, task_id):
         key = "{}:{}:queue".format(self.table_name, task_id)
@@ -759,7 +2072,7 @@ class Item(Table):
         db.execute("delete", key)
         Index.drop("{}:{}:{}".format(self.table_name, 'task_id', task_id))
 
-db.execute("sadd", "{}:uniq".format(Item.table_name), "haha")
+dedup.init("{}:uniq".format(Item.table_name))
 
 init_table(Item)
 
@@ -774,7 +2087,7 @@ class Link(object):
     @property
     def index(self):
         if not self._index and self._req:
-            self._index = hash_url(self._req.url)
+            self._index = fingerprint(self._req.url)
 
         return self._index
 
@@ -788,13 +2101,13 @@ class Link(object):
             data = db.execute("GET", "{}:{}".format(self.table_name,
                                                     self.index))
             if data:
-                self._req = Request.build(data)
+                self._req = Request.build(link_codec.decode(data))
 
         return self._req
 
     def save(self):
         db.execute("SET", "{}:{}".format(self.table_name, self.index),
-                   bytes(self.req))
+                   link_codec.encode(bytes(self.req)))
 
     def delete(self):
         db.del_object("{}:{}".format(self.table_name, self.index))
@@ -805,12 +2118,7 @@ class Link(object):
 
     @classmethod
     def has(self, hash_url):
-        key = "{}:uniq".format(self.table_name)
-        if db.execute("sismember", key, hash_url):
-            return True
-
-        db.execute("sadd", key, hash_url)
-        return False
+        return dedup.has("{}:uniq".format(self.table_name), hash_url)
 
 
-db.execute("sadd", "{}:uniq".format(Link.table_name), "haha")
+dedup.init("{}:uniq".format(Link.table_name))
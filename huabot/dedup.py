@@ -0,0 +1,197 @@
+'''
+Check-and-add deduplication for the ``uniq`` keys: ``task:<id>:link:uniq``,
+``link:uniq`` and ``item:uniq``.
+
+``has(key, member)`` answers whether ``member`` was seen under ``key`` and
+records it when it was not. ``SetDedup`` keeps every member in a redis
+set; ``BloomDedup`` keeps a scalable bloom filter in plain redis bitmaps,
+trading a configurable false positive rate for a small, bounded memory
+footprint.
+'''
+import math
+import hashlib
+from .utils import to_int, to_str, DEDUP_BACKEND, DEDUP_CAPACITY, DEDUP_ERROR_RATE
+from .utils import SET_SENTINEL
+
+
+class SetDedup(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def has(self, key, member):
+        # SADD answers 0 when the member was already there, so the check
+        # and the add are one atomic round trip
+        return self.db.execute("sadd", key, member) == 0
+
+    def init(self, key):
+        self.db.execute("sadd", key, SET_SENTINEL)
+
+    def clear(self, key):
+        self.db.del_object(key)
+
+
+# KEYS[1] is the filter meta hash, its layers live in KEYS[1]:<n>.
+# ARGV: h1, h2, capacity, error rate, growth, tightening ratio.
+BLOOM_SCRIPT = '''
+local meta = KEYS[1]
+local h1 = tonumber(ARGV[1])
+local h2 = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local rate = tonumber(ARGV[4])
+local growth = tonumber(ARGV[5])
+local ratio = tonumber(ARGV[6])
+
+local function shape(i)
+    local n = capacity * growth ^ i
+    local p = rate * ratio ^ i
+    local m = math.ceil(-n * math.log(p) / (math.log(2) ^ 2))
+    local k = math.ceil(m / n * math.log(2))
+    return n, m, k
+end
+
+local layers = tonumber(redis.call('HGET', meta, 'layers') or '0')
+for i = 0, layers - 1 do
+    local n, m, k = shape(i)
+    local key = meta .. ':' .. i
+    local found = true
+    for j = 0, k - 1 do
+        if redis.call('GETBIT', key, (h1 + j * h2) % m) == 0 then
+            found = false
+            break
+        end
+    end
+    if found then
+        return 1
+    end
+end
+
+if layers == 0 then
+    layers = 1
+    redis.call('HSET', meta, 'layers', layers)
+end
+
+local i = layers - 1
+local n, m, k = shape(i)
+local key = meta .. ':' .. i
+for j = 0, k - 1 do
+    redis.call('SETBIT', key, (h1 + j * h2) % m, 1)
+end
+
+if redis.call('HINCRBY', meta, 'count:' .. i, 1) >= n then
+    redis.call('HSET', meta, 'layers', layers + 1)
+end
+return 0
+'''
+
+
+def bloom_has(client, keys, args):
+    '''
+    ``BLOOM_SCRIPT`` in python, for the storage backends without lua.
+    '''
+    meta = keys[0]
+    h1, h2 = int(args[0]), int(args[1])
+    capacity, rate, growth, ratio = map(float, args[2:6])
+
+    def shape(i):
+        n = capacity * growth ** i
+        p = rate * ratio ** i
+        m = math.ceil(-n * math.log(p) / (math.log(2) ** 2))
+        k = math.ceil(m / n * math.log(2))
+        return n, m, k
+
+    layers = to_int(client.hget(meta, 'layers') or 0)
+    for i in range(layers):
+        n, m, k = shape(i)
+        key = '{}:{}'.format(to_str(meta), i)
+        if all(client.getbit(key, (h1 + j * h2) % m) for j in range(k)):
+            return 1
+
+    if layers == 0:
+        layers = 1
+        client.hset(meta, 'layers', layers)
+
+    i = layers - 1
+    n, m, k = shape(i)
+    key = '{}:{}'.format(to_str(meta), i)
+    for j in range(k):
+        client.setbit(key, (h1 + j * h2) % m, 1)
+
+    if client.hincrby(meta, 'count:{}'.format(i), 1) >= n:
+        client.hset(meta, 'layers', layers + 1)
+    return 0
+
+
+# KEYS[1] is the filter meta hash. Deletes it and the layers it counts.
+BLOOM_CLEAR_SCRIPT = '''
+local layers = tonumber(redis.call('HGET', KEYS[1], 'layers') or '0')
+local keys = {KEYS[1]}
+for i = 0, layers - 1 do
+    keys[#keys + 1] = KEYS[1] .. ':' .. i
+end
+return redis.call('DEL', unpack(keys))
+'''
+
+
+def bloom_clear(client, keys, args):
+    '''
+    ``BLOOM_CLEAR_SCRIPT`` in python.
+    '''
+    meta = to_str(keys[0])
+    layers = to_int(client.hget(meta, 'layers') or 0)
+    return client.delete(meta, *['{}:{}'.format(meta, i)
+                                 for i in range(layers)])
+
+
+class BloomDedup(object):
+    '''
+    A scalable bloom filter: each layer holds ``capacity * growth ** n``
+    members at an error rate of ``error_rate * ratio ** n``, and a new
+    layer starts when the last one is full, so the overall false positive
+    rate stays under ``error_rate / (1 - ratio)``.
+    '''
+
+    def __init__(self, db, capacity=DEDUP_CAPACITY,
+                 error_rate=DEDUP_ERROR_RATE, growth=2, ratio=0.5):
+        self.db = db
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.ratio = ratio
+        self._script = db.register_script(BLOOM_SCRIPT, bloom_has)
+        self._clear = db.register_script(BLOOM_CLEAR_SCRIPT, bloom_clear)
+
+    def _key(self, key):
+        return key + ':bloom'
+
+    def hashes(self, member):
+        digest = hashlib.sha1(bytes(str(member), 'utf-8')).digest()
+        h1 = int.from_bytes(digest[0:4], 'big')
+        h2 = int.from_bytes(digest[4:8], 'big') | 1
+        return h1, h2
+
+    def has(self, key, member):
+        h1, h2 = self.hashes(member)
+        ret = self._script(keys=[self.db.object_key(self._key(key))],
+                           args=[h1, h2, self.capacity, self.error_rate,
+                                 self.growth, self.ratio])
+        return to_int(ret) == 1
+
+    def init(self, key):
+        pass
+
+    def clear(self, key):
+        self._clear(keys=[self.db.object_key(self._key(key))])
+
+
+backends = {
+    'set': SetDedup,
+    'bloom': BloomDedup,
+}
+
+
+def get_dedup(db, backend=DEDUP_BACKEND, **params):
+    if backend not in backends:
+        raise ValueError("unknown dedup backend: {}".format(backend))
+
+    return backends[backend](db, **params)
@@ -0,0 +1,337 @@
+'''
+Process-local counters and latency histograms, rendered in the
+Prometheus text format by ``/api/metrics``, to logged in users only.
+
+Off unless METRICS=1: ``timed`` then returns the function untouched and
+``DB`` talks to a plain redis client, so there is nothing to pay. On,
+every redis round trip is timed by command and key family (the key with
+the prefix dropped and ids replaced by ``*``) and the hot paths of the
+scheduler are timed as spans.
+
+Engine processes do not serve http; ``publish`` stores a snapshot of
+their metrics in a redis hash, which the api reads with one HGETALL and
+renders next to its own with an ``instance`` label.
+'''
+import os
+import json
+import socket
+import asyncio
+import inspect
+import threading
+from time import time
+from functools import wraps
+from bisect import bisect_left
+from redis import StrictRedis
+from redis.client import StrictPipeline
+from .utils import METRICS, to_str
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+
+
+class Registry(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, labels=None, value=1):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = (name, _labels(labels))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                # one count per bucket, then +Inf, sum
+                hist = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            hist[bisect_left(self.buckets, seconds)] += 1
+            hist[-1] += seconds
+
+    def count(self, name):
+        '''
+        Observations of histogram ``name`` over all its labels; for
+        ``huabot_redis_seconds`` the redis round trips so far.
+        '''
+        with self._lock:
+            return sum(sum(hist[:-1]) for (key, _), hist
+                       in self.histograms.items() if key == name)
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def dump(self):
+        with self._lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value
+                             in self.counters.items()],
+                'histograms': [[name, labels, hist] for (name, labels), hist
+                               in self.histograms.items()],
+            }
+
+    def render(self, snapshots=()):
+        '''
+        The text exposition of this registry and of ``snapshots``, a list
+        of ``(instance, dump())`` pairs.
+        '''
+        dumps = [(None, self.dump())] + list(snapshots)
+        counters = {}
+        histograms = {}
+        for instance, dump in dumps:
+            extra = (('instance', instance),) if instance else ()
+            for name, labels, value in dump['counters']:
+                labels = tuple(map(tuple, labels)) + extra
+                counters.setdefault(name, []).append((labels, value))
+            for name, labels, hist in dump['histograms']:
+                labels = tuple(map(tuple, labels)) + extra
+                histograms.setdefault(name, []).append((labels, hist))
+
+        lines = []
+        for name in sorted(counters):
+            self._header(lines, name, 'counter')
+            for labels, value in counters[name]:
+                lines.append('{}{} {}'.format(name, _format(labels), value))
+
+        for name in sorted(histograms):
+            self._header(lines, name, 'histogram')
+            for labels, hist in histograms[name]:
+                total = 0
+                for le, count in zip(self.buckets + ('+Inf',), hist):
+                    total += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format(labels + (('le', str(le)),)), total))
+                lines.append('{}_sum{} {}'.format(name, _format(labels),
+                                                  hist[-1]))
+                lines.append('{}_count{} {}'.format(name, _format(labels),
+                                                    total))
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, kind):
+        if name in self.help:
+            lines.append('# HELP {} {}'.format(name, self.help[name]))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+
+def _labels(labels):
+    if not labels:
+        return ()
+    return tuple(sorted((k, to_str(v)) for k, v in labels.items()))
+
+
+def _format(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels) + '}'
+
+
+registry = Registry()
+registry.describe('huabot_redis_seconds',
+                  'redis command latency by command and key family')
+registry.describe('huabot_redis_errors_total',
+                  'redis commands that raised, by command and key family')
+registry.describe('huabot_redis_pipelined_total',
+                  'commands sent in a pipeline, by command and key family')
+registry.describe('huabot_db_execute_errors_total',
+                  'errors swallowed by huabot.db.DB.execute')
+registry.describe('huabot_span_seconds', 'latency of the hot paths')
+
+
+def key_family(key, prefix=None):
+    '''
+    ``huabot:task:12:link`` -> ``task:*:link``: ids and fingerprints
+    become ``*`` so keys group into a few families.
+    '''
+    parts = to_str(key).split(':')
+    if prefix and parts and parts[0] == prefix:
+        parts = parts[1:]
+    family = []
+    for part in parts[:4]:
+        stripped = part.lstrip('-')
+        if stripped.isdigit() or (len(part) >= 32 and _is_hex(part)):
+            part = '*'
+        family.append(part)
+    return ':'.join(family)
+
+
+def _is_hex(value):
+    try:
+        int(value, 16)
+        return True
+    except ValueError:
+        return False
+
+
+def timed(name, labels=None):
+    '''
+    Decorate a function or generator coroutine to record its wall time as
+    span ``name``. ``labels`` is a dict, or a function of the call
+    arguments returning one.
+    '''
+    def decorator(func):
+        if not METRICS:
+            return func
+        return span(name, func, labels)
+    return decorator
+
+
+def span(name, func, labels=None):
+    '''
+    ``func`` recording its wall time as span ``name``.
+    '''
+    def _span_labels(args, kwargs):
+        extra = labels(*args, **kwargs) if callable(labels) else labels
+        ret = {'span': name}
+        ret.update(extra or {})
+        return ret
+
+    if inspect.isgeneratorfunction(func) or \
+            asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        @asyncio.coroutine
+        def wrapper(*args, **kwargs):
+            start = time()
+            try:
+                return (yield from func(*args, **kwargs))
+            finally:
+                registry.observe('huabot_span_seconds',
+                                 _span_labels(args, kwargs), time() - start)
+    else:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe('huabot_span_seconds',
+                                 _span_labels(args, kwargs), time() - start)
+    return wrapper
+
+
+def command_family(args, prefix=None):
+    '''
+    The key family of a redis command, the first key of a script call.
+
+    >>> command_family(('GET', 'huabot:task:12'), 'huabot')
+    'task:*'
+    >>> command_family(('EVALSHA', 'ab12', 1, 'huabot:task:ready'), 'huabot')
+    'task:ready'
+    >>> command_family(('PING',))
+    ''
+    '''
+    if args[0].upper() in ('EVAL', 'EVALSHA'):
+        if len(args) < 4 or not int(args[2]):
+            return ''
+        return key_family(args[3], prefix)
+    if len(args) < 2:
+        return ''
+    return key_family(args[1], prefix)
+
+
+class InstrumentedRedis(StrictRedis):
+    '''
+    ``StrictRedis`` timing every round trip by command and key family.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.key_prefix = kwargs.pop('key_prefix', None)
+        StrictRedis.__init__(self, *args, **kwargs)
+
+    def execute_command(self, *args, **options):
+        labels = {
+            'command': args[0].lower(),
+            'family': command_family(args, self.key_prefix),
+        }
+        start = time()
+        try:
+            return StrictRedis.execute_command(self, *args, **options)
+        except Exception:
+            registry.incr('huabot_redis_errors_total', labels)
+            raise
+        finally:
+            registry.observe('huabot_redis_seconds', labels, time() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = InstrumentedPipeline(self.connection_pool,
+                                    self.response_callbacks, transaction,
+                                    shard_hint)
+        pipe.key_prefix = self.key_prefix
+        return pipe
+
+
+class InstrumentedPipeline(StrictPipeline):
+    '''
+    A pipeline is one round trip, timed as command ``multi`` or
+    ``pipeline`` with the family of its first command; the commands it
+    carries are counted on their own.
+    '''
+    key_prefix = None
+
+    def execute(self, raise_on_error=True):
+        stack = self.command_stack
+        if not stack:
+            return StrictPipeline.execute(self, raise_on_error)
+
+        for args, _ in stack:
+            registry.incr('huabot_redis_pipelined_total', {
+                'command': args[0].lower(),
+                'family': command_family(args, self.key_prefix),
+            })
+        labels = {
+            'command': 'multi' if self.transaction else 'pipeline',
+            'family': command_family(stack[0][0], self.key_prefix),
+        }
+        start = time()
+        try:
+            return StrictPipeline.execute(self, raise_on_error)
+        except Exception:
+            registry.incr('huabot_redis_errors_total', labels)
+            raise
+        finally:
+            registry.observe('huabot_redis_seconds', labels, time() - start)
+
+
+def instance_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def publish(db, ttl=60):
+    '''
+    Store this process' metrics in redis for the api to render, as a field
+    of the ``metrics`` hash good for ``ttl`` seconds.
+    '''
+    key = db.object_key('metrics')
+    pipe = db.pipeline(False)
+    pipe.hset(key, instance_name(), json.dumps({
+        'expires': time() + ttl,
+        'metrics': registry.dump(),
+    }))
+    pipe.expire(key, ttl)
+    pipe.execute()
+
+
+def collect(db):
+    '''
+    The snapshots other processes published, as ``(instance, dump)``;
+    those their process stopped refreshing are dropped.
+    '''
+    own = instance_name()
+    now = time()
+    snapshots = []
+    stale = []
+    for instance, data in (db.execute('hgetall', 'metrics') or {}).items():
+        instance = to_str(instance)
+        snapshot = json.loads(to_str(data))
+        if snapshot['expires'] < now:
+            stale.append(instance)
+        elif instance != own:
+            snapshots.append((instance, snapshot['metrics']))
+    if stale:
+        db.execute('hdel', 'metrics', *stale)
+    return sorted(snapshots)
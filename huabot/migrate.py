@@ -0,0 +1,282 @@
+'''
+One-off keyspace migrations.
+
+    python -m huabot.migrate fingerprints
+    python -m huabot.migrate succeed_counts
+    python -m huabot.migrate ready_tasks
+    python -m huabot.migrate shards
+    python -m huabot.migrate rows
+
+Stop the engines before running them: queues are rewritten in place.
+Only ``rows`` may run next to them, each row is swapped atomically.
+'''
+import asyncio
+import argparse
+from . import db
+from .utils import hex_to_fingerprint, to_str, logger, DEDUP_BACKEND
+from .utils import SET_SENTINEL
+
+
+def _fingerprint(member):
+    member = to_str(member)
+    if member == 'haha':
+        return SET_SENTINEL
+    return hex_to_fingerprint(member)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def migrate_set(key, size=500):
+    '''
+    Rewrite the members of set ``key`` as int64 fingerprints.
+    '''
+    tmp = key + ':migrate'
+    cursor = 0
+    while True:
+        ret = db.execute('sscan', key, cursor, count=size)
+        if not ret:
+            break
+        cursor, members = ret
+        if members:
+            db.execute('sadd', tmp, *[_fingerprint(m) for m in members])
+        if not cursor:
+            break
+
+    if db.execute('exists', tmp):
+        db.execute('rename', tmp, db.db.object_key(key))
+
+
+def migrate_list(key):
+    '''
+    Rewrite the elements of list ``key`` as int64 fingerprints, keeping
+    their order.
+    '''
+    members = db.execute('lrange', key, 0, -1)
+    if not members:
+        return
+    pipe = db.db.pipeline()
+    pipe.delete(db.db.object_key(key))
+    pipe.rpush(db.db.object_key(key), *[_fingerprint(m) for m in members])
+    pipe.execute()
+
+
+def migrate_links(size=500):
+    '''
+    Rename every ``link:<sha1>`` payload to ``link:<int64>``.
+    '''
+    count = 0
+    keys = (key for key in db.db.scan_objects('link:*', size)
+            if len(key) == 45)
+    for batch in _batches(keys, size):
+        pipe = db.db.pipeline(False)
+        for key in batch:
+            new_key = 'link:' + hex_to_fingerprint(key[5:])
+            if new_key != key:
+                pipe.renamenx(db.db.object_key(key), db.db.object_key(new_key))
+                count += 1
+        pipe.execute()
+    return count
+
+
+def migrate_fingerprints(size=100):
+    '''
+    Move a keyspace written with FINGERPRINT=sha1 to FINGERPRINT=int64:
+    task link queues, link payloads and the uniq/item sets. Bloom filter
+    dedup keeps no members and cannot be converted; clear it instead.
+    '''
+    if DEDUP_BACKEND != 'set':
+        logger.warning('%s dedup filters can not be migrated, '
+                       'already seen urls may be crawled again.',
+                       DEDUP_BACKEND)
+
+    for table in [db.Task, db.Robot]:
+        start = 0
+        while True:
+            idxs = db.Index.range(table.table_name, start, start + size - 1)
+            if not idxs:
+                break
+            for idx in idxs:
+                if table is db.Task:
+                    migrate_list('task:{}:link'.format(idx.member))
+                    if DEDUP_BACKEND == 'set':
+                        migrate_set('task:{}:link:uniq'.format(idx.member))
+                else:
+                    migrate_set('robot:{}:item'.format(idx.member))
+            start += size
+
+    if DEDUP_BACKEND == 'set':
+        migrate_set('link:uniq')
+
+    return migrate_links()
+
+
+def migrate_succeed_counts():
+    return sum(db.migrate_succeed_counts())
+
+
+def migrate_ready_tasks():
+    db.Task.rebuild_ready()
+    return db.Index.count(db.Task.table_name)
+
+
+def migrate_shards(size=500):
+    '''
+    Resubmit every alive robot and every task to its shard after
+    ENGINE_SHARDS changed. Jobs left under the old func names are no
+    longer served and can be dropped from periodic.
+    '''
+    from . import periodic
+    loop = asyncio.get_event_loop()
+    count = 0
+    for table, sched in [(db.Robot, periodic.sched_robots),
+                         (db.Task, periodic.sched_tasks)]:
+        start = 0
+        while True:
+            idxs = db.Index.range(table.table_name, start, start + size - 1)
+            if not idxs:
+                break
+            rows = [row for row in table.get_many(
+                [int(idx.member) for idx in idxs]) if row]
+            if table is db.Robot:
+                rows = [row for row in rows if row.alive]
+            loop.run_until_complete(sched(rows))
+            count += len(rows)
+            start += size
+    return count
+
+
+def _swap_row_py(client, keys, args):
+    row = keys[0]
+    if to_str(client.type(row)) != to_str(args[0]):
+        return 0
+    pairs = dict(zip(args[2::2], args[3::2]))
+    if to_str(args[0]) == 'string':
+        if to_str(client.get(row)) != to_str(args[1]):
+            return 0
+        client.delete(row)
+        if pairs:
+            client.hmset(row, pairs)
+    else:
+        old = dict((to_str(field), to_str(value))
+                   for field, value in client.hgetall(row).items())
+        if old != dict((to_str(field), to_str(value))
+                       for field, value in pairs.items()):
+            return 0
+        client.set(row, args[1])
+    return 1
+
+
+# KEYS[1] is a row, ARGV[1] its layout when read, string or hash. A string
+# row is replaced by the hash of ARGV[3..] field/value pairs if it still
+# holds ARGV[2]; a hash row by the string ARGV[2] if it still holds the
+# pairs ARGV[3..]. Returns 0, writing nothing, when the row changed.
+_swap_row = db.db.register_script('''
+local row = KEYS[1]
+if redis.call('TYPE', row).ok ~= ARGV[1] then
+    return 0
+end
+if ARGV[1] == 'string' then
+    if redis.call('GET', row) ~= ARGV[2] then
+        return 0
+    end
+    redis.call('DEL', row)
+    if #ARGV > 2 then
+        redis.call('HMSET', row, unpack(ARGV, 3))
+    end
+else
+    if redis.call('HLEN', row) * 2 ~= #ARGV - 2 then
+        return 0
+    end
+    for i = 3, #ARGV, 2 do
+        if redis.call('HGET', row, ARGV[i]) ~= ARGV[i + 1] then
+            return 0
+        end
+    end
+    redis.call('SET', row, ARGV[2])
+end
+return 1
+''', _swap_row_py)
+
+
+def migrate_row(key):
+    '''
+    Rewrite row ``key`` in the layout HASH_ROWS asks for, a json string
+    or a hash; returns whether it was rewritten. A row written meanwhile
+    is read again, so no update is lost.
+    '''
+    while True:
+        layout = to_str(db.execute('type', key))
+        if layout not in ('string', 'hash') or \
+                (layout == 'hash') == db.db.is_hash(key):
+            return False
+
+        if layout == 'hash':
+            fields = db.execute('hgetall', key)
+            payload = db.db.load_fields(fields)
+            args = ['hash', db.db.dump_object(payload)]
+            for field, value in fields.items():
+                args += [field, value]
+        else:
+            data = db.execute('get', key)
+            payload = db.db.load_object(data)
+            args = ['string', data]
+            for field, value in db.db.dump_fields(payload).items():
+                args += [field, value]
+
+        if _swap_row(keys=[db.db.object_key(key)], args=args):
+            break
+
+    if db.db.is_cacheable(key):
+        pipe = db.db.pipeline()
+        db.db.publish_change(pipe, key)
+        pipe.execute()
+    return True
+
+
+def migrate_rows(size=500):
+    '''
+    Convert the rows of every table after HASH_ROWS changed.
+    '''
+    count = 0
+    for table in [db.Task, db.Robot, db.User, db.Item]:
+        start = 0
+        while True:
+            idxs = db.Index.range(table.table_name, start, start + size - 1)
+            if not idxs:
+                break
+            for idx in idxs:
+                if migrate_row(':'.join([table.table_name, idx.member])):
+                    count += 1
+            start += size
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('cmd', choices=['fingerprints', 'succeed_counts',
+                                        'ready_tasks', 'shards', 'rows'])
+    args = parser.parse_args()
+
+    if args.cmd == 'fingerprints':
+        print('renamed {} links'.format(migrate_fingerprints()))
+    elif args.cmd == 'succeed_counts':
+        print('moved {} minute buckets'.format(migrate_succeed_counts()))
+    elif args.cmd == 'ready_tasks':
+        print('checked {} tasks'.format(migrate_ready_tasks()))
+    elif args.cmd == 'rows':
+        print('converted {} rows'.format(migrate_rows()))
+    else:
+        print('resubmitted {} jobs'.format(migrate_shards()))
+
+
+if __name__ == '__main__':
+    main()
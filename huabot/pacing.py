@@ -0,0 +1,88 @@
+'''
+Token bucket pacing for the scheduler loops.
+
+A ``Pacer`` keeps one bucket per key (a robot id, a host): ``burst``
+requests go out back to back, then ``rate`` per second. Buckets live in
+the scheduler process, so the limits hold per process.
+'''
+import asyncio
+from time import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time()
+
+    def take(self):
+        '''
+        Take a token: 0 when it was there, else the seconds to wait before
+        asking again.
+        '''
+        now = time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Pacer(object):
+    '''
+    Buckets by key, the least recently used dropped past ``max_keys``. A
+    ``rate`` of 0 turns pacing off.
+    '''
+
+    def __init__(self, rate, burst=1, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def bucket(self, key):
+        bucket = self._buckets.pop(key, None)
+        if not bucket:
+            bucket = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) >= self.max_keys:
+                self._buckets.popitem(last=False)
+        self._buckets[key] = bucket
+        return bucket
+
+    @asyncio.coroutine
+    def wait(self, key, deadline=None):
+        '''
+        Wait for a token of ``key``. Returns False, without waiting, when
+        the token would come after ``deadline``.
+        '''
+        if self.rate <= 0:
+            return True
+
+        bucket = self.bucket(key)
+        while True:
+            delay = bucket.take()
+            if not delay:
+                return True
+            if deadline and time() + delay > deadline:
+                return False
+            yield from asyncio.sleep(delay)
+
+
+def idle_delay(misses, base=0.05, cap=2):
+    '''
+    Back off after ``misses`` empty picks in a row: 0.05s, 0.1s, 0.2s ...
+    up to ``cap``.
+    '''
+    if misses <= 0:
+        return 0
+    return min(base * 2 ** (misses - 1), cap)
+
+
+def host_of(url):
+    return urlsplit(url).netloc.lower()
@@ -1,18 +1,158 @@
 import os
+import asyncio
+from time import time
 from aio_periodic import Client
+from .utils import shard_of, shard_func
+from .db import Schedable
 
 
 if not os.environ.get('PERIODIC_PORT'):
     os.environ['PERIODIC_PORT'] = "unix:///tmp/periodic.sock"
 
+PERIODIC_POOL_SIZE = int(os.environ.get('PERIODIC_POOL_SIZE', 4))
+PERIODIC_PIPELINE_DEPTH = int(os.environ.get('PERIODIC_PIPELINE_DEPTH', 200))
+
+
+class ClientPool(object):
+    '''
+    Long lived periodic clients shared by everything in the process.
+
+    At most ``size`` commands run at once, each on its own connection. A
+    connection idle for more than ``ping_interval`` seconds is pinged
+    before reuse. A command that fails or times out drops the connections
+    and is retried once on a fresh one.
+    '''
+
+    def __init__(self, entrypoint=None, size=PERIODIC_POOL_SIZE, timeout=10,
+                 ping_interval=30):
+        self.entrypoint = entrypoint
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self._idle = []
+        self._sem = asyncio.Semaphore(size)
+
+    @asyncio.coroutine
+    def _connect(self):
+        client = Client()
+        client.add_server(self.entrypoint or os.environ['PERIODIC_PORT'])
+        yield from asyncio.wait_for(client.connect(), self.timeout)
+        return client
+
+    @asyncio.coroutine
+    def _healthy(self, client, used_at):
+        if time() - used_at < self.ping_interval:
+            return True
+        try:
+            return (yield from asyncio.wait_for(client.ping(), self.timeout))
+        except Exception:
+            return False
+
+    @asyncio.coroutine
+    def acquire(self):
+        yield from self._sem.acquire()
+        try:
+            while self._idle:
+                client, used_at = self._idle.pop()
+                if (yield from self._healthy(client, used_at)):
+                    return client
+                client.close()
+
+            return (yield from self._connect())
+        except BaseException:
+            self._sem.release()
+            raise
+
+    def release(self, client, broken=False):
+        if broken:
+            client.close()
+        else:
+            self._idle.append((client, time()))
+        self._sem.release()
+
+    @asyncio.coroutine
+    def execute(self, cmd, *args, retry=1):
+        client = yield from self.acquire()
+        try:
+            ret = yield from asyncio.wait_for(getattr(client, cmd)(*args),
+                                              self.timeout)
+        except asyncio.CancelledError:
+            self.release(client, True)
+            raise
+        except Exception:
+            self.release(client, True)
+            if retry <= 0:
+                raise
+            # the idle connections most likely went down with this one
+            self.close()
+            return (yield from self.execute(cmd, *args, retry=retry - 1))
+
+        self.release(client)
+        return ret
+
+    @asyncio.coroutine
+    def _pipeline(self, client, cmd, batch):
+        futures = [asyncio.wait_for(getattr(client, cmd)(*args), self.timeout)
+                   for args in batch]
+        return (yield from asyncio.gather(*futures, return_exceptions=True))
+
+    @asyncio.coroutine
+    def execute_many(self, cmd, batch, depth=PERIODIC_PIPELINE_DEPTH,
+                     retry=1):
+        '''
+        Run ``cmd`` once per args tuple of ``batch`` on one connection,
+        writing up to ``depth`` frames before waiting for their replies.
+        Returns the results in order; commands that failed are retried
+        once on a fresh connection and come back as their exception if
+        they fail again. The commands never sent after the last failed
+        chunk come back as its exception as well.
+        '''
+        rets = [None] * len(batch)
+        pending = list(range(len(batch)))
+        while pending:
+            client = yield from self.acquire()
+            failed = []
+            unsent = []
+            try:
+                for start in range(0, len(pending), depth):
+                    idxs = pending[start:start + depth]
+                    results = yield from self._pipeline(
+                        client, cmd, [batch[i] for i in idxs])
+                    for i, ret in zip(idxs, results):
+                        rets[i] = ret
+                        if isinstance(ret, Exception):
+                            failed.append(i)
+                            error = ret
+                    if failed:
+                        unsent = pending[start + depth:]
+                        failed.extend(unsent)
+                        break
+            except BaseException:
+                self.release(client, True)
+                raise
+
+            self.release(client, bool(failed))
+            if not failed or retry <= 0:
+                for i in unsent:
+                    rets[i] = error
+                break
+            self.close()
+            pending = failed
+            retry -= 1
+
+        return rets
+
+    def close(self):
+        while self._idle:
+            client, _ = self._idle.pop()
+            client.close()
+
+
+pool = ClientPool()
+
 
 def submit_job(job):
-    client = Client()
-    client.add_server(os.environ['PERIODIC_PORT'])
-    yield from client.connect()
-    ret = yield from client.submitJob(job)
-    client.close()
-    return ret
+    return (yield from pool.execute('submitJob', job))
 
 
 def remove_job(func, name):
@@ -20,53 +160,94 @@ def remove_job(func, name):
         "name": name,
         "func": func
     }
-    client = Client()
-    client.add_server(os.environ['PERIODIC_PORT'])
-    yield from client.connect()
-    ret = yield from client.removeJob(data)
-    client.close()
-    return ret
+    return (yield from pool.execute('removeJob', data))
 
 
-def sched_robot(robot):
-    data = {
+def submit_jobs(jobs):
+    return (yield from pool.execute_many('submitJob',
+                                         [(job,) for job in jobs]))
+
+
+def remove_sharded_jobs(func, names):
+    return (yield from pool.execute_many(
+        'removeJob', [({"name": int(name),
+                        "func": shard_func(func, shard_of(name))},)
+                      for name in names]))
+
+
+def robot_job(robot):
+    return {
         'name': str(robot.index),
-        'func': 'process_robot',
+        'func': shard_func('process_robot', shard_of(robot.index)),
         'sched_at': int(robot.sched_at),
         'timeout': 500
     }
 
-    return (yield from submit_job(data))
+
+def task_job(task):
+    return {
+        'name': str(task.index),
+        'func': shard_func('update_task', shard_of(task.index)),
+        'sched_at': int(task.sched_at),
+        'timeout': 500
+    }
+
+
+def sched_robot(robot):
+    return (yield from submit_job(robot_job(robot)))
+
+
+def sched_robots(robots):
+    robots = list(robots)
+    Schedable.load_sched_at(robots)
+    return (yield from submit_jobs(map(robot_job, robots)))
 
 
 def remove_robot(robot):
-    return (yield from remove_job('process_robot', int(robot.index)))
+    func = shard_func('process_robot', shard_of(robot.index))
+    return (yield from remove_job(func, int(robot.index)))
+
+
+def remove_robots(robots):
+    return (yield from remove_sharded_jobs('process_robot',
+                                           [robot.index for robot in robots]))
 
 
 def sched_task(task):
-    data = {
-        'name': str(task.index),
-        'func': 'update_task',
-        'sched_at': int(task.sched_at),
-        'timeout': 500
-    }
+    return (yield from submit_job(task_job(task)))
+
 
-    return (yield from submit_job(data))
+def sched_tasks(tasks):
+    tasks = list(tasks)
+    Schedable.load_sched_at(tasks)
+    return (yield from submit_jobs(map(task_job, tasks)))
 
 
 def remove_task(task):
-    return (yield from remove_job('update_task', int(task.index)))
+    func = shard_func('update_task', shard_of(task.index))
+    return (yield from remove_job(func, int(task.index)))
+
+
+def remove_tasks(tasks):
+    return (yield from remove_sharded_jobs('update_task',
+                                           [task.index for task in tasks]))
 
 
 def status(funcName=""):
-    client = Client()
-    client.add_server(os.environ['PERIODIC_PORT'])
-    yield from client.connect()
-    ret = yield from client.status()
-    client.close()
+    ret = yield from pool.execute('status')
 
     if funcName:
-        return ret.get(funcName, {})
+        # sum the shards of funcName, see ENGINE_SHARDS
+        stats = [stat for name, stat in ret.items()
+                 if name == funcName or name.startswith(funcName + ':')]
+        if not stats:
+            return {}
+        if len(stats) == 1:
+            return stats[0]
+        total = {'func_name': funcName}
+        for key in ['worker_count', 'job_count', 'processing']:
+            total[key] = sum(stat.get(key, 0) for stat in stats)
+        return total
 
     return {}
 
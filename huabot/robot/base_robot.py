@@ -1,5 +1,6 @@
 import asyncio
 from .. import db
+from ..metrics import timed
 
 
 class RobotError(Exception):
@@ -13,6 +14,9 @@ class BaseRobot(object):
         self.loop = loop
         if not self.loop:
             self.loop = asyncio.get_event_loop()
+        # the subclasses override process, so it is timed per instance
+        self.process = timed('robot_process', {
+            'robot': self.__class__.__name__})(self.process)
 
     @asyncio.coroutine
     def activate(self):
@@ -23,9 +27,8 @@ class BaseRobot(object):
         raise NotImplementedError('you must rewrite at sub class')
 
     def set_success(self, item):
-        self._robot.incr_succeed_count()
-        db.Task(item['task_id']).incr_succeed_count()
-        db.User(self._robot.user_id).incr_succeed_count()
+        db.Countable.incr_succeed_counts(self._robot, db.Task(item['task_id']),
+                                         db.User(self._robot.user_id))
 
     def set_error(self, item):
         pass
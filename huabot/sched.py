@@ -2,7 +2,12 @@ from grapy.core import BaseScheduler
 from grapy.core.exceptions import RetryRequest
 import asyncio
 from .utils import hash_url, SpecDict, random_delay, logger, get_cls_name
+from .utils import fingerprint, PACE_ROBOT_RATE, PACE_ROBOT_BURST
+from .utils import PACE_HOST_RATE, PACE_HOST_BURST
+from .utils import shard_func, METRICS, METRICS_INTERVAL
+from .pacing import Pacer, idle_delay, host_of
 from . import db
+from . import metrics
 import random
 from time import time
 from datetime import datetime
@@ -14,13 +19,17 @@ import os
 
 
 class RobotBased(object):
-    def __init__(self, pool_size, loop=None):
+    func = 'process_robot'
+
+    def __init__(self, pool_size, loop=None, shard=0):
         self.started = False
+        self.func_name = shard_func(self.func, shard)
         self.connect_lock = asyncio.Lock()
         self.grabJob_lock = asyncio.Lock()
         self.alive = True
         self.tasks = []
         self.pool = Pool(self.init_worker, pool_size, 500)
+        self.compact_interval = 3600
 
         self.loop = loop
         if not self.loop:
@@ -32,12 +41,12 @@ class RobotBased(object):
         client = Worker()
         client.add_server(os.environ["PERIODIC_PORT"])
         yield from client.connect()
-        yield from client.add_func("process_robot")
+        yield from client.add_func(self.func_name)
         return client
 
     def run(self, job):
 
-        if job.func_name != 'process_robot':
+        if job.func_name != self.func_name:
             return
 
         try:
@@ -70,7 +79,35 @@ class RobotBased(object):
     def start(self):
         if self.started:
             return
+        # link queues filled before task:ready existed
+        if not db.execute('exists', db.Task.ready_key()):
+            db.Task.rebuild_ready()
         asyncio.Task(self._start())
+        asyncio.Task(self._compact())
+        if METRICS:
+            asyncio.Task(self._publish_metrics())
+
+    def _compact(self):
+        while self.alive:
+            try:
+                if db.lock_compact_succeed_counts(self.compact_interval):
+                    for _ in db.compact_succeed_counts():
+                        if not self.alive:
+                            break
+                        yield from asyncio.sleep(0)
+            except Exception as e:
+                logger.exception(e)
+
+            yield from asyncio.sleep(self.compact_interval)
+
+    def _publish_metrics(self):
+        while self.alive:
+            try:
+                metrics.publish(db.db, METRICS_INTERVAL * 4)
+            except Exception as e:
+                logger.exception(e)
+
+            yield from asyncio.sleep(METRICS_INTERVAL)
 
     def _start(self):
         self.started = True
@@ -116,14 +153,19 @@ class RobotBased(object):
 
         print("signal close")
 
-        task = asyncio.Task(asyncio.wait(self.tasks))
-        task.add_done_callback(lambda t: self.engine.shutdown())
-        # self.loop.call_later(600, self.engine.shutdown)
+        # the engine returns from run_forever once the running jobs are
+        # done; closing the loop from inside it would only raise
+        if not self.tasks:
+            self.loop.stop()
+            return
+        task = asyncio.Task(asyncio.wait(list(self.tasks)), loop=self.loop)
+        task.add_done_callback(lambda t: self.loop.stop())
 
     def push_item(self, item, force_submit=False):
         try:
             robot = db.Robot(item['robot_id'])
-            if force_submit or robot.one_by_one is not True:
+            one_by_one, = robot.get_fields('one_by_one')
+            if force_submit or one_by_one is not True:
                 yield from self.submit_item(item)
             else:
                 self.save_item(item)
@@ -141,11 +183,13 @@ class CommonScheduler(BaseScheduler):
             self.loop = asyncio.get_event_loop()
 
         self._sem = asyncio.Semaphore(tasks)
-        self._item_lock = asyncio.Lock()
         self._process_on_task = True
+        self.robot_pacer = Pacer(PACE_ROBOT_RATE, PACE_ROBOT_BURST)
+        self.host_pacer = Pacer(PACE_HOST_RATE, PACE_HOST_BURST)
 
+    @metrics.timed('push_req')
     def push_req(self, req):
-        key = hash_url(req.url)
+        key = fingerprint(req.url)
         group = int(req.group)
         task = db.Task(group)
         if not task.payload:
@@ -170,10 +214,9 @@ class CommonScheduler(BaseScheduler):
             robot.remove_sched()
             return
 
-        item_subscribe = []
-        for tid in robot.subscribe:
-            if db.Item.count_by_index("task_id", tid) > 0:
-                item_subscribe.append(tid)
+        counts = db.Item.counts_by_index("task_id", robot.subscribe)
+        item_subscribe = [tid for tid, count in zip(robot.subscribe, counts)
+                          if count > 0]
 
         if item_subscribe:
             yield from self.process_on_item(robot, item_subscribe)
@@ -181,9 +224,7 @@ class CommonScheduler(BaseScheduler):
 
         subscribe = []
         if self._process_on_task:
-            for tid in robot.subscribe:
-                if db.Task(tid).link_count() > 0:
-                    subscribe.append(tid)
+            subscribe = db.Task.ready(robot.subscribe)
 
         if not subscribe:
             robot.payload['alive'] = False
@@ -195,9 +236,10 @@ class CommonScheduler(BaseScheduler):
 
     def task_main(self, task):
         while True:
+            # an empty pop already dropped the task from task:ready, the
+            # queue itself may be refilled meanwhile
             hash_url = task.link_pop()
             if not hash_url:
-                task.link_drop()
                 break
 
             link = db.Link(hash_url)
@@ -205,6 +247,8 @@ class CommonScheduler(BaseScheduler):
             if not req:
                 break
 
+            yield from self.host_pacer.wait(host_of(req.url))
+
             callback_args = list(req.callback_args)
             callback_args.append(SpecDict({
                 'task_id': int(req.group),
@@ -220,34 +264,43 @@ class CommonScheduler(BaseScheduler):
                 logger.exception(e)
                 task.link_push(hash_url)
 
+    @metrics.timed('process_on_task')
     def process_on_task(self, robot, subscribe):
         robot_succeed_count = robot.succeed_count
         start_time = time()
         stop_time = start_time + 300
         none_count = 0
         none_limit = 10
+        misses = 0
 
         while True:
-            yield from asyncio.sleep(1)
+            yield from asyncio.sleep(idle_delay(misses))
             if time() > stop_time or none_count > none_limit:
                 break
 
-            task_id = random.choice(subscribe)
-
-            task = db.Task(task_id)
+            if not (yield from self.robot_pacer.wait(robot.index, stop_time)):
+                break
 
-            hash_url = task.link_pop()
+            task_id, hash_url = db.Task.pick_link(subscribe, random.random())
             if not hash_url:
                 none_count += 1
-                task.link_drop()
+                misses += 1
                 continue
 
+            task = db.Task(task_id)
             link = db.Link(hash_url)
             req = link.req
             if not req:
                 none_count += 1
+                misses += 1
                 continue
 
+            misses = 0
+            if not (yield from self.host_pacer.wait(host_of(req.url),
+                                                    stop_time)):
+                task.link_push(hash_url)
+                break
+
             callback_args = list(req.callback_args)
             callback_args.append(SpecDict({
                 'robot_id': robot.index,
@@ -270,44 +323,27 @@ class CommonScheduler(BaseScheduler):
             if robot.succeed_count > robot_succeed_count or robot.one_by_one is True:
                 break
 
+    @metrics.timed('process_on_item')
     def process_on_item(self, robot, subscribe):
         robot_succeed_count = robot.succeed_count
         start_time = time()
         stop_time = start_time + 100
-        none_count = 0
-        none_limit = 10
-
         while True:
-            yield from asyncio.sleep(1)
-            if time() > stop_time or none_count > none_limit:
+            if time() > stop_time or not subscribe:
                 break
 
-            if not subscribe:
+            if not (yield from self.robot_pacer.wait(robot.index, stop_time)):
                 break
 
             task_id = random.choice(subscribe)
-            with (yield from self._item_lock):
-
-                item_id = db.Item.pop_queue(task_id)
-
-                if not item_id:
-                    db.Item.drop_queue(task_id)
-                    subscribe.remove(task_id)
-                    if not subscribe:
-                        break
-                    continue
-
-                item = db.Item(item_id)
-                if not item.payload:
+            item = db.Item.claim(task_id)
+            if not item:
+                if item is None:
                     subscribe.remove(task_id)
-                    item.payload['user_id'] = robot.user_id
-                    item.payload['task_id'] = task_id
-                    item.delete()
-                    continue
+                continue
 
-                pin_item = import_module(item.cls_name, item.payload)
-                pin_item["robot_id"] = robot.index
-                item.delete()
+            pin_item = import_module(item.cls_name, item.payload)
+            pin_item["robot_id"] = robot.index
 
             try:
                 yield from self.push_item(pin_item, True)
@@ -327,14 +363,14 @@ class CommonScheduler(BaseScheduler):
 
 
 class RobotBasedScheduler(RobotBased, CommonScheduler):
-    def __init__(self, tasks=4, loop=None):
-        RobotBased.__init__(self, tasks * 2)
+    def __init__(self, tasks=4, loop=None, shard=0):
+        RobotBased.__init__(self, tasks * 2, loop=loop, shard=shard)
         CommonScheduler.__init__(self, tasks=tasks, loop=loop)
 
 
 class RobotOnlyScheduler(RobotBasedScheduler):
-    def __init__(self, tasks=4, loop=None):
-        RobotBasedScheduler.__init__(self, tasks, loop)
+    def __init__(self, tasks=4, loop=None, shard=0):
+        RobotBasedScheduler.__init__(self, tasks, loop, shard)
         self._process_on_task = False
 
     def push_item(self, item, force_summit=True):
@@ -342,17 +378,11 @@ class RobotOnlyScheduler(RobotBasedScheduler):
 
 
 class TaskBased(RobotBased):
-
-    def init_worker(self):
-        client = Worker()
-        client.add_server(os.environ["PERIODIC_PORT"])
-        yield from client.connect()
-        yield from client.add_func("process_task")
-        return client
+    func = 'process_task'
 
     def run(self, job):
 
-        if job.func_name != 'process_task':
+        if job.func_name != self.func_name:
             return
 
         try:
@@ -388,6 +418,6 @@ class TaskBased(RobotBased):
             logger.exception(e)
 
 class TaskScheduler(TaskBased, CommonScheduler):
-    def __init__(self, tasks=4, loop=None):
-        TaskBased.__init__(self, tasks * 2)
+    def __init__(self, tasks=4, loop=None, shard=0):
+        TaskBased.__init__(self, tasks * 2, loop=loop, shard=shard)
         CommonScheduler.__init__(self, tasks=tasks, loop=loop)
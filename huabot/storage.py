@@ -0,0 +1,1354 @@
+'''
+Storage backends of ``huabot.db.DB``.
+
+A backend is a client speaking the part of the redis-py ``StrictRedis``
+API huabot uses: strings, hashes, sets, lists and sorted sets, key expiry,
+SCAN, ``pipeline()`` and ``publish``, with redis' replies (bytes values,
+float scores, ``ResponseError`` on a wrong type). ``DB`` creates it on
+first use, so importing huabot does not connect anywhere.
+
+``redis`` is the real thing. ``memory`` keeps everything in the process:
+a fast single process mode for small deployments and tests, and a
+baseline for the cost of redis itself. It has no lua, the scripts of
+``DB.register_script`` run their python twin instead; nothing else can
+interleave with one, just as with EVALSHA. It is not shared between
+processes, so the engine and the api must run in the same one, which
+``check_shared`` enforces at startup, and its data is lost on exit.
+
+``sqlite`` keeps the same data on disk for single node deployments, shared
+by the processes of the node, see ``SqliteStorage``. It runs the python
+scripts too, each in one transaction.
+'''
+import os
+import sqlite3
+import hashlib
+import fnmatch
+from time import time
+from bisect import bisect_left, insort
+from itertools import islice
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+import redis
+from redis.exceptions import RedisError, ResponseError
+from .utils import DB_BACKEND, REDIS_HOST, REDIS_PORT, METRICS, DB_PREFIX
+from .utils import DB_SQLITE_PATH, DB_SQLITE_MMAP
+
+
+class Script(object):
+    '''
+    A lua script registered with ``DB.register_script``, with its python
+    twin ``fallback(client, keys, args)`` for the backends without lua.
+    The redis one is registered on first call.
+    '''
+
+    def __init__(self, db, script, fallback=None):
+        self.db = db
+        self.script = script
+        self.fallback = fallback
+        self.sha = hashlib.sha1(script.encode('utf-8')).hexdigest()
+        self._script = None
+
+    def __call__(self, keys=[], args=[]):
+        client = self.db._db
+        if not getattr(client, 'scripting', True):
+            if self.fallback is None:
+                raise NotImplementedError(
+                    'no python fallback for script {}'.format(self.sha))
+            with client.atomic():
+                return self.fallback(client, list(keys), list(args))
+
+        if self._script is None:
+            self._script = client.register_script(self.script)
+        return self._script(keys=keys, args=args)
+
+
+def _encode(value):
+    '''
+    What redis stores for ``value``, as redis-py encodes it.
+
+    >>> _encode('a'), _encode(1), _encode(1.5), _encode(b'b')
+    (b'a', b'1', b'1.5', b'b')
+    '''
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode('utf-8')
+    return str(value).encode('utf-8')
+
+
+def _score(value):
+    '''
+    A score bound of ZRANGEBYSCORE: ``(value, exclusive)``.
+
+    >>> _score('-inf'), _score('(5'), _score(3)
+    ((-inf, False), (5.0, True), (3.0, False))
+    '''
+    value = _encode(value).decode('utf-8')
+    if value.startswith('('):
+        return float(value[1:]), True
+    return float(value), False
+
+
+def _slice(length, start, end):
+    '''
+    LRANGE/ZRANGE ``start`` and inclusive ``end`` as a python slice.
+
+    >>> _slice(10, 0, -1), _slice(10, -3, -2), _slice(10, 5, 2)
+    ((0, 10), (7, 9), (5, 5))
+    '''
+    start, end = int(start), int(end)
+    if start < 0:
+        start = max(length + start, 0)
+    if end < 0:
+        end += length
+    end = min(end + 1, length)
+    return start, max(start, end)
+
+
+def _limit(start, num):
+    '''
+    ZRANGEBYSCORE ``LIMIT start num`` as a python slice, both or neither
+    given like redis-py wants; a negative ``num`` is all from ``start``.
+
+    >>> _limit(None, None), _limit(2, 3), _limit(2, -1)
+    (slice(None, None, None), slice(2, 5, None), slice(2, None, None))
+    '''
+    if start is None and num is None:
+        return slice(None)
+    if start is None or num is None:
+        raise RedisError("``start`` and ``num`` must both be specified")
+    start, num = int(start), int(num)
+    return slice(start, start + num if num >= 0 else None)
+
+
+class SortedSet(object):
+    '''
+    Member scores plus the ``(score, member)`` pairs kept in order.
+    '''
+
+    def __init__(self):
+        self.scores = {}
+        self.order = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score):
+        old = self.scores.get(member)
+        if old is not None:
+            if old == score:
+                return False
+            del self.order[bisect_left(self.order, (old, member))]
+        self.scores[member] = score
+        insort(self.order, (score, member))
+        return old is None
+
+    def remove(self, member):
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        del self.order[bisect_left(self.order, (score, member))]
+        return True
+
+    def by_score(self, min, max):
+        low, low_open = _score(min)
+        high, high_open = _score(max)
+        start = bisect_left(self.order, (low, b''))
+        if low_open:
+            while start < len(self.order) and self.order[start][0] == low:
+                start += 1
+        ret = []
+        for score, member in islice(self.order, start, None):
+            if score > high or (high_open and score == high):
+                break
+            ret.append((score, member))
+        return ret
+
+
+class LocalPipeline(object):
+    '''
+    Queues commands and runs them in one go on ``execute``. As a
+    transaction it runs inside ``client.atomic()``, so it is a MULTI/EXEC
+    either way, taking the write lock only when a queued command writes;
+    with ``transaction=False`` the commands run one by one.
+    '''
+
+    def __init__(self, client, transaction=True):
+        self.client = client
+        self.transaction = transaction
+        self.commands = []
+
+    def __getattr__(self, name):
+        func = getattr(self.client, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((func, args, kwargs))
+            return self
+        return queue
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def reset(self):
+        self.commands = []
+
+    def _run(self, commands):
+        rets = []
+        for func, args, kwargs in commands:
+            try:
+                rets.append(func(*args, **kwargs))
+            except ResponseError as e:
+                rets.append(e)
+        return rets
+
+    def execute(self, raise_on_error=True):
+        commands, self.commands = self.commands, []
+        if self.transaction:
+            write = any(getattr(func, 'writes', False)
+                        for func, _, _ in commands)
+            with self.client.atomic(write):
+                rets = self._run(commands)
+        else:
+            rets = self._run(commands)
+        if raise_on_error:
+            for ret in rets:
+                if isinstance(ret, ResponseError):
+                    raise ret
+        return rets
+
+
+# the TYPE reply for each value class of MemoryStorage
+MEMORY_TYPES = {
+    bytearray: b'string',
+    dict: b'hash',
+    set: b'set',
+    deque: b'list',
+    SortedSet: b'zset',
+}
+
+
+class MemoryStorage(object):
+    scripting = False
+    # the data of one process, see check_shared
+    shared = False
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+
+    # keys
+
+    def _lookup(self, name, kind=None, create=False):
+        name = _encode(name)
+        expires_at = self._expires.get(name)
+        if expires_at is not None and expires_at <= time():
+            self._data.pop(name, None)
+            del self._expires[name]
+
+        value = self._data.get(name)
+        if value is None:
+            if not create:
+                return None
+            value = self._data[name] = kind()
+        elif kind is not None and not isinstance(value, kind):
+            raise ResponseError('WRONGTYPE Operation against a key holding '
+                                'the wrong kind of value')
+        return value
+
+    def _drop_empty(self, name, value):
+        if not value:
+            self._delete(_encode(name))
+
+    def _delete(self, name):
+        self._expires.pop(name, None)
+        return self._data.pop(name, None) is not None
+
+    def delete(self, *names):
+        return sum(1 for name in names if self._lookup(name) is not None and
+                   self._delete(_encode(name)))
+
+    unlink = delete
+
+    def exists(self, name):
+        return self._lookup(name) is not None
+
+    def type(self, name):
+        value = self._lookup(name)
+        if value is None:
+            return b'none'
+        return MEMORY_TYPES[value.__class__]
+
+    def expire(self, name, time_):
+        if self._lookup(name) is None:
+            return False
+        self._expires[_encode(name)] = time() + int(time_)
+        return True
+
+    def ttl(self, name):
+        if self._lookup(name) is None:
+            return -2
+        expires_at = self._expires.get(_encode(name))
+        if expires_at is None:
+            return -1
+        return max(int(round(expires_at - time())), 0)
+
+    def rename(self, src, dst):
+        value = self._lookup(src)
+        if value is None:
+            raise ResponseError('no such key')
+        src, dst = _encode(src), _encode(dst)
+        expires_at = self._expires.pop(src, None)
+        self._delete(dst)
+        self._data[dst] = self._data.pop(src)
+        if expires_at is not None:
+            self._expires[dst] = expires_at
+        return True
+
+    def renamenx(self, src, dst):
+        if self._lookup(dst) is not None:
+            if self._lookup(src) is None:
+                raise ResponseError('no such key')
+            return False
+        return self.rename(src, dst)
+
+    def scan_iter(self, match=None, count=None):
+        for name in list(self._data):
+            if self._lookup(name) is None:
+                continue
+            if match is None or fnmatch.fnmatchcase(
+                    name.decode('utf-8', 'replace'), _encode(match).decode(
+                        'utf-8', 'replace')):
+                yield name
+
+    def scan(self, cursor=0, match=None, count=None):
+        return 0, list(self.scan_iter(match, count))
+
+    def flushdb(self):
+        self._data.clear()
+        self._expires.clear()
+        return True
+
+    def info(self, section=None):
+        return {'redis_version': 'memory', 'db0': {'keys': len(self._data)}}
+
+    def ping(self):
+        return True
+
+    def publish(self, channel, message):
+        return 0
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return LocalPipeline(self, transaction)
+
+    @contextmanager
+    def atomic(self, write=True):
+        # one thread, and nothing here yields to the event loop
+        yield
+
+    # strings
+
+    def get(self, name):
+        value = self._lookup(name, bytearray)
+        return bytes(value) if value is not None else None
+
+    def mget(self, keys, *args):
+        if isinstance(keys, (bytes, str)):
+            keys = [keys]
+        # like redis, a key of another type reads as missing
+        return [self.get(name) if isinstance(self._lookup(name), bytearray)
+                else None for name in list(keys) + list(args)]
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        exists = self._lookup(name) is not None
+        if (nx and exists) or (xx and not exists):
+            return None
+        name = _encode(name)
+        self._delete(name)
+        self._data[name] = bytearray(_encode(value))
+        if ex is not None:
+            self._expires[name] = time() + int(ex)
+        elif px is not None:
+            self._expires[name] = time() + int(px) / 1000.0
+        return True
+
+    def setex(self, name, time_, value):
+        return self.set(name, value, ex=time_)
+
+    def incrby(self, name, amount=1):
+        value = self._lookup(name, bytearray)
+        try:
+            value = int(value or 0) + int(amount)
+        except ValueError:
+            raise ResponseError('value is not an integer or out of range')
+        expires_at = self._expires.get(_encode(name))
+        self._data[_encode(name)] = bytearray(_encode(value))
+        if expires_at is not None:
+            self._expires[_encode(name)] = expires_at
+        return value
+
+    incr = incrby
+
+    def getbit(self, name, offset):
+        value = self._lookup(name, bytearray)
+        byte, bit = divmod(int(offset), 8)
+        if value is None or byte >= len(value):
+            return 0
+        return (value[byte] >> (7 - bit)) & 1
+
+    def setbit(self, name, offset, value):
+        data = self._lookup(name, bytearray, True)
+        byte, bit = divmod(int(offset), 8)
+        if byte >= len(data):
+            data.extend(bytes(byte + 1 - len(data)))
+        old = (data[byte] >> (7 - bit)) & 1
+        if int(value):
+            data[byte] |= 1 << (7 - bit)
+        else:
+            data[byte] &= ~(1 << (7 - bit)) & 0xff
+        return old
+
+    # hashes
+
+    def hget(self, name, key):
+        value = self._lookup(name, dict)
+        return value.get(_encode(key)) if value is not None else None
+
+    def hmget(self, name, keys, *args):
+        value = self._lookup(name, dict) or {}
+        if isinstance(keys, (bytes, str)):
+            keys = [keys]
+        return [value.get(_encode(key)) for key in list(keys) + list(args)]
+
+    def hgetall(self, name):
+        return dict(self._lookup(name, dict) or {})
+
+    def hkeys(self, name):
+        return list(self._lookup(name, dict) or {})
+
+    def hlen(self, name):
+        return len(self._lookup(name, dict) or {})
+
+    def hexists(self, name, key):
+        return _encode(key) in (self._lookup(name, dict) or {})
+
+    def hset(self, name, key, value):
+        data = self._lookup(name, dict, True)
+        key = _encode(key)
+        new = key not in data
+        data[key] = _encode(value)
+        return int(new)
+
+    def hmset(self, name, mapping):
+        data = self._lookup(name, dict, True)
+        for key, value in mapping.items():
+            data[_encode(key)] = _encode(value)
+        return True
+
+    def hdel(self, name, *keys):
+        data = self._lookup(name, dict)
+        if data is None:
+            return 0
+        ret = sum(1 for key in keys if data.pop(_encode(key), None)
+                  is not None)
+        self._drop_empty(name, data)
+        return ret
+
+    def hincrby(self, name, key, amount=1):
+        data = self._lookup(name, dict, True)
+        key = _encode(key)
+        value = int(data.get(key, 0)) + int(amount)
+        data[key] = _encode(value)
+        return value
+
+    # sets
+
+    def sadd(self, name, *values):
+        data = self._lookup(name, set, True)
+        size = len(data)
+        data.update(_encode(value) for value in values)
+        return len(data) - size
+
+    def srem(self, name, *values):
+        data = self._lookup(name, set)
+        if data is None:
+            return 0
+        size = len(data)
+        data.difference_update(_encode(value) for value in values)
+        ret = size - len(data)
+        self._drop_empty(name, data)
+        return ret
+
+    def spop(self, name):
+        data = self._lookup(name, set)
+        if not data:
+            return None
+        member = data.pop()
+        self._drop_empty(name, data)
+        return member
+
+    def smembers(self, name):
+        return set(self._lookup(name, set) or ())
+
+    def scard(self, name):
+        return len(self._lookup(name, set) or ())
+
+    def sismember(self, name, value):
+        return _encode(value) in (self._lookup(name, set) or ())
+
+    def sscan(self, name, cursor=0, match=None, count=None):
+        members = [member for member in self._lookup(name, set) or ()
+                   if match is None or fnmatch.fnmatchcase(
+                       member.decode('utf-8', 'replace'), match)]
+        return 0, members
+
+    # lists
+
+    def lpush(self, name, *values):
+        data = self._lookup(name, deque, True)
+        data.extendleft(_encode(value) for value in values)
+        return len(data)
+
+    def rpush(self, name, *values):
+        data = self._lookup(name, deque, True)
+        data.extend(_encode(value) for value in values)
+        return len(data)
+
+    def lpop(self, name):
+        data = self._lookup(name, deque)
+        if not data:
+            return None
+        value = data.popleft()
+        self._drop_empty(name, data)
+        return value
+
+    def rpop(self, name):
+        data = self._lookup(name, deque)
+        if not data:
+            return None
+        value = data.pop()
+        self._drop_empty(name, data)
+        return value
+
+    def llen(self, name):
+        return len(self._lookup(name, deque) or ())
+
+    def lrange(self, name, start, end):
+        data = self._lookup(name, deque) or ()
+        start, end = _slice(len(data), start, end)
+        return list(islice(data, start, end))
+
+    # sorted sets
+
+    def zadd(self, name, *args, **kwargs):
+        pairs = list(zip(args[1::2], args[::2])) + list(kwargs.items())
+        data = self._lookup(name, SortedSet, True)
+        return sum(1 for member, score in pairs
+                   if data.add(_encode(member), float(score)))
+
+    def zincrby(self, name, value, amount=1):
+        data = self._lookup(name, SortedSet, True)
+        value = _encode(value)
+        score = data.scores.get(value, 0) + float(amount)
+        data.add(value, score)
+        return score
+
+    def zrem(self, name, *values):
+        data = self._lookup(name, SortedSet)
+        if data is None:
+            return 0
+        ret = sum(1 for value in values if data.remove(_encode(value)))
+        self._drop_empty(name, data)
+        return ret
+
+    def zscore(self, name, value):
+        data = self._lookup(name, SortedSet)
+        return data.scores.get(_encode(value)) if data is not None else None
+
+    def zcard(self, name):
+        return len(self._lookup(name, SortedSet) or ())
+
+    def zcount(self, name, min, max):
+        data = self._lookup(name, SortedSet)
+        return len(data.by_score(min, max)) if data is not None else 0
+
+    def _reply(self, pairs, withscores, score_cast_func):
+        if withscores:
+            return [(member, score_cast_func(score))
+                    for score, member in pairs]
+        return [member for _, member in pairs]
+
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        data = self._lookup(name, SortedSet)
+        if data is None:
+            return []
+        order = data.order[::-1] if desc else data.order
+        start, end = _slice(len(order), start, end)
+        return self._reply(order[start:end], withscores, score_cast_func)
+
+    def zrevrange(self, name, start, end, withscores=False,
+                  score_cast_func=float):
+        return self.zrange(name, start, end, True, withscores,
+                           score_cast_func)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        data = self._lookup(name, SortedSet)
+        if data is None:
+            return []
+        pairs = data.by_score(min, max)[_limit(start, num)]
+        return self._reply(pairs, withscores, score_cast_func)
+
+    def zrevrangebyscore(self, name, max, min, start=None, num=None,
+                         withscores=False, score_cast_func=float):
+        data = self._lookup(name, SortedSet)
+        if data is None:
+            return []
+        pairs = data.by_score(min, max)[::-1][_limit(start, num)]
+        return self._reply(pairs, withscores, score_cast_func)
+
+    def zremrangebyscore(self, name, min, max):
+        data = self._lookup(name, SortedSet)
+        if data is None:
+            return 0
+        pairs = data.by_score(min, max)
+        for _, member in pairs:
+            data.remove(member)
+        self._drop_empty(name, data)
+        return len(pairs)
+
+    def zscan(self, name, cursor=0, match=None, count=None,
+              score_cast_func=float):
+        data = self._lookup(name, SortedSet)
+        if data is None:
+            return 0, []
+        return 0, [(member, score_cast_func(score))
+                   for score, member in data.order
+                   if match is None or fnmatch.fnmatchcase(
+                       member.decode('utf-8', 'replace'), match)]
+
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS keys (
+    key TEXT PRIMARY KEY, type TEXT NOT NULL, expires REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS keys_expires ON keys (expires)
+    WHERE expires IS NOT NULL;
+CREATE TABLE IF NOT EXISTS strings (
+    key TEXT PRIMARY KEY, value BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hashes (
+    key TEXT, field BLOB, value BLOB NOT NULL, PRIMARY KEY (key, field)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sets (
+    key TEXT, member BLOB, PRIMARY KEY (key, member)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lists (
+    key TEXT, pos INTEGER, value BLOB NOT NULL, PRIMARY KEY (key, pos)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS zsets (
+    key TEXT, member BLOB, score REAL NOT NULL, PRIMARY KEY (key, member)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS zsets_score ON zsets (key, score, member);
+'''
+
+SQLITE_TABLES = {
+    'string': 'strings',
+    'hash': 'hashes',
+    'set': 'sets',
+    'list': 'lists',
+    'zset': 'zsets',
+}
+
+
+def _atomic(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.atomic():
+            return func(self, *args, **kwargs)
+    # LocalPipeline takes the write lock for these only
+    wrapper.writes = True
+    return wrapper
+
+
+def _key(name):
+    if isinstance(name, bytes):
+        return name.decode('utf-8')
+    return str(name)
+
+
+class SqliteStorage(object):
+    '''
+    Every redis type in its own table of one sqlite file in WAL mode: the
+    engine and api processes share it, readers never wait for the writer
+    and the pages in use are memory mapped, so data far larger than RAM
+    stays cheap to read. The table indexes and unique columns, being
+    sorted sets, are real b-tree indexes on ``(key, score, member)``; the
+    dedup sets and the link queues are rows, not process memory.
+
+    Each write command, script and pipeline queueing one is an IMMEDIATE
+    transaction. A pipeline of reads only is a deferred one, reading one
+    snapshot without the write lock, and a SADD of members the set already
+    holds writes nothing, so processes only checking the dedup sentinels
+    never queue behind a writer.
+    The bitmaps of the bloom dedup are rewritten whole on every SETBIT,
+    the set dedup suits this backend better.
+    '''
+    scripting = False
+    # the expired keys are dropped every that many transactions
+    purge_every = 1000
+
+    def __init__(self, path=DB_SQLITE_PATH, mmap_size=DB_SQLITE_MMAP,
+                 timeout=30):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+        self._depth = 0
+        self._writes = 0
+
+    def _connection(self):
+        # a forked child must not share its parent's connection
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('PRAGMA mmap_size={:d}'.format(self.mmap_size))
+            self._conn.executescript(SQLITE_SCHEMA)
+            self._pid = os.getpid()
+            self._depth = 0
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        return self._connection().execute(sql, params)
+
+    def _one(self, sql, params=()):
+        row = self._execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    @contextmanager
+    def atomic(self, write=True):
+        '''
+        One transaction, IMMEDIATE unless ``write`` is false; nested ones
+        join the outer one.
+        '''
+        conn = self._connection()
+        if self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+
+        conn.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+        self._depth = 1
+        try:
+            yield
+        except BaseException:
+            self._depth = 0
+            conn.execute('ROLLBACK')
+            raise
+        self._depth = 0
+        if write:
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                self._purge()
+        conn.execute('COMMIT')
+
+    def _purge(self):
+        rows = self._execute('SELECT key, type FROM keys WHERE expires <= ?',
+                             (time(),)).fetchall()
+        for key, type_ in rows:
+            self._drop(key, type_)
+
+    # keys
+
+    def _type(self, key):
+        row = self._execute('SELECT type, expires FROM keys WHERE key = ?',
+                            (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time()):
+            return None
+        return row[0]
+
+    def _check(self, name, type_):
+        '''
+        Whether ``name`` holds a ``type_``, raising on another type.
+        '''
+        found = self._type(_key(name))
+        if found is None:
+            return False
+        if found != type_:
+            raise ResponseError('WRONGTYPE Operation against a key holding '
+                                'the wrong kind of value')
+        return True
+
+    def _create(self, name, type_):
+        '''
+        Make sure ``name`` holds a ``type_``, in a write transaction.
+        '''
+        key = _key(name)
+        row = self._execute('SELECT type, expires FROM keys WHERE key = ?',
+                            (key,)).fetchone()
+        if row is not None and row[1] is not None and row[1] <= time():
+            self._drop(key, row[0])
+            row = None
+        if row is None:
+            self._execute('INSERT INTO keys (key, type) VALUES (?, ?)',
+                          (key, type_))
+        elif row[0] != type_:
+            raise ResponseError('WRONGTYPE Operation against a key holding '
+                                'the wrong kind of value')
+        return key
+
+    def _drop(self, key, type_):
+        self._execute('DELETE FROM keys WHERE key = ?', (key,))
+        self._execute('DELETE FROM {} WHERE key = ?'.format(
+            SQLITE_TABLES[type_]), (key,))
+
+    def _drop_empty(self, key, type_):
+        if self._one('SELECT 1 FROM {} WHERE key = ? LIMIT 1'.format(
+                SQLITE_TABLES[type_]), (key,)) is None:
+            self._execute('DELETE FROM keys WHERE key = ?', (key,))
+
+    @_atomic
+    def delete(self, *names):
+        count = 0
+        for name in names:
+            key = _key(name)
+            row = self._execute('SELECT type, expires FROM keys '
+                                'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                continue
+            if row[1] is None or row[1] > time():
+                count += 1
+            self._drop(key, row[0])
+        return count
+
+    unlink = delete
+
+    def exists(self, name):
+        return self._type(_key(name)) is not None
+
+    def type(self, name):
+        return (self._type(_key(name)) or 'none').encode('utf-8')
+
+    @_atomic
+    def expire(self, name, time_):
+        if not self.exists(name):
+            return False
+        self._execute('UPDATE keys SET expires = ? WHERE key = ?',
+                      (time() + int(time_), _key(name)))
+        return True
+
+    def ttl(self, name):
+        if not self.exists(name):
+            return -2
+        expires_at = self._one('SELECT expires FROM keys WHERE key = ?',
+                               (_key(name),))
+        if expires_at is None:
+            return -1
+        return max(int(round(expires_at - time())), 0)
+
+    @_atomic
+    def rename(self, src, dst):
+        src, dst = _key(src), _key(dst)
+        type_ = self._type(src)
+        if type_ is None:
+            raise ResponseError('no such key')
+        self.delete(dst)
+        self._execute('UPDATE keys SET key = ? WHERE key = ?', (dst, src))
+        self._execute('UPDATE {} SET key = ? WHERE key = ?'.format(
+            SQLITE_TABLES[type_]), (dst, src))
+        return True
+
+    @_atomic
+    def renamenx(self, src, dst):
+        if self.exists(dst):
+            if not self.exists(src):
+                raise ResponseError('no such key')
+            return False
+        return self.rename(src, dst)
+
+    def scan_iter(self, match=None, count=None):
+        # pages by key, so the keys may be deleted while iterating
+        last = ''
+        while True:
+            sql = 'SELECT key FROM keys WHERE key > ? AND ' \
+                  '(expires IS NULL OR expires > ?)'
+            params = [last, time()]
+            if match is not None:
+                sql += ' AND key GLOB ?'
+                params.append(_key(match))
+            sql += ' ORDER BY key LIMIT ?'
+            params.append(int(count or 500))
+            keys = [row[0] for row in self._execute(sql, params)]
+            for key in keys:
+                yield key.encode('utf-8')
+            if len(keys) < int(count or 500):
+                return
+            last = keys[-1]
+
+    def scan(self, cursor=0, match=None, count=None):
+        return 0, list(self.scan_iter(match, count))
+
+    @_atomic
+    def flushdb(self):
+        self._execute('DELETE FROM keys')
+        for table in SQLITE_TABLES.values():
+            self._execute('DELETE FROM {}'.format(table))
+        return True
+
+    def info(self, section=None):
+        pages = self._one('PRAGMA page_count')
+        size = self._one('PRAGMA page_size')
+        return {'redis_version': 'sqlite ' + sqlite3.sqlite_version,
+                'used_disk': pages * size,
+                'db0': {'keys': self._one('SELECT COUNT(*) FROM keys')}}
+
+    def ping(self):
+        return True
+
+    def publish(self, channel, message):
+        return 0
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return LocalPipeline(self, transaction)
+
+    # strings
+
+    def get(self, name):
+        if not self._check(name, 'string'):
+            return None
+        return self._one('SELECT value FROM strings WHERE key = ?',
+                         (_key(name),))
+
+    def mget(self, keys, *args):
+        if isinstance(keys, (bytes, str)):
+            keys = [keys]
+        # like redis, a key of another type reads as missing
+        return [self.get(name) if self._type(_key(name)) == 'string'
+                else None for name in list(keys) + list(args)]
+
+    @_atomic
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        exists = self.exists(name)
+        if (nx and exists) or (xx and not exists):
+            return None
+        self.delete(name)
+        key = self._create(name, 'string')
+        self._execute('INSERT INTO strings (key, value) VALUES (?, ?)',
+                      (key, _encode(value)))
+        if ex is not None:
+            self.expire(name, ex)
+        elif px is not None:
+            self._execute('UPDATE keys SET expires = ? WHERE key = ?',
+                          (time() + int(px) / 1000.0, key))
+        return True
+
+    def setex(self, name, time_, value):
+        return self.set(name, value, ex=time_)
+
+    def _put_string(self, key, value):
+        self._execute('INSERT OR REPLACE INTO strings (key, value) '
+                      'VALUES (?, ?)', (key, value))
+
+    @_atomic
+    def incrby(self, name, amount=1):
+        key = self._create(name, 'string')
+        value = self._one('SELECT value FROM strings WHERE key = ?', (key,))
+        try:
+            value = int(value or 0) + int(amount)
+        except ValueError:
+            raise ResponseError('value is not an integer or out of range')
+        self._put_string(key, _encode(value))
+        return value
+
+    incr = incrby
+
+    def getbit(self, name, offset):
+        value = self.get(name)
+        byte, bit = divmod(int(offset), 8)
+        if value is None or byte >= len(value):
+            return 0
+        return (value[byte] >> (7 - bit)) & 1
+
+    @_atomic
+    def setbit(self, name, offset, value):
+        key = self._create(name, 'string')
+        data = bytearray(self._one('SELECT value FROM strings WHERE key = ?',
+                                   (key,)) or b'')
+        byte, bit = divmod(int(offset), 8)
+        if byte >= len(data):
+            data.extend(bytes(byte + 1 - len(data)))
+        old = (data[byte] >> (7 - bit)) & 1
+        if int(value):
+            data[byte] |= 1 << (7 - bit)
+        else:
+            data[byte] &= ~(1 << (7 - bit)) & 0xff
+        self._put_string(key, bytes(data))
+        return old
+
+    # hashes
+
+    def hget(self, name, key):
+        if not self._check(name, 'hash'):
+            return None
+        return self._one('SELECT value FROM hashes WHERE key = ? AND '
+                         'field = ?', (_key(name), _encode(key)))
+
+    def hmget(self, name, keys, *args):
+        if isinstance(keys, (bytes, str)):
+            keys = [keys]
+        return [self.hget(name, key) for key in list(keys) + list(args)]
+
+    def hgetall(self, name):
+        if not self._check(name, 'hash'):
+            return {}
+        return dict(self._execute('SELECT field, value FROM hashes '
+                                  'WHERE key = ?', (_key(name),)))
+
+    def hkeys(self, name):
+        return list(self.hgetall(name))
+
+    def hlen(self, name):
+        if not self._check(name, 'hash'):
+            return 0
+        return self._one('SELECT COUNT(*) FROM hashes WHERE key = ?',
+                         (_key(name),))
+
+    def hexists(self, name, key):
+        return self.hget(name, key) is not None
+
+    @_atomic
+    def hset(self, name, key, value):
+        new = self.hget(name, key) is None
+        self._execute('INSERT OR REPLACE INTO hashes (key, field, value) '
+                      'VALUES (?, ?, ?)', (self._create(name, 'hash'),
+                                           _encode(key), _encode(value)))
+        return int(new)
+
+    @_atomic
+    def hmset(self, name, mapping):
+        key = self._create(name, 'hash')
+        self._connection().executemany(
+            'INSERT OR REPLACE INTO hashes (key, field, value) '
+            'VALUES (?, ?, ?)', [(key, _encode(field), _encode(value))
+                                 for field, value in mapping.items()])
+        return True
+
+    @_atomic
+    def hdel(self, name, *keys):
+        if not self._check(name, 'hash'):
+            return 0
+        count = self._connection().executemany(
+            'DELETE FROM hashes WHERE key = ? AND field = ?',
+            [(_key(name), _encode(key)) for key in keys]).rowcount
+        self._drop_empty(_key(name), 'hash')
+        return count
+
+    @_atomic
+    def hincrby(self, name, key, amount=1):
+        value = int(self.hget(name, key) or 0) + int(amount)
+        self.hset(name, key, value)
+        return value
+
+    # sets
+
+    def sadd(self, name, *values):
+        # read first: adding members already there must not wait for, or
+        # hold up, the writer
+        members = list(set(_encode(value) for value in values))
+        if len(members) <= 100 and self._check(name, 'set') and self._one(
+                'SELECT COUNT(*) FROM sets WHERE key = ? AND member IN '
+                '({})'.format(', '.join('?' * len(members))),
+                [_key(name)] + members) == len(members):
+            return 0
+        return self._sadd(name, *values)
+    sadd.writes = True
+
+    @_atomic
+    def _sadd(self, name, *values):
+        key = self._create(name, 'set')
+        return self._connection().executemany(
+            'INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)',
+            [(key, _encode(value)) for value in values]).rowcount
+
+    @_atomic
+    def srem(self, name, *values):
+        if not self._check(name, 'set'):
+            return 0
+        count = self._connection().executemany(
+            'DELETE FROM sets WHERE key = ? AND member = ?',
+            [(_key(name), _encode(value)) for value in values]).rowcount
+        self._drop_empty(_key(name), 'set')
+        return count
+
+    @_atomic
+    def spop(self, name):
+        if not self._check(name, 'set'):
+            return None
+        key = _key(name)
+        member = self._one('SELECT member FROM sets WHERE key = ? LIMIT 1',
+                           (key,))
+        self._execute('DELETE FROM sets WHERE key = ? AND member = ?',
+                      (key, member))
+        self._drop_empty(key, 'set')
+        return member
+
+    def smembers(self, name):
+        if not self._check(name, 'set'):
+            return set()
+        return set(row[0] for row in self._execute(
+            'SELECT member FROM sets WHERE key = ?', (_key(name),)))
+
+    def scard(self, name):
+        if not self._check(name, 'set'):
+            return 0
+        return self._one('SELECT COUNT(*) FROM sets WHERE key = ?',
+                         (_key(name),))
+
+    def sismember(self, name, value):
+        if not self._check(name, 'set'):
+            return False
+        return self._one('SELECT 1 FROM sets WHERE key = ? AND member = ?',
+                         (_key(name), _encode(value))) is not None
+
+    def sscan(self, name, cursor=0, match=None, count=None):
+        members = self.smembers(name)
+        if match is not None:
+            members = [member for member in members if fnmatch.fnmatchcase(
+                member.decode('utf-8', 'replace'), match)]
+        return 0, list(members)
+
+    # lists
+
+    def _push(self, name, values, left):
+        key = self._create(name, 'list')
+        if left:
+            pos = self._one('SELECT MIN(pos) FROM lists WHERE key = ?',
+                            (key,))
+            rows = [(key, (pos or 0) - 1 - i, _encode(value))
+                    for i, value in enumerate(values)]
+        else:
+            pos = self._one('SELECT MAX(pos) FROM lists WHERE key = ?',
+                            (key,))
+            rows = [(key, (pos or 0) + 1 + i, _encode(value))
+                    for i, value in enumerate(values)]
+        self._connection().executemany(
+            'INSERT INTO lists (key, pos, value) VALUES (?, ?, ?)', rows)
+        return self.llen(name)
+
+    @_atomic
+    def lpush(self, name, *values):
+        return self._push(name, values, True)
+
+    @_atomic
+    def rpush(self, name, *values):
+        return self._push(name, values, False)
+
+    def _pop(self, name, order):
+        if not self._check(name, 'list'):
+            return None
+        key = _key(name)
+        row = self._execute('SELECT pos, value FROM lists WHERE key = ? '
+                            'ORDER BY pos {} LIMIT 1'.format(order),
+                            (key,)).fetchone()
+        self._execute('DELETE FROM lists WHERE key = ? AND pos = ?',
+                      (key, row[0]))
+        self._drop_empty(key, 'list')
+        return row[1]
+
+    @_atomic
+    def lpop(self, name):
+        return self._pop(name, 'ASC')
+
+    @_atomic
+    def rpop(self, name):
+        return self._pop(name, 'DESC')
+
+    def llen(self, name):
+        if not self._check(name, 'list'):
+            return 0
+        return self._one('SELECT COUNT(*) FROM lists WHERE key = ?',
+                         (_key(name),))
+
+    def lrange(self, name, start, end):
+        start, end = _slice(self.llen(name), start, end)
+        if start >= end:
+            return []
+        return [row[0] for row in self._execute(
+            'SELECT value FROM lists WHERE key = ? ORDER BY pos '
+            'LIMIT ? OFFSET ?', (_key(name), end - start, start))]
+
+    # sorted sets
+
+    @_atomic
+    def zadd(self, name, *args, **kwargs):
+        pairs = list(zip(args[1::2], args[::2])) + list(kwargs.items())
+        key = self._create(name, 'zset')
+        count = 0
+        for member, score in pairs:
+            member, score = _encode(member), float(score)
+            if self._execute('INSERT OR IGNORE INTO zsets (key, member, '
+                             'score) VALUES (?, ?, ?)',
+                             (key, member, score)).rowcount:
+                count += 1
+            else:
+                self._execute('UPDATE zsets SET score = ? WHERE key = ? AND '
+                              'member = ?', (score, key, member))
+        return count
+
+    @_atomic
+    def zincrby(self, name, value, amount=1):
+        score = (self.zscore(name, value) or 0) + float(amount)
+        self.zadd(name, score, value)
+        return score
+
+    @_atomic
+    def zrem(self, name, *values):
+        if not self._check(name, 'zset'):
+            return 0
+        count = self._connection().executemany(
+            'DELETE FROM zsets WHERE key = ? AND member = ?',
+            [(_key(name), _encode(value)) for value in values]).rowcount
+        self._drop_empty(_key(name), 'zset')
+        return count
+
+    def zscore(self, name, value):
+        if not self._check(name, 'zset'):
+            return None
+        return self._one('SELECT score FROM zsets WHERE key = ? AND '
+                         'member = ?', (_key(name), _encode(value)))
+
+    def zcard(self, name):
+        if not self._check(name, 'zset'):
+            return 0
+        return self._one('SELECT COUNT(*) FROM zsets WHERE key = ?',
+                         (_key(name),))
+
+    def _by_score(self, min, max):
+        low, low_open = _score(min)
+        high, high_open = _score(max)
+        return 'score {} ? AND score {} ?'.format(
+            '>' if low_open else '>=', '<' if high_open else '<='), \
+            [low, high]
+
+    def zcount(self, name, min, max):
+        if not self._check(name, 'zset'):
+            return 0
+        where, params = self._by_score(min, max)
+        return self._one('SELECT COUNT(*) FROM zsets WHERE key = ? AND ' +
+                         where, [_key(name)] + params)
+
+    def _reply(self, rows, withscores, score_cast_func):
+        if withscores:
+            return [(member, score_cast_func(score)) for member, score in rows]
+        return [member for member, _ in rows]
+
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        start, end = _slice(self.zcard(name), start, end)
+        if start >= end:
+            return []
+        order = 'DESC' if desc else 'ASC'
+        rows = self._execute(
+            'SELECT member, score FROM zsets WHERE key = ? ORDER BY '
+            'score {0}, member {0} LIMIT ? OFFSET ?'.format(order),
+            (_key(name), end - start, start))
+        return self._reply(rows, withscores, score_cast_func)
+
+    def zrevrange(self, name, start, end, withscores=False,
+                  score_cast_func=float):
+        return self.zrange(name, start, end, True, withscores,
+                           score_cast_func)
+
+    def _range_by_score(self, name, min, max, start, num, order):
+        limit = _limit(start, num)
+        if not self._check(name, 'zset'):
+            return []
+        where, params = self._by_score(min, max)
+        sql = 'SELECT member, score FROM zsets WHERE key = ? AND ' + where + \
+            ' ORDER BY score {0}, member {0}'.format(order)
+        params = [_key(name)] + params
+        if limit.start is not None:
+            # a negative LIMIT is no limit in sqlite too
+            sql += ' LIMIT ? OFFSET ?'
+            params += [int(num), limit.start]
+        return self._execute(sql, params).fetchall()
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        return self._reply(self._range_by_score(name, min, max, start, num,
+                                                'ASC'),
+                           withscores, score_cast_func)
+
+    def zrevrangebyscore(self, name, max, min, start=None, num=None,
+                         withscores=False, score_cast_func=float):
+        return self._reply(self._range_by_score(name, min, max, start, num,
+                                                'DESC'),
+                           withscores, score_cast_func)
+
+    @_atomic
+    def zremrangebyscore(self, name, min, max):
+        if not self._check(name, 'zset'):
+            return 0
+        where, params = self._by_score(min, max)
+        count = self._execute('DELETE FROM zsets WHERE key = ? AND ' + where,
+                              [_key(name)] + params).rowcount
+        self._drop_empty(_key(name), 'zset')
+        return count
+
+    def zscan(self, name, cursor=0, match=None, count=None,
+              score_cast_func=float):
+        rows = self._range_by_score(name, '-inf', '+inf', None, None, 'ASC')
+        return 0, [(member, score_cast_func(score)) for member, score in rows
+                   if match is None or fnmatch.fnmatchcase(
+                       member.decode('utf-8', 'replace'), match)]
+
+
+def redis_storage():
+    if METRICS:
+        from .metrics import InstrumentedRedis
+        return InstrumentedRedis(host=REDIS_HOST, port=REDIS_PORT,
+                                 key_prefix=DB_PREFIX)
+    return redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT)
+
+
+backends = {
+    'redis': redis_storage,
+    'memory': MemoryStorage,
+    'sqlite': SqliteStorage,
+}
+
+
+def get_storage(backend=DB_BACKEND, **params):
+    if backend not in backends:
+        raise ValueError("unknown db backend: {}".format(backend))
+
+    return backends[backend](**params)
+
+
+def check_shared(processes, backend=DB_BACKEND):
+    '''
+    Raise when ``processes`` would each get data of their own: more than
+    one engine worker, or the engine and the api run apart, on a backend
+    that lives in one process.
+    '''
+    if backend not in backends:
+        raise ValueError("unknown db backend: {}".format(backend))
+
+    if getattr(backends[backend], 'shared', True):
+        return
+    raise ValueError("db backend {} is not shared between processes, can "
+                     "not run {}".format(backend, processes))
@@ -0,0 +1,91 @@
+'''
+Run one engine worker process per shard, see ENGINE_SHARDS.
+
+Every worker serves the periodic funcs of its shard (``process_robot:<n>``)
+so each robot and task is handled by exactly one worker, and the API side
+submits jobs to the same shards as long as it runs with the same
+ENGINE_SHARDS.
+'''
+import os
+import signal
+import asyncio
+from time import sleep
+from grapy import engine
+from .utils import logger, ENGINE_SHARDS
+from .storage import check_shared
+
+
+class Supervisor(object):
+    '''
+    Fork ``workers`` processes, worker ``n`` running ``target(n)``.
+
+    SIGINT and SIGTERM are passed on to the workers as SIGTERM, which
+    ``RobotBased.signal_handler`` turns into a graceful drain of the jobs
+    they are running. A worker that exits before that is restarted.
+    '''
+
+    def __init__(self, target, workers=ENGINE_SHARDS, restart_delay=1):
+        if workers > 1:
+            check_shared('{} engine workers'.format(workers))
+        self.target = target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.alive = True
+        self.children = {}
+
+    def spawn(self, shard):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # the parent's loop shares its selector with every child, and
+            # grapy's engine took that loop when it was imported
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            engine.loop = loop
+            code = 0
+            try:
+                self.target(shard)
+            except BaseException as e:
+                logger.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+
+        logger.info('engine worker %s started, pid %s', shard, pid)
+        self.children[pid] = shard
+
+    def signal_handler(self, signum, frame):
+        if not self.alive:
+            return
+        self.alive = False
+        logger.info('draining %s engine workers', len(self.children))
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+
+        for shard in range(self.workers):
+            self.spawn(shard)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            shard = self.children.pop(pid, None)
+            if shard is None:
+                continue
+
+            if self.alive:
+                logger.warning('engine worker %s (pid %s) exited with %s, '
+                               'restarting', shard, pid, status)
+                sleep(self.restart_delay)
+                if self.alive:
+                    self.spawn(shard)
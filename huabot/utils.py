@@ -3,6 +3,7 @@ import re
 import os.path
 import json
 import random
+import zlib
 import hashlib
 import logging
 from collections import defaultdict
@@ -23,6 +24,116 @@ REDIS_HOST, REDIS_PORT = get_env_redis_host()
 
 DB_PREFIX = os.environ.get("DB_PREFIX", "huabot")
 
+# redis, memory or sqlite, see huabot.storage
+DB_BACKEND = os.environ.get("DB_BACKEND", "redis")
+# the sqlite backend's database file and how much of it is memory mapped
+DB_SQLITE_PATH = os.environ.get("DB_SQLITE_PATH", "huabot.sqlite3")
+DB_SQLITE_MMAP = int(os.environ.get("DB_SQLITE_MMAP", 1 << 30))
+
+
+def parse_retention(spec):
+    '''
+    Parse a ``dtype=age`` list into seconds per dtype. Ages take an
+    ``m``, ``h`` or ``d`` suffix, a bare number is seconds and ``0``
+    keeps the buckets forever.
+
+    >>> sorted(parse_retention('minute=2d,hour=30d').items())
+    [('hour', 2592000), ('minute', 172800)]
+    >>> parse_retention('hour=12h, minute=90m, day=0')
+    {'hour': 43200, 'minute': 5400}
+    >>> parse_retention('')
+    {}
+    '''
+    units = {'m': 60, 'h': 3600, 'd': 86400}
+    ret = {}
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        dtype, age = part.split('=', 1)
+        age = age.strip()
+        if age[-1:] in units:
+            age = int(age[:-1]) * units[age[-1]]
+        else:
+            age = int(age)
+        if age > 0:
+            ret[dtype.strip()] = age
+    return ret
+
+SUCCEED_COUNT_RETENTION = parse_retention(
+    os.environ.get("SUCCEED_COUNT_RETENTION", "minute=2d,hour=30d"))
+
+DEDUP_BACKEND = os.environ.get("DEDUP_BACKEND", "set")
+DEDUP_CAPACITY = int(os.environ.get("DEDUP_CAPACITY", 100000))
+DEDUP_ERROR_RATE = float(os.environ.get("DEDUP_ERROR_RATE", 0.001))
+
+# sha1: 40 char hex digests, int64: the digest's first 8 bytes as a signed
+# integer, which redis keeps in its compact intset/listpack encodings
+FINGERPRINT = os.environ.get("FINGERPRINT", "sha1")
+# placeholder member of the uniq/item sets, an integer in int64 mode so
+# the sets can keep the intset encoding
+SET_SENTINEL = '0' if FINGERPRINT == 'int64' else 'haha'
+
+# raw, zlib, zlib-dict or lz4, see huabot.codec
+LINK_CODEC = os.environ.get("LINK_CODEC", "raw")
+# a file holding the zlib-dict dictionary, the built-in one when unset
+LINK_CODEC_DICT = os.environ.get("LINK_CODEC_DICT")
+
+# token bucket pacing of the scheduler loops, requests per second and
+# burst size per robot and per crawled host; a rate of 0 turns it off
+PACE_ROBOT_RATE = float(os.environ.get("PACE_ROBOT_RATE", 1))
+PACE_ROBOT_BURST = int(os.environ.get("PACE_ROBOT_BURST", 5))
+PACE_HOST_RATE = float(os.environ.get("PACE_HOST_RATE", 2))
+PACE_HOST_BURST = int(os.environ.get("PACE_HOST_BURST", 10))
+
+# rows of the cacheable tables kept per process, 0 turns the cache off,
+# and the seconds one may be served without reading redis again
+OBJECT_CACHE_SIZE = int(os.environ.get("OBJECT_CACHE_SIZE", 0))
+OBJECT_CACHE_TTL = float(os.environ.get("OBJECT_CACHE_TTL", 60))
+
+# tables whose rows are redis hashes, one field per column, instead of
+# json strings, e.g. "robot,task"; see huabot.db.Table.update, and
+# ``python -m huabot.migrate rows`` after changing it
+HASH_ROWS = set(name.strip() for name in
+                os.environ.get("HASH_ROWS", "").split(",") if name.strip())
+
+# redis latency and hot path timings for /api/metrics, see huabot.metrics,
+# and the seconds between two snapshots of an engine process
+METRICS = os.environ.get("METRICS", "0") not in ("", "0", "false", "no")
+METRICS_INTERVAL = int(os.environ.get("METRICS_INTERVAL", 15))
+
+# engine worker processes, periodic jobs are spread over them by name
+ENGINE_SHARDS = int(os.environ.get("ENGINE_SHARDS", 1))
+
+
+def shard_of(name, shards=ENGINE_SHARDS):
+    '''
+    The shard of a periodic job name, stable across processes and runs.
+
+    >>> shard_of('5', 4)
+    2
+    >>> shard_of(5, 4)
+    2
+    >>> shard_of('42', 1)
+    0
+    '''
+    if shards <= 1:
+        return 0
+    return zlib.crc32(bytes(str(name), 'utf-8')) % shards
+
+
+def shard_func(func, shard, shards=ENGINE_SHARDS):
+    '''
+    The periodic func served by ``shard``, plain ``func`` when unsharded.
+
+    >>> shard_func('process_robot', 3, 4)
+    'process_robot:3'
+    >>> shard_func('process_robot', 0, 1)
+    'process_robot'
+    '''
+    if shards <= 1:
+        return func
+    return '{}:{}'.format(func, shard)
+
 
 def to_int(val):
     '''
@@ -146,6 +257,42 @@ def hash_url(url):
     return h.hexdigest()
 
 
+def fingerprint(url, mode=None):
+    '''
+    The key a crawled url is stored and deduplicated under.
+
+    >>> fingerprint('http://example.com', 'sha1')
+    '89dce6a446a69d6b9bdc01ac75251e4c322bcdff'
+    >>> fingerprint('http://example.com', 'int64')
+    '-8512675602402730645'
+    '''
+    if (mode or FINGERPRINT) == 'int64':
+        h = hashlib.sha1()
+        h.update(bytes(url, 'utf-8'))
+        return str(int.from_bytes(h.digest()[:8], 'big', signed=True))
+
+    return hash_url(url)
+
+
+def hex_to_fingerprint(hex_digest):
+    '''
+    Convert a ``hash_url`` digest to its int64 fingerprint, anything else
+    is returned unchanged.
+
+    >>> hex_to_fingerprint('89dce6a446a69d6b9bdc01ac75251e4c322bcdff')
+    '-8512675602402730645'
+    >>> hex_to_fingerprint('haha')
+    'haha'
+    '''
+    if len(hex_digest) != 40:
+        return hex_digest
+    try:
+        digest = bytes.fromhex(hex_digest)
+    except ValueError:
+        return hex_digest
+    return str(int.from_bytes(digest[:8], 'big', signed=True))
+
+
 def submit_task(task):
     req = Request(task.url)
     req.group = task.index
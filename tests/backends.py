@@ -0,0 +1,53 @@
+'''
+The storage backends the tests run huabot on, memory and sqlite, so they
+need no redis server. ``on_backends`` turns a mixin of tests into one
+``TestCase`` per backend, each starting from an empty store.
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# importing huabot.db writes its dedup sentinels, keep them out of redis
+os.environ['DB_BACKEND'] = 'memory'
+
+from huabot import db
+from huabot.storage import MemoryStorage, SqliteStorage
+
+
+class BackendCase(unittest.TestCase):
+    backend = 'memory'
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='huabot-test-')
+        if self.backend == 'sqlite':
+            client = SqliteStorage(os.path.join(self.workdir, 'db.sqlite3'))
+        else:
+            client = MemoryStorage()
+        self._client, db.db._client = db.db._client, client
+        # what importing huabot.db set up on the store it started with
+        db.dedup.init('item:uniq')
+        db.dedup.init('link:uniq')
+
+    def tearDown(self):
+        db.db._client = self._client
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    @property
+    def client(self):
+        return db.db._db
+
+
+def on_backends(tests):
+    '''
+    Class decorator of the mixin ``tests``: the memory and the sqlite
+    ``TestCase`` running them, put in the calling module by name.
+    '''
+    module = sys.modules[tests.__module__]
+    for backend in ['memory', 'sqlite']:
+        name = '{}{}Test'.format(tests.__name__, backend.capitalize())
+        setattr(module, name, type(name, (tests, BackendCase),
+                                   {'backend': backend,
+                                    '__module__': tests.__module__}))
+    return tests
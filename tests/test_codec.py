@@ -0,0 +1,93 @@
+'''
+Link payload codecs, and links stored with them, see huabot.codec.
+'''
+import unittest
+
+from tests.backends import on_backends
+from grapy.core import Request
+from huabot import db, codec
+from huabot.codec import get_codec, LinkCodec, ZlibCodec
+
+PAYLOADS = [
+    b'',
+    b'http://example.com/',
+    bytes(Request('https://www.example.com/index.html?page=2',
+                  callback='parse_item',
+                  headers={'User-Agent': 'Huabot'})),
+    b'http://example.com/' + bytes(range(256)) * 4,
+]
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for name in codec.codecs:
+            if name == 'lz4' and codec.lz4 is None:
+                continue
+            link_codec = get_codec(name)
+            for payload in PAYLOADS:
+                data = link_codec.encode(payload)
+                self.assertEqual(link_codec.decode(data), payload, name)
+
+    def test_raw_is_plain(self):
+        self.assertEqual(get_codec('raw').encode(PAYLOADS[2]), PAYLOADS[2])
+
+    def test_decode_any_codec(self):
+        # a payload stays readable after LINK_CODEC changed
+        raw = get_codec('raw')
+        for name in ['zlib', 'zlib-dict']:
+            data = get_codec(name).encode(PAYLOADS[2])
+            self.assertTrue(data.startswith(codec.MAGIC))
+            self.assertEqual(raw.decode(data), PAYLOADS[2])
+            self.assertEqual(get_codec('zlib').decode(data), PAYLOADS[2])
+
+    def test_plain_payload(self):
+        self.assertEqual(get_codec('zlib').decode(PAYLOADS[2]), PAYLOADS[2])
+
+    def test_dict_is_smaller(self):
+        plain = len(get_codec('zlib').encode(PAYLOADS[2]))
+        primed = len(get_codec('zlib-dict').encode(PAYLOADS[2]))
+        self.assertLess(primed, plain)
+        self.assertLess(primed, len(PAYLOADS[2]))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            get_codec('nope')
+        with self.assertRaises(ValueError):
+            get_codec('raw').decode(codec.MAGIC + b'?data')
+
+    def test_lz4(self):
+        if codec.lz4 is None:
+            with self.assertRaises(ValueError):
+                get_codec('lz4')
+            return
+        data = get_codec('lz4').encode(PAYLOADS[2])
+        self.assertEqual(get_codec('raw').decode(data), PAYLOADS[2])
+
+
+@on_backends
+class StoredLink(object):
+
+    def setUp(self):
+        super(StoredLink, self).setUp()
+        self._codec = db.link_codec
+
+    def tearDown(self):
+        db.link_codec = self._codec
+        super(StoredLink, self).tearDown()
+
+    def test_link(self):
+        req = Request('http://example.com/a', callback='parse_item')
+        for name in ['raw', 'zlib-dict']:
+            db.link_codec = get_codec(name)
+            db.Link('k-' + name, req).save()
+
+        db.link_codec = LinkCodec(ZlibCodec())
+        for name in ['raw', 'zlib-dict']:
+            link = db.Link('k-' + name)
+            self.assertEqual(link.req.url, 'http://example.com/a')
+            self.assertEqual(link.req.callback, 'parse_item')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+'''
+The dedup backends of the ``uniq`` keys, see huabot.dedup.
+'''
+import unittest
+
+from tests.backends import on_backends
+from huabot import db
+from huabot.dedup import SetDedup, BloomDedup, get_dedup
+
+
+class DedupTests(object):
+
+    def test_has(self):
+        dedup = self.dedup()
+        dedup.init('t:uniq')
+        self.assertFalse(dedup.has('t:uniq', 'a'))
+        self.assertTrue(dedup.has('t:uniq', 'a'))
+        self.assertFalse(dedup.has('t:uniq', 'b'))
+        self.assertFalse(dedup.has('u:uniq', 'a'))
+
+    def test_clear(self):
+        dedup = self.dedup()
+        dedup.init('t:uniq')
+        for member in ['a', 'b']:
+            dedup.has('t:uniq', member)
+        dedup.clear('t:uniq')
+        self.assertFalse(dedup.has('t:uniq', 'a'))
+        dedup.clear('t:uniq')
+        self.assertEqual(list(db.db.scan_objects('t:*')), [])
+
+
+@on_backends
+class SetDedupTests(DedupTests):
+
+    def dedup(self):
+        return SetDedup(db.db)
+
+
+@on_backends
+class BloomDedupTests(DedupTests):
+
+    def dedup(self, **params):
+        return BloomDedup(db.db, **params)
+
+    def test_layers(self):
+        dedup = self.dedup(capacity=100, error_rate=0.01)
+        members = ['m{}'.format(i) for i in range(1000)]
+        seen = sum(dedup.has('t:uniq', member) for member in members)
+        layers = int(self.client.hget(db.db.object_key('t:uniq:bloom'),
+                                      'layers'))
+        # 100, 200, 400 and 800 members
+        self.assertEqual(layers, 4)
+        # false positives stay under error_rate / (1 - ratio)
+        self.assertLess(seen, 20)
+        self.assertTrue(all(dedup.has('t:uniq', member)
+                            for member in members))
+
+
+class GetDedupTest(unittest.TestCase):
+
+    def test_backends(self):
+        self.assertIsInstance(get_dedup(db.db, 'set'), SetDedup)
+        self.assertIsInstance(get_dedup(db.db, 'bloom'), BloomDedup)
+        with self.assertRaises(ValueError):
+            get_dedup(db.db, 'nope')
+
+
+if __name__ == '__main__':
+    unittest.main()
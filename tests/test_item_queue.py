@@ -0,0 +1,67 @@
+'''
+Claiming the queued items of a task, see ``Item.claim``, next to the
+saves that queue them.
+'''
+import unittest
+
+from tests.backends import on_backends
+from huabot import db
+
+
+def new_item(i, task_id=1):
+    return db.Item(None, {'task_id': task_id, 'hash_url': 'h{}'.format(i),
+                          'cls_name': 'tests.Item'})
+
+
+@on_backends
+class ItemQueue(object):
+
+    def count(self, task_id=1):
+        return db.Item.count_by_index('task_id', task_id)
+
+    def test_claim(self):
+        items = [new_item(i) for i in range(2)]
+        for item in items:
+            item.save()
+        self.assertEqual(self.count(), 2)
+
+        claimed = sorted(db.Item.claim(1).index for _ in items)
+        self.assertEqual(claimed, sorted(item.index for item in items))
+        self.assertIsNone(db.Item.claim(1))
+        self.assertEqual(self.count(), 0)
+        self.assertIsNone(db.Item.get_by_hash_url('h0'))
+
+    def test_claim_between_index_and_queue(self):
+        item = new_item(0)
+        # Item.save indexes the row, the claim runs before it is queued
+        db.Table.save(item)
+
+        claimed = db.Item.claim(1)
+        self.assertEqual(claimed.index, item.index)
+        self.assertEqual(claimed.hash_url, 'h0')
+        self.assertEqual(self.count(), 0)
+
+        # the id the late add_queue leaves has no row any more
+        item.add_queue()
+        self.assertIs(db.Item.claim(1), False)
+        self.assertIsNone(db.Item.claim(1))
+
+    def test_claim_keeps_other_tasks(self):
+        new_item(0, task_id=1).save()
+        new_item(1, task_id=2).save()
+        self.assertIsNotNone(db.Item.claim(1))
+        self.assertIsNone(db.Item.claim(1))
+        self.assertEqual(self.count(2), 1)
+
+    def test_claim_drops_entries_of_deleted_rows(self):
+        item = new_item(0)
+        item.save()
+        db.del_object(item.key())
+        db.Item.pop_queue(1)
+
+        self.assertIsNone(db.Item.claim(1))
+        self.assertEqual(self.count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
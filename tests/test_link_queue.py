@@ -0,0 +1,94 @@
+'''
+Task link queues and the task:ready index of their depths.
+'''
+import asyncio
+import unittest
+
+from tests.backends import on_backends
+from huabot import db
+
+
+def new_task(i=0):
+    task = db.Task(None, {'user_id': 1, 'name': 't{}'.format(i),
+                          'url': 'http://example.com/{}'.format(i),
+                          'hash_url': 'h{}'.format(i)})
+    task.save()
+    return task
+
+
+@on_backends
+class LinkQueue(object):
+
+    def ready(self, task):
+        return self.client.zscore(db.db.object_key(task.ready_key()),
+                                  task.index)
+
+    def test_push_pop(self):
+        task = new_task()
+        task.link_push('a')
+        task.link_push('b')
+        self.assertEqual(self.ready(task), 2)
+        self.assertEqual(task.link_pop(), 'a')
+        self.assertEqual(self.ready(task), 1)
+        self.assertEqual(task.link_pop(), 'b')
+        self.assertIsNone(self.ready(task))
+        self.assertIsNone(task.link_pop())
+
+    def test_pop_without_ready_entry(self):
+        task = new_task()
+        task.link_push('a')
+        task.link_push('b')
+        # drift, or a queue filled before task:ready existed
+        self.client.zrem(db.db.object_key(task.ready_key()), task.index)
+        self.assertEqual(task.link_pop(), 'a')
+        self.assertEqual(self.ready(task), 1)
+        self.assertEqual(task.link_pop(), 'b')
+        self.assertIsNone(self.ready(task))
+
+    def test_pick_link_weighted(self):
+        tasks = [new_task(i) for i in range(2)]
+        tasks[0].link_push('a')
+        tasks[1].link_push('b')
+        tasks[1].link_push('c')
+        self.assertEqual(db.Task.ready([t.index for t in tasks] + [99]),
+                         [tasks[0].index, tasks[1].index])
+        picked = db.Task.pick_link([t.index for t in tasks], 0.9)
+        self.assertEqual(picked, (tasks[1].index, 'b'))
+        self.assertEqual(self.ready(tasks[1]), 1)
+
+    def test_task_main_without_ready_entry(self):
+        from grapy.core import Request
+        from huabot.sched import CommonScheduler
+
+        task = new_task()
+        for url in ['http://example.com/a', 'http://example.com/b']:
+            req = Request(url)
+            req.group = task.index
+            req.spider = 'bench'
+            link = db.Link(req=req)
+            link.save()
+            task.link_push(link.index)
+        self.client.zrem(db.db.object_key(task.ready_key()), task.index)
+
+        submitted = []
+
+        class Sched(CommonScheduler):
+
+            @asyncio.coroutine
+            def submit_req(self, req):
+                submitted.append(req.url)
+                yield from asyncio.sleep(0)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(Sched(loop=loop).task_main(task))
+        finally:
+            loop.close()
+        self.assertEqual(submitted, ['http://example.com/a',
+                                     'http://example.com/b'])
+        self.assertEqual(task.link_count(), 0)
+        self.assertIsNone(self.ready(task))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+'''
+Token buckets of the scheduler loops, on a clock the tests move.
+'''
+import asyncio
+import unittest
+
+from huabot import pacing
+from huabot.pacing import TokenBucket, Pacer, idle_delay, host_of
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class PacingCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self._time, pacing.time = pacing.time, self.clock
+
+    def tearDown(self):
+        pacing.time = self._time
+
+
+class TokenBucketTest(PacingCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.take() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(), 0.5)
+
+        self.clock.now += 0.5
+        self.assertEqual(bucket.take(), 0)
+        self.assertAlmostEqual(bucket.take(), 0.5)
+
+    def test_refill_stops_at_burst(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        self.clock.now += 60
+        self.assertEqual([bucket.take() for _ in range(2)], [0, 0])
+        self.assertGreater(bucket.take(), 0)
+
+
+class PacerTest(PacingCase):
+
+    def setUp(self):
+        super(PacerTest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super(PacerTest, self).tearDown()
+
+    def wait(self, pacer, key, deadline=None):
+        return self.loop.run_until_complete(pacer.wait(key, deadline))
+
+    def test_keys_apart(self):
+        pacer = Pacer(rate=1)
+        self.assertEqual(pacer.bucket('a').take(), 0)
+        self.assertEqual(pacer.bucket('b').take(), 0)
+        self.assertGreater(pacer.bucket('a').take(), 0)
+
+    def test_least_recently_used_dropped(self):
+        pacer = Pacer(rate=1, max_keys=2)
+        a = pacer.bucket('a')
+        pacer.bucket('b')
+        pacer.bucket('a')
+        pacer.bucket('c')
+        self.assertIs(pacer.bucket('a'), a)
+        self.assertNotIn('b', pacer._buckets)
+
+    def test_off(self):
+        pacer = Pacer(rate=0)
+        for _ in range(10):
+            self.assertTrue(self.wait(pacer, 'a', deadline=self.clock.now))
+        self.assertFalse(pacer._buckets)
+
+    def test_deadline(self):
+        pacer = Pacer(rate=1)
+        self.assertTrue(self.wait(pacer, 'a', deadline=self.clock.now))
+        self.assertFalse(self.wait(pacer, 'a',
+                                   deadline=self.clock.now + 0.5))
+
+    def test_wait_for_token(self):
+        # on the real clock, the second token comes a millisecond later
+        pacing.time = self._time
+        pacer = Pacer(rate=1000)
+        self.assertTrue(self.wait(pacer, 'a'))
+        self.assertTrue(self.wait(pacer, 'a'))
+        self.assertLess(pacer.bucket('a').tokens, 1)
+
+
+class HelpersTest(unittest.TestCase):
+
+    def test_idle_delay(self):
+        self.assertEqual([idle_delay(i) for i in range(4)],
+                         [0, 0.05, 0.1, 0.2])
+        self.assertEqual(idle_delay(20), 2)
+
+    def test_host_of(self):
+        self.assertEqual(host_of('http://Example.com:8080/a?b'),
+                         'example.com:8080')
+
+
+if __name__ == '__main__':
+    unittest.main()
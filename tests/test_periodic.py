@@ -0,0 +1,87 @@
+'''
+``ClientPool.execute_many`` against a periodic client that fails the
+jobs it is told to, without a periodic server.
+'''
+import os
+import asyncio
+import unittest
+
+# importing huabot.db writes its dedup sentinels, keep them out of redis
+os.environ['DB_BACKEND'] = 'memory'
+
+from huabot.periodic import ClientPool
+
+
+class FakeClient(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @asyncio.coroutine
+    def submitJob(self, job):
+        yield from asyncio.sleep(0)
+        self.pool.sent.append(job)
+        if self.pool.failures.get(job, 0) > 0:
+            self.pool.failures[job] -= 1
+            raise ConnectionError('lost {}'.format(job))
+        return job.upper()
+
+    def close(self):
+        pass
+
+
+class FakePool(ClientPool):
+
+    def __init__(self, failures, **kwargs):
+        ClientPool.__init__(self, **kwargs)
+        # how many times each job fails before it goes through
+        self.failures = failures
+        self.sent = []
+
+    @asyncio.coroutine
+    def _connect(self):
+        yield from asyncio.sleep(0)
+        return FakeClient(self)
+
+
+class ExecuteManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def execute_many(self, failures, jobs, depth=2):
+        pool = FakePool(failures)
+        rets = self.loop.run_until_complete(pool.execute_many(
+            'submitJob', [(job,) for job in jobs], depth=depth))
+        return pool, rets
+
+    def test_all_sent(self):
+        pool, rets = self.execute_many({}, ['a', 'b', 'c'])
+        self.assertEqual(rets, ['A', 'B', 'C'])
+        self.assertEqual(pool.sent, ['a', 'b', 'c'])
+
+    def test_retry(self):
+        pool, rets = self.execute_many({'b': 1}, ['a', 'b', 'c', 'd'])
+        self.assertEqual(rets, ['A', 'B', 'C', 'D'])
+        # c and d were not sent before the retry
+        self.assertEqual(pool.sent, ['a', 'b', 'b', 'c', 'd'])
+
+    def test_unsent_after_retries(self):
+        pool, rets = self.execute_many({'b': 2, 'c': 2},
+                                       ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(rets[0], 'A')
+        for ret in rets[1:]:
+            self.assertIsInstance(ret, ConnectionError)
+        self.assertEqual(str(rets[1]), 'lost b')
+        self.assertEqual(str(rets[2]), 'lost c')
+        self.assertNotIn('d', pool.sent)
+        self.assertNotIn('e', pool.sent)
+
+
+if __name__ == '__main__':
+    unittest.main()
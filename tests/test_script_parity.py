@@ -0,0 +1,259 @@
+'''
+The lua scripts of huabot against their python twins: each case seeds the
+same keys, runs the script with EVAL in redis and the twin on redis,
+memory and sqlite, and every run must return the same and leave the same
+keys behind. Skipped without a redis at REDIS_PORT.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+# importing huabot.db writes its dedup sentinels, keep them out of redis
+os.environ['DB_BACKEND'] = 'memory'
+
+from redis import StrictRedis
+from redis.exceptions import ConnectionError
+from huabot import db, dedup, migrate
+from huabot.storage import MemoryStorage, SqliteStorage
+from huabot.utils import REDIS_HOST, REDIS_PORT, to_str
+
+PREFIX = 'huabot-test-{}:'.format(os.getpid())
+
+
+def _reply(value):
+    if isinstance(value, (list, tuple)):
+        return [_reply(v) for v in value]
+    if isinstance(value, dict):
+        return {_reply(k): _reply(v) for k, v in value.items()}
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+def _dump(client, prefix):
+    ret = {}
+    for key in client.scan_iter(prefix + '*'):
+        key = to_str(key)
+        kind = to_str(client.type(key))
+        if kind == 'string':
+            value = client.get(key)
+        elif kind == 'hash':
+            value = client.hgetall(key)
+        elif kind == 'set':
+            value = sorted(client.smembers(key))
+        elif kind == 'list':
+            value = client.lrange(key, 0, -1)
+        else:
+            value = client.zrange(key, 0, -1, withscores=True)
+        ret[key[len(prefix):]] = (kind, _reply(value))
+    return ret
+
+
+class ScriptParityTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.redis = StrictRedis(REDIS_HOST, int(REDIS_PORT))
+        try:
+            cls.redis.ping()
+        except ConnectionError:
+            raise unittest.SkipTest('no redis at {}:{}'.format(
+                REDIS_HOST, REDIS_PORT))
+        cls.workdir = tempfile.mkdtemp(prefix='huabot-test-')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir, ignore_errors=True)
+
+    def tearDown(self):
+        keys = list(self.redis.scan_iter(PREFIX + '*'))
+        if keys:
+            self.redis.delete(*keys)
+
+    def assertParity(self, script, case):
+        '''
+        ``case(client, prefix)`` seeds the keys of one run under
+        ``prefix`` and returns the script's keys and args.
+        '''
+        prefix = PREFIX + 'lua:'
+        keys, args = case(self.redis, prefix)
+        expected = _reply(self.redis.eval(script.script, len(keys),
+                                          *(keys + args)))
+        state = _dump(self.redis, prefix)
+        self.assertTrue(state, 'the case leaves no keys to compare')
+
+        clients = [
+            ('redis', self.redis),
+            ('memory', MemoryStorage()),
+            ('sqlite', SqliteStorage(os.path.join(
+                self.workdir, '{}.sqlite3'.format(self.id())))),
+        ]
+        for name, client in clients:
+            prefix = '{}py:{}:'.format(PREFIX, name)
+            keys, args = case(client, prefix)
+            if name == 'redis':
+                ret = script.fallback(client, keys, args)
+            else:
+                with client.atomic():
+                    ret = script.fallback(client, keys, args)
+            self.assertEqual(_reply(ret), expected, name)
+            self.assertEqual(_dump(client, prefix), state, name)
+
+    def test_pick_link(self):
+        def case(client, prefix):
+            client.zadd(prefix + 'task:ready', 2, '1')
+            client.zadd(prefix + 'task:ready', 5, '2')
+            client.zadd(prefix + 'task:ready', 1, '3')
+            client.rpush(prefix + 'task:1:link', 'a', 'b')
+            client.rpush(prefix + 'task:2:link', 'c')
+            return ([prefix + 'task:ready', prefix + 'task:1:link',
+                     prefix + 'task:2:link', prefix + 'task:3:link'],
+                    ['0.5', '1', '2', '3'])
+        self.assertParity(db._pick_link, case)
+
+    def test_pick_link_empty(self):
+        def case(client, prefix):
+            client.zadd(prefix + 'task:ready', 3, '1')
+            client.zadd(prefix + 'task:ready', 1, '2')
+            client.rpush(prefix + 'task:2:link', 'a')
+            return [prefix + 'task:ready', prefix + 'task:1:link'], \
+                ['0.1', '1']
+        self.assertParity(db._pick_link, case)
+
+    def test_pop_link(self):
+        def case(client, prefix):
+            client.rpush(prefix + 'task:1:link', 'a', 'b')
+            return [prefix + 'task:ready', prefix + 'task:1:link'], ['1']
+        self.assertParity(db._pop_link, case)
+
+    def test_pop_link_last(self):
+        def case(client, prefix):
+            client.zadd(prefix + 'task:ready', 4, '1')
+            client.zadd(prefix + 'task:ready', 1, '2')
+            client.rpush(prefix + 'task:1:link', 'a')
+            return [prefix + 'task:ready', prefix + 'task:1:link'], ['1']
+        self.assertParity(db._pop_link, case)
+
+    def test_claim_item(self):
+        def case(client, prefix):
+            client.sadd(prefix + 'task:1:item', '7')
+            client.set(prefix + 'item:7',
+                       '{"hash_url": "abc", "task_id": 1, "text": "x"}')
+            client.zadd(prefix + 'index:item', 0, '7')
+            client.zadd(prefix + 'index:item:task_id:1', 0, '7')
+            client.zadd(prefix + 'index:item:hash_url', 0, 'abc')
+            client.zadd(prefix + 'index:item:hash_url', 0, 'def')
+            return ([prefix + 'task:1:item', prefix + 'index:item',
+                     prefix + 'index:item:task_id:1'],
+                    [prefix + 'item:', prefix + 'index:item:', 'hash_url'])
+        self.assertParity(db._claim_item, case)
+
+    def test_claim_item_unqueued(self):
+        def case(client, prefix):
+            client.set(prefix + 'item:7',
+                       '{"hash_url": "abc", "task_id": 1, "text": "x"}')
+            client.zadd(prefix + 'index:item', 0, '7')
+            client.zadd(prefix + 'index:item', 0, '8')
+            client.zadd(prefix + 'index:item', 0, '9')
+            client.zadd(prefix + 'index:item:task_id:1', 0, '7')
+            client.zadd(prefix + 'index:item:task_id:1', 0, '8')
+            client.zadd(prefix + 'index:item:hash_url', 0, 'abc')
+            return ([prefix + 'task:1:item', prefix + 'index:item',
+                     prefix + 'index:item:task_id:1'],
+                    [prefix + 'item:', prefix + 'index:item:', 'hash_url'])
+        self.assertParity(db._claim_item, case)
+
+    def test_incr_succeed_count(self):
+        def case(client, prefix):
+            client.zadd(prefix + 'task:succeed_count', 3, '2026')
+            return ([prefix + 'task:succeed_count',
+                     prefix + 'task:1:succeed_count:day',
+                     prefix + 'task:1:succeed_count:minute:2026:1:2'],
+                    ['2', '3600', '2026', '2026:1:2', '2026:1:2:3:4'])
+        self.assertParity(db._incr_succeed_count, case)
+
+    def test_update_row(self):
+        def case(client, prefix):
+            client.hmset(prefix + 'robot:1', {'name': '"r"', 'alive': 'true'})
+            return [prefix + 'robot:1'], ['', 'robot:1', 'alive', 'false',
+                                          'access_token', '"t"']
+        self.assertParity(db._update_row, case)
+
+    def test_update_row_json(self):
+        def case(client, prefix):
+            client.set(prefix + 'robot:1', '{"name": "r"}')
+            return [prefix + 'robot:1'], ['', 'robot:1', 'name', '"q"']
+        self.assertParity(db._update_row, case)
+
+    def test_write_row(self):
+        def case(client, prefix):
+            client.hmset(prefix + 'robot:1', {'name': '"r"', 'old': '1'})
+            client.zadd(prefix + 'index:robot:name', 1, 'r')
+            return ([prefix + 'robot:1', prefix + 'index:robot:name',
+                     prefix + 'index:robot:name', prefix + 'index:robot'],
+                    ['1', '', 'robot:1', 'hash', 2, 'name', '"q"',
+                     '', 'r', 1, 'q', 1, '1'])
+        self.assertParity(db._write_row, case)
+
+    def test_write_row_deleted(self):
+        def case(client, prefix):
+            client.zadd(prefix + 'index:robot', 1, '1')
+            return ([prefix + 'robot:1', prefix + 'index:robot'],
+                    ['1', '', 'robot:1', 'string', 1, '{"name": "q"}',
+                     1, '1'])
+        self.assertParity(db._write_row, case)
+
+    def test_write_row_new(self):
+        def case(client, prefix):
+            return ([prefix + 'robot:2', prefix + 'index:robot'],
+                    ['', '', 'robot:2', 'string', 1, '{"name": "q"}',
+                     2, '2'])
+        self.assertParity(db._write_row, case)
+
+    def test_swap_row(self):
+        def case(client, prefix):
+            client.set(prefix + 'robot:1', '{"name": "r"}')
+            client.hmset(prefix + 'robot:2', {'name': '"q"'})
+            return [prefix + 'robot:1'], ['string', '{"name": "r"}',
+                                          'name', '"r"']
+        self.assertParity(migrate._swap_row, case)
+
+    def test_swap_row_changed(self):
+        def case(client, prefix):
+            client.hmset(prefix + 'robot:1', {'name': '"q"', 'alive': '1'})
+            return [prefix + 'robot:1'], ['hash', '{"name": "q"}',
+                                          'name', '"q"']
+        self.assertParity(migrate._swap_row, case)
+
+    def test_bloom_has(self):
+        bloom = dedup.BloomDedup(db.db, capacity=4, error_rate=0.01)
+        members = ['m{}'.format(i) for i in range(10)] + ['m3']
+
+        def case(client, prefix):
+            key = prefix + 'link:uniq:bloom'
+            for member in members[:-1]:
+                h1, h2 = bloom.hashes(member)
+                bloom._script.fallback(client, [key], [
+                    h1, h2, bloom.capacity, bloom.error_rate,
+                    bloom.growth, bloom.ratio])
+            h1, h2 = bloom.hashes(members[-1])
+            return [key], [h1, h2, bloom.capacity, bloom.error_rate,
+                           bloom.growth, bloom.ratio]
+        self.assertParity(bloom._script, case)
+
+    def test_bloom_clear(self):
+        bloom = dedup.BloomDedup(db.db)
+
+        def case(client, prefix):
+            key = prefix + 'link:uniq:bloom'
+            client.hset(key, 'layers', 2)
+            client.setbit(key + ':0', 3, 1)
+            client.setbit(key + ':1', 5, 1)
+            client.setbit(key + ':2', 7, 1)
+            return [key], []
+        self.assertParity(bloom._clear, case)
+
+
+if __name__ == '__main__':
+    unittest.main()
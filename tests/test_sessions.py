@@ -0,0 +1,140 @@
+'''
+The beaker session store of the api, see huabot.api.redis_store. It talks
+to redis itself whatever DB_BACKEND is: skipped without a redis at
+REDIS_PORT.
+'''
+import os
+import unittest
+
+# importing huabot.db writes its dedup sentinels, keep them out of redis
+os.environ['DB_BACKEND'] = 'memory'
+
+from redis import StrictRedis
+from redis.exceptions import ConnectionError
+from huabot.api.redis_store import RedisManager
+from huabot.utils import REDIS_HOST, REDIS_PORT
+
+NAMESPACE = 'huabot-test-{}'.format(os.getpid())
+
+
+class SessionCase(unittest.TestCase):
+    storage = 'hash'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.redis = StrictRedis(REDIS_HOST, int(REDIS_PORT))
+        try:
+            cls.redis.ping()
+        except ConnectionError:
+            raise unittest.SkipTest('no redis at {}:{}'.format(
+                REDIS_HOST, REDIS_PORT))
+
+    def setUp(self):
+        RedisManager.local_cache.clear()
+        self.manager = self.new_manager()
+
+    def tearDown(self):
+        RedisManager.local_cache.clear()
+        keys = list(self.redis.scan_iter('beaker:{}*'.format(NAMESPACE)))
+        if keys:
+            self.redis.delete(*keys)
+
+    def new_manager(self, **params):
+        params.setdefault('storage', self.storage)
+        return RedisManager(NAMESPACE, url='{}:{}'.format(
+            REDIS_HOST, REDIS_PORT), **params)
+
+    def stored(self, key):
+        if self.storage == 'hash':
+            return self.redis.hget('beaker:' + NAMESPACE, key)
+        return self.redis.get('beaker:{}:{}'.format(NAMESPACE, key))
+
+
+class SessionStoreTest(SessionCase):
+
+    def test_set_get(self):
+        self.manager.set_value('a', {'user': 1}, 60)
+        self.assertEqual(self.manager['a'], {'user': 1})
+        self.assertIn('a', self.manager)
+        self.assertNotIn('b', self.manager)
+        with self.assertRaises(KeyError):
+            self.manager['b']
+        self.assertEqual(self.manager.keys(), ['a'])
+
+        # another process reads it from redis
+        RedisManager.local_cache.clear()
+        self.assertEqual(self.new_manager()['a'], {'user': 1})
+
+    def test_access_time_only(self):
+        self.manager.set_value('a', {'user': 1, '_accessed_time': 1.0}, 60)
+        payload = self.stored('a')
+
+        self.manager.set_value('a', {'user': 1, '_accessed_time': 2.0}, 60)
+        self.assertEqual(self.stored('a'), payload)
+
+        self.manager.set_value('a', {'user': 2, '_accessed_time': 3.0}, 60)
+        self.assertNotEqual(self.stored('a'), payload)
+        self.assertEqual(self.manager['a']['user'], 2)
+
+    def test_refresh_expiry(self):
+        manager = self.new_manager(refresh_interval=0)
+        key = 'beaker:' + NAMESPACE
+        if self.storage != 'hash':
+            key += ':a'
+        manager.set_value('a', {'user': 1, '_accessed_time': 1.0}, 60)
+        self.redis.expire(key, 10)
+
+        manager.set_value('a', {'user': 1, '_accessed_time': 2.0}, 60)
+        self.assertGreater(self.redis.ttl(key), 10)
+
+    def test_delete(self):
+        self.manager.set_value('a', {'user': 1}, 60)
+        del self.manager['a']
+        self.assertIsNone(self.stored('a'))
+        self.assertNotIn('a', self.manager)
+
+    def test_remove(self):
+        for key in ['a', 'b']:
+            self.manager.set_value(key, {'user': key}, 60)
+        self.manager.do_remove()
+        self.assertEqual(self.manager.keys(), [])
+        self.assertEqual(
+            list(self.redis.scan_iter('beaker:{}*'.format(NAMESPACE))), [])
+
+
+class StringSessionStoreTest(SessionStoreTest):
+    storage = 'string'
+
+    def test_remove_in_batches(self):
+        manager = self.new_manager(scan_count=2)
+        for i in range(5):
+            manager.set_value(str(i), {'user': i}, 60)
+        manager.do_remove()
+        self.assertEqual(
+            list(self.redis.scan_iter('beaker:{}*'.format(NAMESPACE))), [])
+
+
+class LegacySessionTest(SessionCase):
+
+    def test_read_legacy(self):
+        legacy = self.new_manager(storage='string')
+        legacy.set_value('session', {'user': 1}, 60)
+        RedisManager.local_cache.clear()
+
+        self.assertIn('session', self.manager)
+        self.assertEqual(self.manager['session'], {'user': 1})
+        self.assertIsNone(self.redis.get(
+            'beaker:{}:session'.format(NAMESPACE)))
+        self.assertIsNotNone(self.stored('session'))
+        self.assertGreater(self.redis.ttl('beaker:' + NAMESPACE), 0)
+
+    def test_remove_legacy(self):
+        legacy = self.new_manager(storage='string')
+        legacy.set_value('session', {'user': 1}, 60)
+        self.manager.do_remove()
+        self.assertEqual(
+            list(self.redis.scan_iter('beaker:{}*'.format(NAMESPACE))), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
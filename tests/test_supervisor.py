@@ -0,0 +1,77 @@
+'''
+A worker forked by ``Supervisor.spawn`` runs the real grapy engine and
+drains the job it is running when it gets SIGTERM.
+'''
+import os
+import time
+import signal
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+# importing huabot.db writes its dedup sentinels, keep them out of redis;
+# the worker must not reach a periodic server either
+os.environ['DB_BACKEND'] = 'memory'
+workdir = tempfile.mkdtemp(prefix='huabot-test-')
+os.environ['PERIODIC_PORT'] = 'unix://' + os.path.join(workdir, 'none.sock')
+
+from grapy import engine
+from huabot import sched
+from huabot.supervisor import Supervisor
+
+
+def _wait(pid, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            return status
+        time.sleep(0.05)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    return None
+
+
+class SupervisorDrainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.started = os.path.join(workdir, 'started')
+        self.drained = os.path.join(workdir, 'drained')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    def target(self, shard):
+        robot = sched.RobotBasedScheduler(tasks=1, loop=engine.loop,
+                                          shard=shard)
+        engine.set_sched(robot)
+
+        @asyncio.coroutine
+        def job():
+            open(self.started, 'w').close()
+            yield from asyncio.sleep(0.5)
+            open(self.drained, 'w').close()
+
+        engine.loop.call_soon(
+            lambda: robot.tasks.append(asyncio.Task(job())))
+        engine.start(True)
+
+    def test_drain_on_sigterm(self):
+        supervisor = Supervisor(self.target, workers=1)
+        supervisor.spawn(0)
+        pid, = supervisor.children
+
+        deadline = time.time() + 10
+        while not os.path.exists(self.started) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(os.path.exists(self.started), 'the job never ran')
+
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(_wait(pid, 10), 0)
+        self.assertTrue(os.path.exists(self.drained))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+'''
+Saving and updating Table rows, as json strings and as hashes, see
+HASH_ROWS: a row deleted meanwhile stays deleted.
+'''
+import unittest
+
+from tests.backends import on_backends
+from huabot import db
+
+
+def new_robot(name='r'):
+    robot = db.Robot(None, {'user_id': 1, 'name': name, 'alive': True})
+    robot.save()
+    return robot
+
+
+class RowTests(object):
+    hash_rows = False
+
+    def setUp(self):
+        super(RowTests, self).setUp()
+        self._hash_tables = set(db.DB.hash_tables)
+        if self.hash_rows:
+            db.DB.hash_tables.add('robot')
+        else:
+            db.DB.hash_tables.discard('robot')
+
+    def tearDown(self):
+        db.DB.hash_tables.clear()
+        db.DB.hash_tables.update(self._hash_tables)
+        super(RowTests, self).tearDown()
+
+    def stored(self, robot):
+        return self.client.exists(db.db.object_key(robot.key()))
+
+    def test_save_and_update(self):
+        robot = new_robot()
+        self.assertTrue(robot.update(forbidden=True))
+        self.assertTrue(robot.update(alive=False, name='q'))
+
+        robot = db.Robot(robot.index)
+        self.assertEqual(robot.name, 'q')
+        self.assertFalse(robot.alive)
+        self.assertTrue(robot.forbidden)
+        self.assertEqual(db.Robot.get_by_name('q').index, robot.index)
+        self.assertIsNone(db.Robot.get_by_name('r'))
+
+    def test_update_deleted(self):
+        robot = new_robot()
+        # loaded here, deleted by another process
+        robot.payload
+        db.Robot(robot.index).delete()
+
+        self.assertFalse(robot.update(forbidden=True))
+        self.assertFalse(self.stored(robot))
+
+    def test_update_deleted_indexed(self):
+        robot = new_robot()
+        # loaded here, deleted by another process
+        robot.payload
+        db.Robot(robot.index).delete()
+
+        self.assertFalse(robot.update(name='q'))
+        self.assertFalse(self.stored(robot))
+        self.assertIsNone(db.Robot.get_by_name('q'))
+
+    def test_save_deleted(self):
+        robot = new_robot()
+        robot.payload['alive'] = False
+        db.Robot(robot.index).delete()
+
+        self.assertFalse(robot.save())
+        self.assertFalse(self.stored(robot))
+        self.assertIsNone(db.Robot.get_by_name('r'))
+
+
+@on_backends
+class JsonRows(RowTests):
+    pass
+
+
+@on_backends
+class HashRows(RowTests):
+    hash_rows = True
+
+
+if __name__ == '__main__':
+    unittest.main()